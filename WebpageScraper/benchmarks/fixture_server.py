@@ -0,0 +1,208 @@
+"""
+Local aiohttp fixture server, serves a recorded snapshot of the animals list page, the animal pages and the images.
+
+The snapshot folder mirrors the URL paths ('wiki/List_of_animal_names', 'wiki/Cat', 'upload/...').
+The SNAPSHOT_BASE_PLACEHOLDER in the recorded pages is replaced by the server's own URL,
+so the images links point back to the fixture server.
+The MediaWiki API (pageimages) is emulated from the "application/ld+json" image field of the recorded pages,
+including the titles normalization, the redirects (a recorded page "#REDIRECT [[Target]]") and the continuation
+(at most api_page_limit images per response).
+The recorded files are served with their validators (ETag / Last-Modified, from the file size and mtime),
+conditional requests (If-None-Match / If-Modified-Since) are answered "304 Not Modified", HEAD requests get no body.
+
+Latency, bandwidth and errors can be injected, e.g.:
+    python fixture_server.py snapshot --port 8080 --latency 0.05 --bandwidth 2000000 --error-rate 0.01
+"""
+import re
+import json
+import random
+import asyncio
+import argparse
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import quote
+
+from aiohttp import web
+
+SNAPSHOT_BASE_PLACEHOLDER = '__FIXTURE_BASE__'
+LD_JSON_IMAGE_PATTERN = re.compile(rb'<script type="application/ld\+json">(.*?)</script>', re.DOTALL)
+REDIRECT_PATTERN = re.compile(rb'^#REDIRECT \[\[(.+?)\]\]')
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def snapshot_file_name(url_path: str) -> str:
+    """The (file system safe) file name of a recorded URL path"""
+    return quote(url_path.lstrip('/'), safe='/')
+
+
+class FixtureServer:
+    def __init__(self, snapshot_dir: Path, latency: float = 0.0, bandwidth: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0, api_page_limit: int = 0, api_missing_images=()):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.latency = latency  # in seconds, added to every response
+        self.bandwidth = bandwidth  # in bytes per second per response, 0 means unlimited
+        self.error_rate = error_rate  # probability of a "503 Service Unavailable" response
+        self.random = random.Random(seed)
+        self.api_page_limit = api_page_limit  # images per API response (then a "continue"), 0 means unlimited
+        self.api_missing_images = frozenset(api_missing_images)  # titles the API has no lead image for
+        self.api_requests = 0
+        self.base_url = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self._runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_stats', self.handle_stats)
+        app.router.add_get('/w/api.php', self.handle_api)
+        app.router.add_get('/{path:.*}', self.handle_file)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'api_requests': self.api_requests, 'bytes_sent': self.bytes_sent}
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def snapshot_path(self, url_path: str) -> Path:
+        return Path(self.snapshot_dir, snapshot_file_name(url_path))
+
+    def read_snapshot_file(self, url_path: str):
+        path = self.snapshot_path(url_path)
+        if not path.is_file():
+            return None
+        content = path.read_bytes()
+        if url_path.startswith('/wiki/'):
+            content = content.replace(SNAPSHOT_BASE_PLACEHOLDER.encode(), self.base_url.encode())
+        return content
+
+    async def respond(self, request: web.Request, body: bytes, content_type: str,
+                      headers: dict = None) -> web.StreamResponse:
+        """Send the body, throttled to the configured bandwidth"""
+        response = web.StreamResponse(headers={'Content-Type': content_type, 'Content-Length': str(len(body)),
+                                               **(headers or {})})
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            await response.write_eof()
+            return response
+        for offset in range(0, len(body), STREAM_CHUNK_SIZE):
+            chunk = body[offset:offset + STREAM_CHUNK_SIZE]
+            await response.write(chunk)
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        await response.write_eof()
+        self.bytes_sent += len(body)
+        return response
+
+    async def injected_failure(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        return None
+
+    async def handle_file(self, request: web.Request) -> web.StreamResponse:
+        if failure := await self.injected_failure():
+            return failure
+        content = self.read_snapshot_file(request.path)
+        if content is None:
+            return web.Response(status=404)
+        stat = self.snapshot_path(request.path).stat()
+        validators = {'ETag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                      'Last-Modified': formatdate(stat.st_mtime, usegmt=True)}
+        if not_modified(request, validators, stat.st_mtime):
+            return web.Response(status=304, headers=validators)
+        content_type = mimetypes.guess_type(request.path)[0] or 'text/html'
+        return await self.respond(request, content, content_type, validators)
+
+    async def handle_api(self, request: web.Request) -> web.StreamResponse:
+        """Minimal action=query&redirects=1&prop=pageimages emulation (formatversion=2)"""
+        if failure := await self.injected_failure():
+            return failure
+        self.api_requests += 1
+        query = {'pages': []}
+        images_offset = int(request.query.get('picontinue', 0))
+        images = 0
+        for title in request.query.get('titles', '').split('|'):
+            normalized_title = normalize_title(title)
+            if normalized_title != title:
+                query.setdefault('normalized', []).append({'from': title, 'to': normalized_title})
+            content = self.read_snapshot_file(f'/wiki/{normalized_title.replace(" ", "_")}')
+            if content and (redirect := REDIRECT_PATTERN.match(content)):
+                target = normalize_title(redirect.group(1).decode())
+                query.setdefault('redirects', []).append({'from': normalized_title, 'to': target})
+                normalized_title = target
+                content = self.read_snapshot_file(f'/wiki/{target.replace(" ", "_")}')
+
+            page = {'title': normalized_title}
+            match = LD_JSON_IMAGE_PATTERN.search(content) if content else None
+            if match is None:
+                page['missing'] = content is None
+            elif (image := json.loads(match.group(1)).get('image')) and \
+                    normalized_title not in self.api_missing_images:
+                # The images before the continuation offset were sent already, the ones past the limit come next
+                if images_offset <= images < images_offset + (self.api_page_limit or float('inf')):
+                    page['original'] = {'source': image}
+                images += 1
+            query['pages'].append(page)
+
+        response = {'query': query}
+        if self.api_page_limit and images > images_offset + self.api_page_limit:
+            response['continue'] = {'picontinue': images_offset + self.api_page_limit, 'continue': '||'}
+        else:
+            response['batchcomplete'] = True
+        return await self.respond(request, json.dumps(response).encode(), 'application/json')
+
+
+def normalize_title(title: str) -> str:
+    """'red_fox' -> 'Red fox', as MediaWiki normalizes the requested titles"""
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def not_modified(request: web.Request, validators: dict, mtime: float) -> bool:
+    """Whether the conditional request headers match the current version of the file"""
+    if if_none_match := request.headers.get('If-None-Match'):
+        return validators['ETag'] in (etag.strip() for etag in if_none_match.split(','))
+    try:
+        return parsedate_to_datetime(request.headers['If-Modified-Since']).timestamp() >= int(mtime)
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+async def serve_forever(server: FixtureServer, port: int) -> None:
+    print(f'Serving {server.snapshot_dir} on {await server.start(port=port)}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('snapshot', type=Path, help='The recorded snapshot folder (see record_snapshot.py)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='Bytes per second per response (0: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 503 response')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-page-limit', type=int, default=0,
+                        help='Images per MediaWiki API response, the rest are continued (0: unlimited)')
+    args = parser.parse_args()
+    asyncio.run(serve_forever(FixtureServer(args.snapshot, args.latency, args.bandwidth, args.error_rate, args.seed,
+                                            args.api_page_limit), args.port))
@@ -0,0 +1,59 @@
+"""
+Run a scraper's main.py with an event loop lag probe attached to every asyncio.run() call.
+The probe sleeps PROBE_INTERVAL seconds repeatedly and records how late it wakes up,
+the lags are written as JSON to the path in the LOOP_LAG_OUTPUT environment variable.
+(The synchronous scraper never runs an event loop, so nothing is written for it.)
+
+Usage:
+    LOOP_LAG_OUTPUT=lag.json python loop_lag_probe.py ../v3-async-lxml-uvloop-linux/main.py
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import asyncio
+from pathlib import Path
+
+PROBE_INTERVAL = 0.01  # in seconds
+LAGS = []
+
+
+async def probe_loop_lag() -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        LAGS.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def with_lag_probe(coroutine):
+    probe = asyncio.ensure_future(probe_loop_lag())
+    try:
+        return await coroutine
+    finally:
+        probe.cancel()
+
+
+def save_lags(path: str) -> None:
+    lags = sorted(LAGS)
+    report = {'samples': len(lags), 'interval': PROBE_INTERVAL}
+    if lags:
+        report.update(max=round(lags[-1], 4), mean=round(sum(lags) / len(lags), 4),
+                      p99=round(lags[min(len(lags) - 1, int(len(lags) * 0.99))], 4))
+    with open(path, 'w') as output_file:
+        json.dump(report, output_file)
+
+
+if __name__ == '__main__':
+    main_path = Path(sys.argv[1]).resolve()
+    original_run = asyncio.run
+    asyncio.run = lambda coroutine, **kwargs: original_run(with_lag_probe(coroutine), **kwargs)
+
+    # Run it as if it was started by "python main.py" (its own folder first in the modules search path)
+    sys.argv = sys.argv[1:]
+    sys.path.insert(0, str(main_path.parent))
+    try:
+        runpy.run_path(str(main_path), run_name='__main__')
+    finally:
+        if LAGS and (output_path := os.environ.get('LOOP_LAG_OUTPUT')):
+            save_lags(output_path)
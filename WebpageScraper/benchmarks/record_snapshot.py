@@ -0,0 +1,120 @@
+"""
+Record a snapshot of the animals list page, the animal pages and their images for the fixture server.
+The images URIs in the animal pages are rewritten to point at the fixture server (SNAPSHOT_BASE_PLACEHOLDER),
+under the 'upload' folder.
+
+Usage:
+    python record_snapshot.py snapshot [--limit 50]        # record from en.wikipedia.org
+    python record_snapshot.py snapshot --synthetic 200     # generate a synthetic snapshot (no network access)
+"""
+import io
+import re
+import json
+import random
+import argparse
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+import requests
+from PIL import Image
+
+from fixture_server import SNAPSHOT_BASE_PLACEHOLDER, snapshot_file_name
+
+WIKIPEDIA_URL = 'https://en.wikipedia.org'
+ANIMALS_PAGE_PATH = '/wiki/List_of_animal_names'
+ANIMAL_LINK_PATTERN = re.compile(r'<td><a href="(/wiki/[^"#:]+)"')
+LD_JSON_PATTERN = re.compile(r'(<script type="application/ld\+json">)(.*?)(</script>)', re.DOTALL)
+USER_AGENT = 'Mozilla/5.0'
+SYNTHETIC_NAME_LETTERS = 'abdfghjkmn'
+
+
+def save(snapshot_dir: Path, url_path: str, content: bytes) -> None:
+    path = Path(snapshot_dir, snapshot_file_name(unquote(url_path)))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+def localize_image(page: str) -> (str, str):
+    """Point the ld+json image of the page at the fixture server, returns the page and the original image URI"""
+    match = LD_JSON_PATTERN.search(page)
+    if not match:
+        return page, None
+    ld_json = json.loads(match.group(2))
+    image_uri = ld_json.get('image')
+    if not image_uri:
+        return page, None
+    ld_json['image'] = f'{SNAPSHOT_BASE_PLACEHOLDER}/upload{urlsplit(image_uri).path}'
+    return page[:match.start(2)] + json.dumps(ld_json) + page[match.end(2):], image_uri
+
+
+def record(snapshot_dir: Path, limit: int = None) -> None:
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    main_page = session.get(f'{WIKIPEDIA_URL}{ANIMALS_PAGE_PATH}').content
+    save(snapshot_dir, ANIMALS_PAGE_PATH, main_page)
+
+    animal_pages = list(dict.fromkeys(ANIMAL_LINK_PATTERN.findall(main_page.decode())))[:limit]
+    for index, animal_page in enumerate(animal_pages, 1):
+        response = session.get(f'{WIKIPEDIA_URL}{animal_page}')
+        if not response.ok:
+            print(f'Skipping {animal_page} ({response.status_code})')
+            continue
+        page, image_uri = localize_image(response.text)
+        save(snapshot_dir, animal_page, page.encode())
+        if image_uri and (image := session.get(image_uri)).ok:
+            save(snapshot_dir, f'/upload{urlsplit(image_uri).path}', image.content)
+        print(f'{index}/{len(animal_pages)} {animal_page}')
+
+
+def synthetic_name(index: int) -> str:
+    """
+    A unique alphabetic name (the scrapers keep letters only), avoiding the words they cut the names at
+    ('list', 'also', 'see', 'citation')
+    """
+    return ''.join(SYNTHETIC_NAME_LETTERS[int(digit)] for digit in f'{index:05d}')
+
+
+def record_synthetic(snapshot_dir: Path, animals: int, seed: int = 0) -> None:
+    """A snapshot with the structure of the real one (table layout, ld+json images, shared images)"""
+    rng = random.Random(seed)
+    adjectives = ['canine', 'feline', 'bovine', 'equine', 'ursine', 'avian', 'piscine', 'lupine', 'vulpine']
+    headers = ('Animal', 'Young', 'Female', 'Male', 'Collective noun', 'Collateral adjective', 'Culinary noun')
+    rows = []
+    for index in range(animals):
+        name = f'Animal_{synthetic_name(index)}'
+        if index % 40 == 0:
+            rows.append(f'<tr><th colspan="{len(headers)}">{index // 40}</th></tr>')  # a letter "header" row
+        chosen = rng.sample(adjectives, rng.randint(1, 3))
+        adjective = '<br />'.join(chosen) if len(chosen) > 1 else f'{chosen[0]}<sup><a href="#n">[1]</a></sup>'
+        rows.append(f'<tr><td><a href="/wiki/{name}" title="{name}">{name}</a></td>'
+                    f'<td>cub</td><td>?</td><td>?</td><td>herd</td><td>{adjective}</td><td></td></tr>')
+
+        image_name = f'shared_{index % 7}.jpg' if index % 10 == 5 else f'{name}.jpg'  # few images are shared
+        if not Path(snapshot_dir, 'upload', image_name).is_file():
+            image = Image.new('RGB', (rng.randint(200, 800), rng.randint(200, 600)),
+                              tuple(rng.randrange(256) for _ in range(3)))
+            content = io.BytesIO()
+            image.save(content, 'JPEG')
+            save(snapshot_dir, f'/upload/{image_name}', content.getvalue())
+        ld_json = {'@context': 'https://schema.org', 'name': name,
+                   'image': f'{SNAPSHOT_BASE_PLACEHOLDER}/upload/{image_name}'}
+        page = (f'<html><head><script type="application/ld+json">{json.dumps(ld_json)}</script></head>'
+                f'<body><p>{f"{name} text. " * 200}</p></body></html>')
+        save(snapshot_dir, f'/wiki/{name}', page.encode())
+
+    table_headers = ''.join(f'<th>{header}</th>' for header in headers)
+    main_page = (f'<html><body><table class="wikitable sortable"><tr><th>Term</th></tr><tr><td>-</td></tr></table>'
+                 f'<table class="wikitable sortable"><tr>{table_headers}</tr>{"".join(rows)}</table></body></html>')
+    save(snapshot_dir, ANIMALS_PAGE_PATH, main_page.encode())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('snapshot', type=Path, help='The snapshot folder to create')
+    parser.add_argument('--limit', type=int, help='Record only the first N animal pages')
+    parser.add_argument('--synthetic', type=int, metavar='N', help='Generate N synthetic animals instead')
+    args = parser.parse_args()
+    if args.synthetic:
+        record_synthetic(args.snapshot, args.synthetic)
+    else:
+        record(args.snapshot, args.limit)
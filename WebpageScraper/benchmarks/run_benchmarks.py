@@ -0,0 +1,150 @@
+"""
+End-to-end benchmark of the v1 (sync), v2 (async) and v3 (async + lxml + uvloop) scrapers.
+Every version runs its main.py (in a fresh working folder) against the local fixture server,
+and the wall time, requests/s, peak RSS and event loop lag are reported as JSON.
+
+Every report is appended to results.jsonl with the current git commit, and the versions which got slower
+than in the previous report (by more than --threshold) are reported as regressions.
+
+Usage:
+    python record_snapshot.py snapshot --synthetic 200
+    python run_benchmarks.py snapshot [--versions v3] [--latency 0.05] [--bandwidth 2000000] [--error-rate 0.01]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import functools
+import tempfile
+import subprocess
+from pathlib import Path
+
+from fixture_server import FixtureServer
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+SCRAPERS_DIR = BENCHMARKS_DIR.parent
+VERSIONS = {
+    'v1': SCRAPERS_DIR / 'v1-sync-code',
+    'v2': SCRAPERS_DIR / 'v2-async',
+    'v3': SCRAPERS_DIR / 'v3-async-lxml-uvloop-linux',
+}
+RESULTS_FILE = BENCHMARKS_DIR / 'results.jsonl'
+COPIED_FILES = ('output_template.html',)  # files main.py expects in its working folder
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(('git', 'rev-parse', '--short', 'HEAD'), cwd=SCRAPERS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scraper(version_dir: Path, base_url: str, timeout: float) -> dict:
+    """Run main.py of the version as a child process, returns its wall time, peak RSS and loop lag"""
+    with tempfile.TemporaryDirectory(prefix='scraper_bench_') as work_dir:
+        for file_name in COPIED_FILES:
+            if Path(version_dir, file_name).is_file():
+                shutil.copy(Path(version_dir, file_name), work_dir)
+        lag_path = Path(work_dir, 'loop_lag.json')
+        env = dict(os.environ, SCRAPER_BASE_URL=base_url, SCRAPER_IMAGES_DIR=str(Path(work_dir, 'images_store')),
+                   LOOP_LAG_OUTPUT=str(lag_path))
+
+        with open(Path(work_dir, 'output.log'), 'w') as output:
+            start = time.perf_counter()
+            process = subprocess.Popen((sys.executable, str(BENCHMARKS_DIR / 'loop_lag_probe.py'),
+                                        str(version_dir / 'main.py')), cwd=work_dir, env=env,
+                                       stdout=output, stderr=subprocess.STDOUT)
+            deadline = start + timeout
+            while (waited := os.wait4(process.pid, os.WNOHANG))[0] == 0:
+                if time.perf_counter() > deadline:
+                    process.kill()
+                    waited = os.wait4(process.pid, 0)
+                    break
+                time.sleep(0.05)
+            wall_time = time.perf_counter() - start
+            # os.waitstatus_to_exitcode requires python 3.9: the exit code, or -signal when it was killed
+            status = waited[1]
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+        return {
+            'exit_code': process.returncode,
+            'wall_time': round(wall_time, 3),
+            'peak_rss_mb': round(waited[2].ru_maxrss / 1024, 1),  # ru_maxrss is in KB on Linux
+            'loop_lag': json.loads(lag_path.read_text()) if lag_path.is_file() else None,
+        }
+
+
+async def run(snapshot: Path, versions: list, latency: float, bandwidth: float, error_rate: float,
+              timeout: float) -> dict:
+    server = FixtureServer(snapshot, latency, bandwidth, error_rate)
+    base_url = await server.start()
+    results = dict()
+    try:
+        for version in versions:
+            requests_before = server.requests
+            # The scraper runs in a child process, the server keeps serving meanwhile
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(run_scraper, VERSIONS[version], base_url, timeout))
+            result['requests'] = server.requests - requests_before
+            result['requests_per_second'] = round(result['requests'] / result['wall_time'], 2)
+            results[version] = result
+            print(f'{version}: {json.dumps(result)}', file=sys.stderr)
+    finally:
+        await server.stop()
+
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'fixture': {'snapshot': str(snapshot), 'latency': latency, 'bandwidth': bandwidth, 'error_rate': error_rate},
+        'results': results,
+    }
+
+
+def find_regressions(report: dict, previous: dict, threshold: float) -> dict:
+    """The versions whose wall time grew by more than threshold (a ratio) since the previous comparable report"""
+    if not previous or previous['fixture'] != report['fixture']:
+        return dict()
+    regressions = dict()
+    for version, result in report['results'].items():
+        if (before := previous['results'].get(version)) and result['wall_time'] > before['wall_time'] * (1 + threshold):
+            regressions[version] = {'previous_commit': previous['commit'],
+                                    'previous_wall_time': before['wall_time'], 'wall_time': result['wall_time']}
+    return regressions
+
+
+def load_previous_report(fixture: dict) -> dict:
+    if not RESULTS_FILE.is_file():
+        return None
+    previous = None
+    with open(RESULTS_FILE) as results_file:
+        for line in results_file:
+            report = json.loads(line)
+            if report['fixture'] == fixture:
+                previous = report
+    return previous
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('snapshot', type=Path, help='The recorded snapshot folder (see record_snapshot.py)')
+    parser.add_argument('--versions', nargs='+', choices=VERSIONS, default=list(VERSIONS))
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='Bytes per second per response (0: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 503 response')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds before a scraper run is killed')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Wall time growth reported as a regression')
+    parser.add_argument('--no-save', action='store_true', help="Don't append the report to results.jsonl")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.snapshot.resolve(), args.versions, args.latency, args.bandwidth, args.error_rate,
+                             args.timeout))
+    report['regressions'] = find_regressions(report, load_previous_report(report['fixture']), args.threshold)
+    if not args.no_save:
+        with open(RESULTS_FILE, 'a') as results_file:
+            results_file.write(json.dumps(report) + '\n')
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report['regressions'] else 0)
@@ -1,6 +1,7 @@
 """
 App settings/Configuration
 """
+import os
 import logging
 
 # Logger related settings
@@ -17,7 +18,7 @@ LOGGING_FORMAT_STRING = '%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(m
 # HTML, pages, and tables structure settings
 USER_AGENT = 'Mozilla/5.0'
 WEBPAGE_PARSER = 'html.parser'  # TODO: try optimizing with lxml parser
-BASE_URL = 'https://en.wikipedia.org'
+BASE_URL = os.environ.get('SCRAPER_BASE_URL', 'https://en.wikipedia.org')  # overridden by the benchmarks
 LINK_SUFFIX = '_href'
 ANIMALS_PAGE_URL = f'{BASE_URL}/wiki/List_of_animal_names'
 TABLE_XPATH = 'table', {'class': 'wikitable sortable'}
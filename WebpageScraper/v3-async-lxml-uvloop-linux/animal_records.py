@@ -0,0 +1,142 @@
+"""
+Compact storage of the grouped results ("SQL like" group by, e.g. collateral adjective -> animals).
+A record (animal, image path) is stored once, however many groups it belongs to, and a group is an array('I')
+of records ids (4 bytes per member) instead of a list of (animal, image path) tuples.
+The groups keys are interned, the grouping keeps their first insertion order.
+group_records is the group by engine: a single synchronous pass over the rows (no awaits, nothing to schedule).
+"""
+import sys
+import itertools
+from array import array
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+
+def intern_key(key):
+    """A group key: a cell value, or a tuple of cells values (grouping by several columns)"""
+    return sys.intern(key) if isinstance(key, str) else tuple(map(intern_key, key))
+
+
+class AnimalRecord:
+    """An animal and its image path (None -> no image), unpacks like an (animal, image path) tuple"""
+    __slots__ = ('animal', 'image_path')
+
+    def __init__(self, animal: str, image_path=None):
+        self.animal = animal
+        self.image_path = image_path
+
+    def __iter__(self) -> Iterator:
+        return iter((self.animal, self.image_path))
+
+    def __eq__(self, other) -> bool:
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return f'AnimalRecord({self.animal!r}, {self.image_path!r})'
+
+
+class AdjectiveIndex:
+    """
+    Group key (e.g. a collateral adjective) -> the ids of its records, in insertion order.
+    Read like a dict of lists: index[key] / index.items() give the records (items() lazily, straight off the arrays)
+    """
+    __slots__ = ('records', 'ids_by_key')
+
+    def __init__(self):
+        self.records: List[AnimalRecord] = []  # record id -> record
+        self.ids_by_key: Dict[str, array] = dict()
+
+    def add(self, record: AnimalRecord, keys: Iterable[str]) -> int:
+        """Add a record to the groups of its keys, returns the record id"""
+        record_id = len(self.records)
+        self.records.append(record)
+        for key in keys:
+            ids = self.ids_by_key.get(key)
+            if ids is None:
+                ids = self.ids_by_key[intern_key(key)] = array('I')
+            ids.append(record_id)
+        return record_id
+
+    def extend(self, key: str, members: Iterable[Tuple]) -> None:
+        """Add (animal, image path) members to a single group (e.g. a grouping reused from a previous run)"""
+        for animal, image_path in members:
+            self.add(AnimalRecord(animal, image_path), (key,))
+
+    def update(self, grouping) -> None:
+        """Add the groups of another grouping (a dict of members lists, or an index)"""
+        if isinstance(grouping, AdjectiveIndex):
+            # The records are added once, with their ids shifted past the current records
+            offset = len(self.records)
+            self.records.extend(grouping.records)
+            for key, ids in grouping.ids_by_key.items():
+                own_ids = self.ids_by_key.get(key)
+                if own_ids is None:
+                    own_ids = self.ids_by_key[key] = array('I')
+                own_ids.extend(record_id + offset for record_id in ids)
+            return
+        for key, members in grouping.items():
+            self.extend(key, members)
+
+    def members(self, key: str) -> Iterator[AnimalRecord]:
+        return map(self.records.__getitem__, self.ids_by_key[key])
+
+    def items(self) -> Iterator[Tuple[str, Iterator[AnimalRecord]]]:
+        return ((key, self.members(key)) for key in self.ids_by_key)
+
+    def keys(self):
+        return self.ids_by_key.keys()
+
+    def counts(self) -> Dict[str, int]:
+        """Group key -> the number of its members"""
+        return {key: len(ids) for key, ids in self.ids_by_key.items()}
+
+    def __getitem__(self, key: str) -> List[AnimalRecord]:
+        return list(self.members(key))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ids_by_key
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids_by_key)
+
+    def __len__(self) -> int:
+        return len(self.ids_by_key)
+
+    def __repr__(self):
+        return f'AdjectiveIndex({len(self.ids_by_key)} keys, {len(self.records)} records)'
+
+
+def group_records(rows: Iterable[dict], key_column: str, group_by: Union[str, Sequence[str]],
+                  values: Iterable = None, grouping: AdjectiveIndex = None) -> AdjectiveIndex:
+    """
+    "SQL like" group by: the group_by column value -> [(key column value, the row's value)] records.
+    Stable: the groups and their members are in the rows order (then in the order of the values in a cell).
+    group_by: a column, or several columns (the keys are then the tuples of their values, e.g. (adjective, young)),
+    a multi valued cell puts the row in a group per value.
+    values: a value per row (e.g. the animals images paths), None for all the rows by default.
+    grouping: the index to add the records to (a new one by default)
+    """
+    grouping = AdjectiveIndex() if grouping is None else grouping
+    columns = (group_by,) if isinstance(group_by, str) else tuple(group_by)
+    single_column = columns[0] if len(columns) == 1 else None
+    skipped = 0
+    for row, value in zip(rows, itertools.repeat(None) if values is None else values):
+        name = row.get(key_column)
+        if single_column is not None:
+            keys = row.get(single_column)
+            if isinstance(keys, str):
+                keys = (keys,)  # a single valued cell
+        else:
+            cells = [row.get(column) for column in columns]
+            keys = None if None in cells else \
+                itertools.product(*((cell,) if isinstance(cell, str) else cell for cell in cells))
+        if name is None or keys is None:
+            skipped += 1
+            continue
+        grouping.add(AnimalRecord(name, value), keys)
+    if skipped:
+        MODULE_LOGGER.warning(f'{skipped} rows without {key_column} or {"/".join(columns)} were not grouped')
+    return grouping
@@ -0,0 +1,108 @@
+"""
+Grouping of the parsed rows (collateral adjective -> animals and their images):
+ - CPU time: the previous task fan-out (an asyncio task per row running an await-free group_by_key, then gather)
+   vs the synchronous single pass engine (animal_records.group_records)
+ - Memory per table row: a dict of lists of (animal, image path) tuples vs the animal_records.AdjectiveIndex
+   (__slots__ records, array('I') of records ids per adjective)
+Also verifies all the groupings hold the same groups, in the same order.
+
+Usage:
+    python benchmarks/bench_grouping.py [--page saved_List_of_animal_names.html] [--scale 10] [--repeat 5]
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+import animal_records  # noqa: E402
+
+from bench_table_parsing import load_page, scale_page  # noqa: E402
+from bench_table_parsers import parse_with_lxml  # noqa: E402
+
+
+async def group_by_key(result: dict, keys_to_group_by, animal_name: str, img_file_name) -> None:
+    for key in keys_to_group_by:
+        result[key].append((animal_name, img_file_name))
+
+
+async def group_with_tasks(rows: list, image_paths: list) -> dict:
+    """The previous main.combine_results: a task per row"""
+    grouping = defaultdict(list)
+    tasks = [asyncio.create_task(group_by_key(grouping, row[settings.COLATERAL_COLLECTIVES_COL],
+                                              row[settings.ANIMAL_NAME_COL_KEY], image_path))
+             for row, image_path in zip(rows, image_paths)]
+    await asyncio.gather(*tasks)
+    return grouping
+
+
+async def group_to_tuples(rows: list, image_paths: list) -> dict:
+    grouping = defaultdict(list)
+    for row, image_path in zip(rows, image_paths):
+        for key in row[settings.COLATERAL_COLLECTIVES_COL]:
+            grouping[key].append((row[settings.ANIMAL_NAME_COL_KEY], image_path))
+    return grouping
+
+
+async def group_to_index(rows: list, image_paths: list) -> animal_records.AdjectiveIndex:
+    return animal_records.group_records(rows, settings.ANIMAL_NAME_COL_KEY, settings.COLATERAL_COLLECTIVES_COL,
+                                        values=image_paths)
+
+
+async def measure(group, rows: list, image_paths: list, repeat: int) -> dict:
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        await group(rows, image_paths)
+        cpu_times.append(time.process_time() - start)
+
+    # The bytes allocated by the grouping (the rows and the images paths already exist)
+    tracemalloc.start()
+    grouping = await group(rows, image_paths)
+    allocated, peak_allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows_count = max(len(rows), 1)
+    return {
+        'grouping': group.__name__,
+        'best_cpu_time': round(min(cpu_times), 4),
+        'bytes_per_row': round(allocated / rows_count, 1),
+        'peak_bytes_per_row': round(peak_allocated / rows_count, 1),
+    }, [(key, [tuple(member) for member in members]) for key, members in grouping.items()]
+
+
+async def run(page_path: str, scale: int, repeat: int) -> dict:
+    rows = await parse_with_lxml(scale_page(await load_page(page_path), scale))
+    rows = [row for row in rows if row.get(settings.COLATERAL_COLLECTIVES_COL) and
+            row.get(settings.ANIMAL_NAME_COL_KEY)]  # the previous grouping fails on the incomplete rows
+    # Every row gets an image path (a distinct object, as the downloads return)
+    image_paths = [Path(settings.SAVED_IMAGES_DIR, f'{index:064x}.jpg') for index in range(len(rows))]
+
+    results, groupings = [], []
+    for group in (group_with_tasks, group_to_tuples, group_to_index):
+        result, grouping = await measure(group, rows, image_paths, repeat)
+        results.append(result)
+        groupings.append(grouping)
+    return {
+        'rows': len(rows),
+        'groups': len(groupings[-1]),
+        'results': results,
+        'cpu_speedup_vs_tasks': round(results[0]['best_cpu_time'] / max(results[-1]['best_cpu_time'], 1e-9), 2),
+        'identical_groups': all(grouping == groupings[-1] for grouping in groupings),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', help='A saved copy of the animals list page (default: download it)')
+    parser.add_argument('--scale', type=int, default=1, help='Duplicate the table rows N times')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per grouping (the best CPU time is reported)')
+    args = parser.parse_args()
+    report = asyncio.run(run(args.page, args.scale, args.repeat))
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['identical_groups'] else 1)
@@ -0,0 +1,68 @@
+"""
+CPU time and allocations of the main table extraction backends (bs4 tree vs lxml native XPath),
+from the main page content to the parsed rows. Also verifies both backends produce the same rows.
+
+Usage:
+    python benchmarks/bench_table_parsers.py [--page saved_List_of_animal_names.html] [--scale 10] [--repeat 3]
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+import table_parser  # noqa: E402
+import table_spec  # noqa: E402
+
+from bench_table_parsing import load_page, parse_sequentially, scale_page  # noqa: E402
+
+
+async def parse_with_lxml(page: bytes) -> list:
+    return table_parser.parse_page_with_lxml(page, table_spec.MAIN_TABLE)
+
+
+async def measure(page: bytes, backend: str, parse, repeat: int) -> (dict, list):
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        rows = await parse(page)
+        cpu_times.append(time.process_time() - start)
+
+    tracemalloc.start()
+    await parse(page)
+    _, peak_allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'backend': backend,
+        'rows': len(rows),
+        'best_cpu_time': round(min(cpu_times), 4),
+        'peak_allocated_bytes': peak_allocated,
+    }, rows
+
+
+async def run(page_path: str, scale: int, repeat: int) -> dict:
+    page = scale_page(await load_page(page_path), scale)
+    bs4_result, bs4_rows = await measure(page, 'bs4', parse_sequentially, repeat)
+    lxml_result, lxml_rows = await measure(page, settings.LXML_NATIVE_PARSER, parse_with_lxml, repeat)
+    return {
+        'results': [bs4_result, lxml_result],
+        'identical_rows': bs4_rows == lxml_rows,
+        'cpu_speedup': round(bs4_result['best_cpu_time'] / max(lxml_result['best_cpu_time'], 1e-9), 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', help='A saved copy of the animals list page (default: download it)')
+    parser.add_argument('--scale', type=int, default=1, help='Duplicate the table rows N times')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per backend (the best CPU time is reported)')
+    args = parser.parse_args()
+    report = asyncio.run(run(args.page, args.scale, args.repeat))
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['identical_rows'] else 1)
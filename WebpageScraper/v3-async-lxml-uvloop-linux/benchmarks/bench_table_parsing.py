@@ -0,0 +1,95 @@
+"""
+Event loop stall benchmark of the main table parsing (TABLE_PARSING_MODE 'sequential' vs 'process_pool'),
+from the main page content to the parsed rows.
+
+Usage:
+    python benchmarks/bench_table_parsing.py [--page saved_List_of_animal_names.html] [--scale 10]
+
+Without --page the live List_of_animal_names page is downloaded.
+--scale duplicates the table rows, to simulate bigger tables.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+import main  # noqa: E402
+import table_spec  # noqa: E402
+import table_parser  # noqa: E402
+import utilties  # noqa: E402
+
+import aiohttp  # noqa: E402
+
+PROBE_INTERVAL = 0.001  # in seconds
+
+
+async def probe_loop_lag(samples: list) -> None:
+    """Sleep for PROBE_INTERVAL over and over, and record how late every wake up was"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        samples.append(max(0.0, time.perf_counter() - start - PROBE_INTERVAL))
+
+
+async def load_page(page_path: str) -> bytes:
+    if page_path:
+        return Path(page_path).read_bytes()
+    async with aiohttp.ClientSession(headers={'User-agent': settings.USER_AGENT}) as session:
+        return await utilties.retrieve_content(settings.ANIMALS_PAGE_URL, session)
+
+
+async def parse_sequentially(page: bytes) -> list:
+    table = await main.get_main_table(page)
+    # parse_table only checks that some session is provided
+    return await main.parse_table(table, session=True, spec=table_spec.MAIN_TABLE)
+
+
+async def parse_in_process_pool(page: bytes) -> list:
+    return await table_parser.parse_page_in_process_pool(page, table_spec.MAIN_TABLE)
+
+
+async def measure(page: bytes, mode: str) -> dict:
+    samples = []
+    probe = asyncio.create_task(probe_loop_lag(samples))
+    await asyncio.sleep(PROBE_INTERVAL * 10)  # let the probe warm up
+
+    start = time.perf_counter()
+    rows = await (parse_in_process_pool(page) if mode == 'process_pool' else parse_sequentially(page))
+    elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(PROBE_INTERVAL * 10)  # let the probe record the last stall
+    probe.cancel()
+    return {
+        'mode': mode,
+        'rows': len(rows),
+        'wall_time': round(elapsed, 4),
+        'max_loop_stall': round(max(samples, default=0.0), 4),
+        'total_loop_stall': round(sum(samples), 4),
+    }
+
+
+def scale_page(page: bytes, scale: int) -> bytes:
+    """Duplicate the data rows of the relevant table"""
+    text = page.decode('utf-8', errors='replace')
+    rows = table_parser.split_table_rows(text)
+    data_rows = ''.join(rows[settings.FIRST_DATA_ROW_INDEX:])
+    end = text.index(rows[-1]) + len(rows[-1])
+    return (text[:end] + data_rows * (scale - 1) + text[end:]).encode()
+
+
+async def run(page_path: str, scale: int) -> list:
+    page = scale_page(await load_page(page_path), scale)
+    return [await measure(page, mode) for mode in ('sequential', 'process_pool')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', help='A saved copy of the animals list page (default: download it)')
+    parser.add_argument('--scale', type=int, default=1, help='Duplicate the table rows N times')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.page, args.scale)), indent=2))
@@ -0,0 +1,120 @@
+"""
+Per-row CPU cost of the table cells text normalization (text_normalization.py) vs the previous
+implementation (re.sub with an uncompiled pattern and a chain of split()s per stop word, no memoization):
+on the table cells alone, and within the whole rows parsing of both table parsing backends.
+Also verifies both implementations produce the same rows.
+
+Usage:
+    python benchmarks/bench_text_normalization.py [--page saved_List_of_animal_names.html] [--scale 10] [--repeat 5]
+"""
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+import text_normalization  # noqa: E402
+import table_parser  # noqa: E402
+import table_spec  # noqa: E402
+import utilties  # noqa: E402
+
+from bench_table_parsing import load_page, parse_sequentially, scale_page  # noqa: E402
+from bench_table_parsers import parse_with_lxml  # noqa: E402
+
+
+def legacy_clean_text(text):
+    ret = re.sub('[^a-zA-Z,]+', settings.PATHNAME_STUB_SYMBOL, text).lower()
+    ret = ret.split('list')[0].split('also')[0].split('see')[0].split('citation')[0]
+    try:
+        ret = ret[:-1] if ret[-1] == settings.PATHNAME_STUB_SYMBOL else ret
+    except IndexError:
+        return None
+    return ret
+
+
+def legacy_clean_cell_value(text):
+    return text.strip().split(' (list)')[0].split('Also')[0]
+
+
+@contextlib.contextmanager
+def legacy_normalization():
+    """Swap the previous implementation in (utilties imported the functions by name)"""
+    current = text_normalization.clean_text, text_normalization.clean_cell_value
+    for module in (text_normalization, utilties):
+        module.clean_text, module.clean_cell_value = legacy_clean_text, legacy_clean_cell_value
+    try:
+        yield
+    finally:
+        for module in (text_normalization, utilties):
+            module.clean_text, module.clean_cell_value = current
+
+
+async def measure(page: bytes, parse, repeat: int) -> (float, list):
+    cpu_times = []
+    for _ in range(repeat):
+        if hasattr(text_normalization.clean_text, 'cache_clear'):
+            text_normalization.clean_text.cache_clear()  # every run starts cold
+        start = time.process_time()
+        rows = await parse(page)
+        cpu_times.append(time.process_time() - start)
+    return min(cpu_times), rows
+
+
+def measure_normalization(page: bytes, clean_text, repeat: int) -> float:
+    """The best CPU time per row of normalizing every cell of the table"""
+    _, rows = table_parser.find_main_table_rows_lxml(page, table_spec.MAIN_TABLE)
+    rows_cells = [[cell.text_content() for cell in row.xpath('.//td')] for row in rows]
+    cpu_times = []
+    for _ in range(repeat):
+        if hasattr(clean_text, 'cache_clear'):
+            clean_text.cache_clear()
+        start = time.process_time()
+        for row_cells in rows_cells:
+            for cell_text in row_cells:
+                clean_text(cell_text)
+        cpu_times.append(time.process_time() - start)
+    return min(cpu_times) / max(len(rows_cells), 1)
+
+
+async def run(page_path: str, scale: int, repeat: int) -> dict:
+    page = scale_page(await load_page(page_path), scale)
+    before_time = measure_normalization(page, legacy_clean_text, repeat)
+    after_time = measure_normalization(page, text_normalization.clean_text, repeat)
+    report = {'results': [{
+        'backend': 'cells normalization only',
+        'before_us_per_row': round(before_time * 1e6, 2),
+        'after_us_per_row': round(after_time * 1e6, 2),
+        'speedup': round(before_time / max(after_time, 1e-9), 2),
+    }], 'identical_rows': True}
+    for backend, parse in (('bs4', parse_sequentially), (settings.LXML_NATIVE_PARSER, parse_with_lxml)):
+        with legacy_normalization():
+            before_time, before_rows = await measure(page, parse, repeat)
+        after_time, after_rows = await measure(page, parse, repeat)
+        report['identical_rows'] &= before_rows == after_rows
+        rows_count = max(len(after_rows), 1)
+        report['results'].append({
+            'backend': backend,
+            'rows': len(after_rows),
+            'before_us_per_row': round(before_time / rows_count * 1e6, 2),
+            'after_us_per_row': round(after_time / rows_count * 1e6, 2),
+            'speedup': round(before_time / max(after_time, 1e-9), 2),
+        })
+    report['cache'] = text_normalization.clean_text.cache_info()._asdict()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', help='A saved copy of the animals list page (default: download it)')
+    parser.add_argument('--scale', type=int, default=1, help='Duplicate the table rows N times')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per implementation (the best CPU time is reported)')
+    args = parser.parse_args()
+    report = asyncio.run(run(args.page, args.scale, args.repeat))
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['identical_rows'] else 1)
@@ -0,0 +1,69 @@
+"""
+Scrape checkpoints (crash recovery).
+Every step of every animal (page fetched, image uri resolved, image saved) is appended to a JSONL journal,
+so a scrape resumed after a crash (main.py --resume) skips the work that was already completed.
+"""
+import json
+from pathlib import Path
+from typing import Dict, Union
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+PAGE_FETCHED = 'page_fetched'
+IMAGE_URI_RESOLVED = 'image_uri_resolved'
+IMAGE_SAVED = 'image_saved'
+
+
+class CheckpointJournal:
+    def __init__(self, path: Path = settings.CHECKPOINT_JOURNAL_PATH, resume: bool = False):
+        self.path = Path(path)
+        self.animals: Dict[str, dict] = dict()  # animal -> its latest known state (the journal records merged)
+        self.resumed = 0
+        if resume:
+            self._load()
+        # A new scrape starts a new journal, a resumed one keeps appending to it
+        self._file = open(self.path, 'a' if resume else 'w', buffering=1)  # line buffered, a record per line
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a record torn by the crash
+                    self.animals.setdefault(record.pop('animal'), dict()).update(record)
+        except FileNotFoundError:
+            MODULE_LOGGER.warning(f'No checkpoint journal to resume from ({self.path})')
+            return
+        self.resumed = sum(1 for animal in self.animals if self.saved_image(animal))
+        MODULE_LOGGER.info(f'Resuming: {self.resumed}/{len(self.animals)} animals were completed')
+
+    def record(self, animal: str, state: str, **fields) -> None:
+        self.animals.setdefault(animal, dict()).update(state=state, **fields)
+        try:
+            self._file.write(json.dumps({'animal': animal, 'state': state, **fields}) + '\n')
+        except (OSError, ValueError) as e:
+            MODULE_LOGGER.exception(f'Failed to write a checkpoint of {animal}: {e}')
+
+    def saved_image(self, animal: str) -> Union[None, Path]:
+        """The image saved by a previous (interrupted) run, if it is still there"""
+        state = self.animals.get(animal)
+        if state and state.get('state') == IMAGE_SAVED and Path(state['image_path']).is_file():
+            return Path(state['image_path'])
+        return None
+
+    def resolved_image_uri(self, animal: str) -> Union[None, str]:
+        state = self.animals.get(animal)
+        return state.get('image_uri') if state else None
+
+    def close(self) -> None:
+        self._file.close()
+
+    def stats(self) -> dict:
+        states = [state.get('state') for state in self.animals.values()]
+        return {'resumed_completed': self.resumed,
+                **{state: states.count(state) for state in (PAGE_FETCHED, IMAGE_URI_RESOLVED, IMAGE_SAVED)}}
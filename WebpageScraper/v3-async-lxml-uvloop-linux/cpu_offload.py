@@ -0,0 +1,63 @@
+"""
+CPU-bound work offloading (e.g. parsing the animal pages, validating the images).
+The calls run in a thread or a process pool (settings.CPU_OFFLOAD_MODE) instead of on the event loop,
+and at most CPU_OFFLOAD_MAX_IN_FLIGHT jobs are submitted at once, so the downloads in flight keep progressing
+while the CPU work piles up. The process pool requires picklable (module level) functions, arguments and results.
+"""
+import asyncio
+import concurrent.futures
+from typing import Any, Callable
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+THREAD_POOL = 'thread'
+PROCESS_POOL = 'process'
+INLINE = 'inline'  # on the event loop (blocking), as if there was no offloading
+
+
+class CpuOffload:
+    def __init__(self, mode: str = settings.CPU_OFFLOAD_MODE, workers: int = settings.CPU_OFFLOAD_WORKERS,
+                 max_in_flight: int = settings.CPU_OFFLOAD_MAX_IN_FLIGHT):
+        self.mode = mode
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._in_flight = None
+        self._submitted = set()  # the executor's futures not done yet (at most max_in_flight)
+
+    @property
+    def executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.mode == PROCESS_POOL:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                       thread_name_prefix='cpu_offload')
+        return self._executor
+
+    async def run(self, function: Callable, *args, **kwargs) -> Any:
+        """Run function(*args, **kwargs) in the executor, waiting (without blocking) for a free slot first"""
+        if self.mode == INLINE:
+            return function(*args, **kwargs)
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        async with self._in_flight:
+            future = self.executor.submit(function, *args, **kwargs)
+            self._submitted.add(future)
+            future.add_done_callback(self._submitted.discard)
+            return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            # The jobs not started yet are dropped (Executor.shutdown(cancel_futures=True) requires python 3.9)
+            for future in list(self._submitted):
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._in_flight = None
+
+
+CPU_OFFLOAD = CpuOffload()
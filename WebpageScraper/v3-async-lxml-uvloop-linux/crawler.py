@@ -0,0 +1,306 @@
+"""
+Crawl mode (main.py --crawl): harvest the pages linked from the animals list (taxon pages, "see also" lists, ...)
+and the pages they link to, up to CRAWL_MAX_DEPTH links away from the seeds.
+The frontier is a SQLite database: the URLs to visit (by priority) and the visited ones. Its transactions run
+in a dedicated thread, off the event loop. Only the pages in flight are held in memory, so a crawl of tens of
+thousands of pages runs in bounded memory, and it can be paused (interrupted) and resumed (main.py --crawl --resume)
+without revisiting the visited pages.
+The discovered URLs are normalized, then deduplicated by a Bloom filter in front of the database.
+Politeness: the requests go through a DownloadScheduler with the CRAWL_*_PER_HOST limits.
+"""
+import re
+import string
+import hashlib
+import asyncio
+import sqlite3
+import functools
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, Iterable, List, Sequence, Tuple, Union
+from urllib.parse import quote, urljoin, urlsplit, urlunsplit
+
+import settings
+import logger
+import utilties
+import cpu_offload
+import session_factory
+import download_scheduler
+
+import aiofile
+import lxml.html
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+QUEUED, IN_FLIGHT, VISITED, FAILED = 'queued', 'in_flight', 'visited', 'failed'
+
+FRONTIER_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    depth INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT '{QUEUED}',
+    referrer TEXT,
+    bytes INTEGER,
+    links INTEGER
+);
+CREATE INDEX IF NOT EXISTS queued_pages ON pages (priority) WHERE state = '{QUEUED}';
+'''
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# RFC 3986 reserved characters kept as is in a path, the rest is percent-encoded (once)
+PATH_SAFE_CHARS = "/:@!$&'()*+,;=~"
+# The only percent-escapes that are decoded: an escaped reserved character (%2F...) isn't the character itself
+UNRESERVED_CHARS = frozenset(string.ascii_letters + string.digits + '-._~')
+PERCENT_ESCAPE = re.compile(r'(%[0-9A-Fa-f]{2})')
+
+
+def normalize_path(path: str) -> str:
+    """
+    The path percent-encoded the same way whatever the link's encoding: the escaped unreserved characters decoded,
+    the other escapes upper cased (but kept), the non-ASCII and unsafe characters encoded
+    """
+    parts = PERCENT_ESCAPE.split(path)  # the escapes are at the odd indexes
+    for index in range(1, len(parts), 2):
+        character = chr(int(parts[index][1:], 16))
+        parts[index] = character if character in UNRESERVED_CHARS else parts[index].upper()
+    for index in range(0, len(parts), 2):
+        parts[index] = quote(parts[index], safe=PATH_SAFE_CHARS)
+    return ''.join(parts)
+
+
+def normalize_url(href: str, base_url: str) -> Union[None, str]:
+    """
+    The absolute URL of a link: lower case scheme and host, without the default port and the fragment,
+    and the path percent-encoded the same way whatever the link's encoding. None for the non http(s) links
+    """
+    try:
+        parts = urlsplit(urljoin(base_url, href.strip()))
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+    netloc = parts.hostname if port in (None, DEFAULT_PORTS[scheme]) else f'{parts.hostname}:{port}'
+    return urlunsplit((scheme, netloc, normalize_path(parts.path) or '/', parts.query, ''))
+
+
+def extract_links(page_content: bytes, page_url: str, links_xpath: str, url_pattern: str,
+                  allowed_hosts: Sequence[str]) -> List[str]:
+    """
+    The distinct followed links of a page, normalized, in the page order (CPU-bound, runs in the CPU offload pool).
+    The settings are passed as arguments, the pool's worker processes don't see the overridden settings
+    """
+    try:
+        tree = lxml.html.fromstring(page_content, parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except (lxml.etree.ParserError, ValueError):
+        return []
+    pattern = re.compile(url_pattern)
+    links, seen = [], set()
+    for href in tree.xpath(links_xpath):
+        url = normalize_url(href, page_url)
+        if url is None or url in seen:
+            continue
+        seen.add(url)
+        parts = urlsplit(url)
+        path = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        if parts.hostname in allowed_hosts and pattern.search(path):
+            links.append(url)
+    return links
+
+
+class BloomFilter:
+    """A fixed size set of strings: no false negatives, few false positives (see CRAWL_BLOOM_FILTER_BITS)"""
+
+    def __init__(self, bits: int = settings.CRAWL_BLOOM_FILTER_BITS, hashes: int = settings.CRAWL_BLOOM_FILTER_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(-(-bits // 8))
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Double hashing: the k positions are derived from the two halves of a single digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str) -> bool:
+        """Add the item, returns whether it was (probably) there already"""
+        present = True
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self._array[byte] & mask:
+                present = False
+                self._array[byte] |= mask
+        return present
+
+
+class Frontier:
+    """
+    The persistent crawl frontier: the URLs seen so far, their depth, priority and state.
+    The crawler calls its methods through `call`, in the frontier's own thread (the connection and the Bloom filter
+    are only ever used by one thread at a time)
+    """
+
+    def __init__(self, path: Path = settings.CRAWL_FRONTIER_PATH, resume: bool = False):
+        self.path = Path(path)
+        if not resume:  # a new crawl starts a new frontier
+            for suffix in ('', '-wal', '-shm'):
+                Path(f'{self.path}{suffix}').unlink(missing_ok=True)
+        # Created by the caller's thread, then used by the frontier's thread only
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='frontier')
+        # WAL: the visited pages are committed one by one, without a full fsync each time
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(FRONTIER_SCHEMA)
+        self.priority_pattern = re.compile(settings.CRAWL_PRIORITY_PATTERN) if settings.CRAWL_PRIORITY_PATTERN else None
+        self.seen = BloomFilter()
+        self.confirmed_lookups = self.false_positives = 0
+        if resume:
+            with self.connection:
+                # The pages in flight when the crawl was paused are visited again
+                resumed = self.connection.execute(f"UPDATE pages SET state = '{QUEUED}' WHERE state = '{IN_FLIGHT}'")
+            for url, in self.connection.execute('SELECT url FROM pages'):
+                self.seen.add(url)
+            MODULE_LOGGER.info(f'Resuming the crawl: {self.stats()} ({resumed.rowcount} pages were in flight)')
+
+    async def call(self, method: Callable, *args):
+        """Run a frontier method in the frontier's thread: the SQLite commits don't block the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args))
+
+    def priority(self, url: str, depth: int) -> int:
+        """The lower the sooner: by depth, the pages matching CRAWL_PRIORITY_PATTERN first within a depth"""
+        boost = 1 if self.priority_pattern and self.priority_pattern.search(urlsplit(url).path) else 0
+        return 2 * depth - boost
+
+    def is_new(self, url: str) -> bool:
+        if not self.seen.add(url):
+            return True
+        # Probably seen, the database has the final word
+        self.confirmed_lookups += 1
+        if self.connection.execute('SELECT 1 FROM pages WHERE url = ?', (url,)).fetchone() is None:
+            self.false_positives += 1
+            return True
+        return False
+
+    def _insert(self, urls: Iterable[str], depth: int, referrer: str = None) -> None:
+        pages = [(url, depth, self.priority(url, depth), referrer) for url in urls if self.is_new(url)]
+        self.connection.executemany('INSERT OR IGNORE INTO pages (url, depth, priority, referrer) VALUES (?, ?, ?, ?)',
+                                    pages)
+
+    def add(self, urls: Iterable[str], depth: int = 0) -> None:
+        with self.connection:
+            self._insert(urls, depth)
+
+    def claim(self, count: int) -> List[Tuple[str, int]]:
+        """The next (url, depth) to visit, by priority (then by discovery order)"""
+        # The state is a literal (not a parameter) so the partial index is used
+        pages = self.connection.execute(
+            f"SELECT url, depth FROM pages WHERE state = '{QUEUED}' ORDER BY priority, rowid LIMIT ?",
+            (count,)).fetchall()
+        with self.connection:
+            self.connection.executemany('UPDATE pages SET state = ? WHERE url = ?',
+                                        ((IN_FLIGHT, url) for url, _ in pages))
+        return pages
+
+    def visited(self, url: str, depth: int, content_size: int, links: List[str]) -> None:
+        """Record the visited page and queue its links, in a single transaction"""
+        with self.connection:
+            self._insert(links, depth + 1, referrer=url)
+            self.connection.execute('UPDATE pages SET state = ?, bytes = ?, links = ? WHERE url = ?',
+                                    (VISITED, content_size, len(links), url))
+
+    def failed(self, url: str) -> None:
+        with self.connection:
+            self.connection.execute('UPDATE pages SET state = ? WHERE url = ?', (FAILED, url))
+
+    def done_count(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM pages WHERE state IN (?, ?)',
+                                       (VISITED, FAILED)).fetchone()[0]
+
+    def stats(self) -> dict:
+        stats = dict(self.connection.execute('SELECT state, COUNT(*) FROM pages GROUP BY state').fetchall())
+        stats.update(bloom_confirmed_lookups=self.confirmed_lookups, bloom_false_positives=self.false_positives)
+        return stats
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)  # the cancelled visits' last transactions
+        self.connection.close()
+
+
+class Crawler:
+    def __init__(self, session, frontier: Frontier, scheduler: download_scheduler.DownloadScheduler = None,
+                 max_depth: int = settings.CRAWL_MAX_DEPTH, max_pages: int = settings.CRAWL_MAX_PAGES,
+                 workers: int = settings.CRAWL_WORKERS, pages_dir: Union[None, Path] = settings.CRAWL_PAGES_DIR):
+        self.session = session
+        self.frontier = frontier
+        self.scheduler = scheduler or download_scheduler.DownloadScheduler(
+            rate_per_host=settings.CRAWL_RATE_PER_HOST,
+            max_concurrency_per_host=settings.CRAWL_MAX_CONCURRENCY_PER_HOST)
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.workers = workers
+        self.pages_dir = Path(pages_dir) if pages_dir else None
+
+    def page_path(self, url: str) -> Path:
+        return Path(self.pages_dir, f'{hashlib.sha256(url.encode("utf-8")).hexdigest()}.html')
+
+    async def visit(self, url: str, depth: int) -> None:
+        """Fetch the page, save it, and queue its links (unless it is at the maximal depth)"""
+        try:
+            # The pages are saved by the crawler itself, the HTTP cache would only double the disk usage
+            content = await utilties.retrieve_content(url, self.session, use_cache=False, scheduler=self.scheduler)
+            if not content:
+                await self.frontier.call(self.frontier.failed, url)
+                return
+            links = []
+            if depth < self.max_depth:
+                links = await cpu_offload.CPU_OFFLOAD.run(
+                    extract_links, content, url, settings.CRAWL_LINKS_XPATH, settings.CRAWL_URL_PATTERN,
+                    settings.CRAWL_ALLOWED_HOSTS)
+            if self.pages_dir:
+                async with aiofile.async_open(self.page_path(url), 'wb') as page_file:
+                    await page_file.write(content)
+            await self.frontier.call(self.frontier.visited, url, depth, len(content), links)
+            MODULE_LOGGER.debug('Visited %s (depth %d, %d links)', url, depth, len(links),
+                                sample_every=settings.LOG_SAMPLE_EVERY)
+        except Exception as e:
+            MODULE_LOGGER.exception(f'Failed to crawl {url}: {e}')
+            await self.frontier.call(self.frontier.failed, url)
+
+    async def run(self, seeds: Iterable[str] = settings.CRAWL_SEEDS) -> None:
+        """Visit the frontier's pages (CRAWL_WORKERS at a time) until it is exhausted or max_pages were visited"""
+        if self.pages_dir:
+            self.pages_dir.mkdir(parents=True, exist_ok=True)
+        # The seeds are already seen when resumed
+        await self.frontier.call(self.frontier.add, [url for url in map(normalize_url, seeds, seeds) if url])
+        budget = self.max_pages - await self.frontier.call(self.frontier.done_count)
+        pending = set()
+        try:
+            while True:
+                if len(pending) < self.workers and budget > 0:
+                    for url, depth in await self.frontier.call(self.frontier.claim,
+                                                               min(self.workers - len(pending), budget)):
+                        pending.add(asyncio.create_task(self.visit(url, depth)))
+                        budget -= 1
+                if not pending:
+                    break
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Paused: the pages in flight stay claimed in the frontier, a resumed crawl visits them again
+            for task in pending:
+                task.cancel()
+            MODULE_LOGGER.info(f'Crawl download scheduler stats: {self.scheduler.stats()}')
+
+
+async def crawl(resume: bool = False, seeds: Iterable[str] = settings.CRAWL_SEEDS) -> None:
+    """resume: continue a paused crawl from its frontier"""
+    # Opened off the event loop, a resumed frontier is read back in full
+    frontier = await asyncio.get_running_loop().run_in_executor(None, functools.partial(Frontier, resume=resume))
+    try:
+        async with session_factory.create_session() as session:
+            session.headers.update({'User-agent': settings.USER_AGENT})
+            await Crawler(session, frontier).run(seeds)
+    finally:
+        MODULE_LOGGER.info(f'Crawl frontier stats: {await frontier.call(frontier.stats)}')
+        frontier.close()
@@ -0,0 +1,158 @@
+"""
+Bounded-concurrency scheduling of the web requests.
+A global limit on the in-flight requests, a per-host concurrency window and a per-host token bucket (rate limit).
+The per-host window is adjusted with AIMD (additive increase, multiplicative decrease)
+according to the responses status codes and latencies, so we stay around the server's limit
+instead of flooding it and collapsing into 429/403 errors.
+"""
+import time
+import asyncio
+import contextlib
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `capacity` tokens may be spent at once (burst)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self) -> None:
+        # The lock keeps the waiters in FIFO order
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class HostLimiter:
+    """AIMD controlled concurrency window (and rate limit) of a single host"""
+
+    def __init__(self, host: str, rate: float = settings.SCHEDULER_RATE_PER_HOST,
+                 max_concurrency: int = settings.SCHEDULER_MAX_CONCURRENCY_PER_HOST):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(settings.SCHEDULER_INITIAL_CONCURRENCY_PER_HOST, max_concurrency))
+        self.in_flight = 0
+        self.bucket = TokenBucket(rate, settings.SCHEDULER_BURST_PER_HOST)
+        self._condition = asyncio.Condition()
+        self._last_decrease = 0.0
+
+        # Counters
+        self.requests = 0
+        self.congestion_signals = 0
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.requests += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        # Additive increase: about +SCHEDULER_ADDITIVE_INCREASE per a full window of successful responses
+        self.limit = min(self.max_concurrency, self.limit + settings.SCHEDULER_ADDITIVE_INCREASE / self.limit)
+
+    def on_congestion(self, latency: float) -> None:
+        self.congestion_signals += 1
+        # Multiplicative decrease, at most once per "round trip"
+        # (all the responses of the requests that were already in flight carry the same signal)
+        now = time.monotonic()
+        if now - self._last_decrease < latency:
+            return
+        self._last_decrease = now
+        self.limit = max(settings.SCHEDULER_MIN_CONCURRENCY_PER_HOST,
+                         self.limit * settings.SCHEDULER_MULTIPLICATIVE_DECREASE)
+        MODULE_LOGGER.warning(f'Congestion on {self.host}, concurrency window decreased to {int(self.limit)}')
+
+
+class RequestTicket:
+    """Handed to the requester while it holds a slot, the response status is reported through it"""
+    __slots__ = ('status',)
+
+    def __init__(self):
+        self.status = None
+
+    def report(self, status: int) -> None:
+        self.status = status
+
+
+class DownloadScheduler:
+    def __init__(self, max_concurrency: int = settings.SCHEDULER_MAX_CONCURRENCY,
+                 rate_per_host: float = settings.SCHEDULER_RATE_PER_HOST,
+                 max_concurrency_per_host: int = settings.SCHEDULER_MAX_CONCURRENCY_PER_HOST):
+        self._global_semaphore = asyncio.Semaphore(max_concurrency)
+        self._rate_per_host = rate_per_host
+        self._max_concurrency_per_host = max_concurrency_per_host
+        self._hosts = dict()
+
+    def _host_limiter(self, uri: str) -> HostLimiter:
+        host = urlsplit(uri).hostname
+        if host not in self._hosts:
+            self._hosts[host] = HostLimiter(host, self._rate_per_host, self._max_concurrency_per_host)
+        return self._hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, uri: str):
+        """Wait for a free slot (host window -> host rate limit -> global limit) and hold it during the request"""
+        limiter = self._host_limiter(uri)
+        await limiter.acquire()
+        try:
+            await limiter.bucket.acquire()
+            async with self._global_semaphore:
+                ticket = RequestTicket()
+                start = time.monotonic()
+                try:
+                    yield ticket
+                except Exception:
+                    limiter.on_congestion(time.monotonic() - start)
+                    raise
+                latency = time.monotonic() - start
+                if ticket.status in settings.SCHEDULER_CONGESTION_STATUSES \
+                        or latency > settings.SCHEDULER_LATENCY_THRESHOLD:
+                    limiter.on_congestion(latency)
+                elif ticket.status is not None and ticket.status < HTTPStatus.BAD_REQUEST:
+                    limiter.on_success()
+        finally:
+            await limiter.release()
+
+    def stats(self) -> dict:
+        return {host: {'requests': limiter.requests,
+                       'congestion_signals': limiter.congestion_signals,
+                       'concurrency_window': int(limiter.limit)}
+                for host, limiter in self._hosts.items()}
+
+
+class NullScheduler:
+    """No limits at all (the default of the callers that weren't given a scheduler)"""
+
+    @contextlib.asynccontextmanager
+    async def slot(self, uri: str):
+        yield RequestTicket()
+
+    def stats(self) -> dict:
+        return {}
+
+
+UNSCHEDULED = NullScheduler()
@@ -0,0 +1,232 @@
+"""
+Exporters of the grouped results (collateral adjective -> animals and their images) for the downstream jobs.
+Every sink gets the records in batches of EXPORT_BATCH_SIZE, writes them to a temporary file,
+and replaces the previous export only once it is complete (the consumers never read a half written export).
+"""
+import os
+import re
+import csv
+import json
+import sqlite3
+import contextlib
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Type
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+FIELDS = ('collateral_adjective', 'animal', 'image_path')
+Record = Tuple[str, ...]  # the FIELDS values, image_path is None when the animal has no image
+
+
+def field_name(column: str) -> str:
+    """A table column header as an export field name, e.g. 'Collateral adjective' -> 'collateral_adjective'"""
+    return re.sub(r'\W+', '_', column.strip().lower()).strip('_')
+
+
+def iter_records(grouping: Dict[str, List], fields: Tuple[str, ...] = FIELDS) -> Iterator[Record]:
+    """
+    (group, name, value) records, cut to the fields count (e.g. the tables without images have 2 fields).
+    The groups of several columns (tuples) are spread over their fields
+    """
+    for group, members in grouping.items():
+        group = group if isinstance(group, tuple) else (group,)
+        for name, value in members:
+            yield (*group, name, str(value) if value else None)[:len(fields)]
+
+
+def batched(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
+
+
+class Exporter:
+    """A sink: open() -> write_batch() per batch -> close(). Subclasses write to self.partial_path"""
+    extension = None
+
+    def __init__(self, export_dir: Path = settings.EXPORT_DIR, name: str = settings.EXPORT_FILE_NAME,
+                 fields: Tuple[str, ...] = FIELDS, table: str = 'animals'):
+        self.fields = fields
+        self.table = table  # for the sinks with named tables (SQLite)
+        self.path = Path(export_dir, f'{name}.{self.extension}')
+        self.partial_path = self.path.with_name(self.path.name + settings.PARTIAL_DOWNLOAD_SUFFIX)
+        self.records = 0
+
+    def open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.partial_path.unlink(missing_ok=True)
+
+    def write_batch(self, batch: List[Record]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        os.replace(self.partial_path, self.path)
+
+    def abort(self) -> None:
+        self.partial_path.unlink(missing_ok=True)
+
+
+class JsonLinesExporter(Exporter):
+    extension = 'jsonl'
+
+    def open(self) -> None:
+        super().open()
+        self._file = open(self.partial_path, 'w', encoding='utf-8')
+
+    def write_batch(self, batch: List[Record]) -> None:
+        self._file.write(''.join(json.dumps(dict(zip(self.fields, record))) + '\n' for record in batch))
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+    def abort(self) -> None:
+        self._file.close()
+        super().abort()
+
+
+class CsvExporter(JsonLinesExporter):
+    extension = 'csv'
+
+    def open(self) -> None:
+        super().open()
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.fields)
+
+    def write_batch(self, batch: List[Record]) -> None:
+        self._writer.writerows(batch)
+
+
+class SqliteExporter(Exporter):
+    """
+    A table of the fields, indexed on the group (e.g. the collateral adjective) and on the name (e.g. the animal),
+    see animals_for_adjective()
+    """
+    extension = 'sqlite3'
+
+    def open(self) -> None:
+        super().open()
+        self._connection = sqlite3.connect(self.partial_path)
+        self._connection.execute('PRAGMA journal_mode = OFF')  # a temporary file, replaced only when complete
+        self._connection.execute('PRAGMA synchronous = OFF')
+        group, name, *values = self.fields
+        self._connection.execute(f'CREATE TABLE {self.table} ({group} TEXT NOT NULL, {name} TEXT NOT NULL'
+                                 f'{"".join(f", {value} TEXT" for value in values)})')
+        self._insert = f'INSERT INTO {self.table} VALUES ({", ".join("?" * len(self.fields))})'
+
+    def write_batch(self, batch: List[Record]) -> None:
+        with self._connection:  # a transaction per batch
+            self._connection.executemany(self._insert, batch)
+
+    def close(self) -> None:
+        # Created after the bulk insert (cheaper than updating them row by row)
+        for field in self.fields[:2]:
+            self._connection.execute(f'CREATE INDEX {self.table}_by_{field} ON {self.table} ({field})')
+        self._connection.close()
+        super().close()
+
+    def abort(self) -> None:
+        self._connection.close()
+        super().abort()
+
+
+class ParquetExporter(Exporter):
+    """A row group per batch. Requires pyarrow (optional dependency: pip install pyarrow)"""
+    extension = 'parquet'
+
+    def __init__(self, *args, **kwargs):
+        import pyarrow
+        import pyarrow.parquet
+
+        super().__init__(*args, **kwargs)
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([(field, pyarrow.string()) for field in self.fields])
+
+    def open(self) -> None:
+        super().open()
+        self._writer = self._pyarrow.parquet.ParquetWriter(self.partial_path, self._schema)
+
+    def write_batch(self, batch: List[Record]) -> None:
+        columns = [list(column) for column in zip(*batch)]
+        self._writer.write_table(self._pyarrow.Table.from_arrays(columns, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+        super().close()
+
+    def abort(self) -> None:
+        self._writer.close()
+        super().abort()
+
+
+EXPORTERS: Dict[str, Type[Exporter]] = {
+    'jsonl': JsonLinesExporter,
+    'csv': CsvExporter,
+    'sqlite': SqliteExporter,
+    'parquet': ParquetExporter,
+}
+
+
+def create_exporters(formats: Iterable[str] = settings.EXPORT_FORMATS, name: str = settings.EXPORT_FILE_NAME,
+                     fields: Tuple[str, ...] = FIELDS, table: str = 'animals') -> List[Exporter]:
+    exporters = list()
+    for export_format in formats:
+        try:
+            exporters.append(EXPORTERS[export_format](name=name, fields=fields, table=table))
+        except KeyError:
+            MODULE_LOGGER.critical(f'Unknown export format: {export_format} (known: {", ".join(EXPORTERS)})')
+        except ImportError as e:
+            MODULE_LOGGER.warning(f'The {export_format} exporter is unavailable (missing dependency: {e.name})')
+    return exporters
+
+
+def export_results(grouping: Dict[str, List], exporters: List[Exporter] = None,
+                   batch_size: int = settings.EXPORT_BATCH_SIZE) -> List[Path]:
+    """
+    Feed the grouping to every exporter, a batch at a time (blocking file IO, run it in a thread).
+    Returns the paths of the completed exports, a failed sink doesn't affect the others
+    """
+    exporters = create_exporters() if exporters is None else exporters
+    opened = list()
+    for exporter in exporters:
+        try:
+            exporter.open()
+            opened.append(exporter)
+        except Exception as e:
+            MODULE_LOGGER.exception(f'Failed to open the {exporter.path} export: {e}')
+
+    fields = exporters[0].fields if exporters else FIELDS
+    for batch in batched(iter_records(grouping, fields), batch_size):
+        for exporter in list(opened):
+            try:
+                exporter.write_batch(batch)
+                exporter.records += len(batch)
+            except Exception as e:
+                MODULE_LOGGER.exception(f'Failed to write to the {exporter.path} export: {e}')
+                opened.remove(exporter)
+                exporter.abort()
+
+    exported = list()
+    for exporter in opened:
+        try:
+            exporter.close()
+            exported.append(exporter.path)
+            MODULE_LOGGER.info(f'Exported {exporter.records} records to {exporter.path}')
+        except Exception as e:
+            MODULE_LOGGER.exception(f'Failed to complete the {exporter.path} export: {e}')
+    return exported
+
+
+def animals_for_adjective(collateral_adjective: str,
+                          database_path: Path = Path(settings.EXPORT_DIR,
+                                                     f'{settings.EXPORT_FILE_NAME}.{SqliteExporter.extension}')
+                          ) -> List[Tuple[str, str]]:
+    """The (animal, image path) of a collateral adjective, from the SQLite export (an index lookup)"""
+    with contextlib.closing(sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)) as connection:
+        return connection.execute(
+            'SELECT animal, image_path FROM animals WHERE collateral_adjective = ? ORDER BY rowid',
+            (collateral_adjective,)).fetchall()
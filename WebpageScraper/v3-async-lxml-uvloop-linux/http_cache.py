@@ -0,0 +1,184 @@
+"""Persistent (on-disk) cache for the web pages GET requests results"""
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from collections import OrderedDict
+from typing import Union
+
+import settings
+import logger
+
+import aiofile
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+BODY_SUFFIX = '.body'
+META_SUFFIX = '.json'
+
+
+class ResponseCache:
+    """
+    Stores response bodies on disk together with their validators (ETag / Last-Modified).
+    A fresh entry (younger than ttl) is served without touching the network,
+    a stale entry is revalidated with a conditional GET (If-None-Match / If-Modified-Since).
+    When the total size exceeds max_size the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: Path = settings.HTTP_CACHE_DIR, ttl: float = settings.HTTP_CACHE_TTL,
+                 max_size: int = settings.HTTP_CACHE_MAX_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # key -> metadata dict, ordered from the least recently used to the most recently used entry
+        self._index = None
+        self._total_size = 0
+
+        # Counters
+        self.hits = 0  # served from disk without any network traffic
+        self.revalidations = 0  # the server answered "304 Not Modified"
+        self.misses = 0  # full download
+        self.evictions = 0  # entries dropped to fit max_size
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(uri: str) -> str:
+        return hashlib.sha256(uri.encode()).hexdigest()
+
+    def _body_path(self, key: str) -> Path:
+        return Path(self.cache_dir, f'{key}{BODY_SUFFIX}')
+
+    def _meta_path(self, key: str) -> Path:
+        return Path(self.cache_dir, f'{key}{META_SUFFIX}')
+
+    def _load_index(self) -> None:
+        """Scan the cache folder once, the body file mtime is used as the "last access" time (LRU order)"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for meta_path in self.cache_dir.glob(f'*{META_SUFFIX}'):
+            key = meta_path.stem
+            try:
+                with open(meta_path, 'r') as meta_file:
+                    meta = json.load(meta_file)
+                last_access = self._body_path(key).stat().st_mtime
+            except (OSError, ValueError):
+                MODULE_LOGGER.warning(f'Dropping corrupted cache entry {key}')
+                self._remove_files(key)
+                continue
+            entries.append((last_access, key, meta))
+
+        self._index = OrderedDict((key, meta) for _, key, meta in sorted(entries, key=lambda entry: entry[0]))
+        self._total_size = sum(meta['size'] for meta in self._index.values())
+        MODULE_LOGGER.debug('Loaded %d cache entries (%d bytes) from %s',
+                            len(self._index), self._total_size, self.cache_dir)
+
+    @property
+    def index(self) -> OrderedDict:
+        if self._index is None:
+            self._load_index()
+        return self._index
+
+    def lookup(self, uri: str) -> Union[None, dict]:
+        """Return the metadata of a cached uri (or None)"""
+        return self.index.get(self.key(uri))
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time.time() - meta['stored_at'] < self.ttl
+
+    @staticmethod
+    def conditional_headers(meta: dict) -> dict:
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    async def read(self, uri: str) -> bytes:
+        """Read a cached body and mark it as the most recently used entry"""
+        key = self.key(uri)
+        async with aiofile.async_open(self._body_path(key), 'rb') as body_file:
+            body = await body_file.read()
+        self._touch(key)
+        self.bytes_saved += len(body)
+        return body
+
+    async def serve_fresh(self, uri: str) -> bytes:
+        self.hits += 1
+        return await self.read(uri)
+
+    async def serve_revalidated(self, uri: str, headers) -> bytes:
+        """The server approved our copy (304), refresh its validators and age"""
+        self.revalidations += 1
+        meta = self.lookup(uri)
+        meta['stored_at'] = time.time()
+        meta['etag'] = headers.get('ETag', meta.get('etag'))
+        meta['last_modified'] = headers.get('Last-Modified', meta.get('last_modified'))
+        await self._write_meta(self.key(uri), meta)
+        return await self.read(uri)
+
+    async def store(self, uri: str, body: bytes, headers) -> None:
+        self.misses += 1
+        if len(body) > self.max_size:
+            return
+        key = self.key(uri)
+        meta = {
+            'uri': uri,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored_at': time.time(),
+            'size': len(body),
+        }
+        try:
+            async with aiofile.async_open(self._body_path(key), 'wb') as body_file:
+                await body_file.write(body)
+            await self._write_meta(key, meta)
+        except OSError as e:
+            MODULE_LOGGER.exception(f'Failed to store {uri} in the cache: {e}')
+            self._remove_files(key)
+            return
+
+        previous = self.index.pop(key, None)
+        self._total_size += meta['size'] - (previous['size'] if previous else 0)
+        self.index[key] = meta
+        self._evict()
+
+    async def _write_meta(self, key: str, meta: dict) -> None:
+        async with aiofile.async_open(self._meta_path(key), 'w') as meta_file:
+            await meta_file.write(json.dumps(meta))
+
+    def _touch(self, key: str) -> None:
+        self.index.move_to_end(key)
+        try:
+            os.utime(self._body_path(key))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """Drop the least recently used entries until the cache fits its size limit"""
+        while self._total_size > self.max_size and self.index:
+            key, meta = self.index.popitem(last=False)
+            self._total_size -= meta['size']
+            self._remove_files(key)
+            self.evictions += 1
+            MODULE_LOGGER.debug('Evicted %s from the cache', meta['uri'])
+
+    def _remove_files(self, key: str) -> None:
+        for path in (self._body_path(key), self._meta_path(key)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes_saved': self.bytes_saved,
+            'entries': len(self.index),
+            'size': self._total_size,
+        }
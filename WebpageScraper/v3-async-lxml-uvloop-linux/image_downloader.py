@@ -1,123 +1,361 @@
 """Image download utils"""
-import io
 import os
+import asyncio
 import json
+import hashlib
+from http import HTTPStatus
 from pathlib import Path
+from collections import Counter, namedtuple
 from typing import Union
 
 import settings
 import logger
 import utilties
+import http_cache
+import image_store
+import checkpoint
+import instrumentation
+import cpu_offload
 
 import bs4
 import aiofile
+import aiohttp
 from PIL import Image, UnidentifiedImageError  # for verification of downloaded images
 
 MODULE_LOGGER = logger.Logger(__name__)
+IMAGE_STORE = image_store.ImageStore()
+THUMBNAILS_IN_FLIGHT = dict()  # thumbnail path -> the future making it (images are shared by several animals)
+THUMBNAILS_STATS = Counter()
+THUMBNAILS = dict()  # image path -> its (up to date) thumbnail path, for the HTML page
+IMAGELESS_PAGES = set()  # the animal pages without an image (a video, no lead image), unlike the failed downloads
 
 
-async def save_image_to_file(content: bytes, file_name: str) -> None:
-    ''' Save the content in a file '''
+# Magic numbers of the image formats we accept (the header of the file)
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+IMAGE_HEADER_SIZE = 16  # enough bytes for any of the signatures above (and the RIFF....WEBP one)
+
+# A downloaded image body, still in its temporary file
+StreamedImage = namedtuple('StreamedImage', ('temp_file_path', 'content_hash'))
+
+
+def validate_image_file(image_path: Path) -> bool:
+    """ Validate the saved file is a complete, valid image (runs in the CPU offload executor)"""
+    try:
+        with Image.open(image_path) as image:
+            image.verify()
+        return True
+    except (UnidentifiedImageError, OSError, SyntaxError):  # PIL raises SyntaxError on some broken files
+        return False
+
+
+def sniff_image_format(header: bytes) -> Union[None, str]:
+    """Identify the image format by the first bytes of its content (without decoding the image)"""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+async def stream_image_to_file(response, image_uri: str, store: image_store.ImageStore) -> Union[None, StreamedImage]:
+    """
+    Write the response body chunk by chunk to a temporary file (hashing it on the way),
+    and check the image header as soon as it arrives. Only the network work happens here:
+    the download slot is held meanwhile (see store_streamed_image for the rest).
+    Memory usage is bounded by IMAGE_DOWNLOAD_CHUNK_SIZE (per concurrent download).
+    """
+    temp_file_path = store.temp_path(hashlib.sha256(image_uri.encode()).hexdigest())
+    content_hash = hashlib.sha256()
+    header = bytes()
+    streamed = None
     try:
-        async with aiofile.async_open(file_name, 'wb') as image_file:
-            await image_file.write(content)
+        async with aiofile.async_open(temp_file_path, 'wb') as image_file:
+            async for chunk in response.content.iter_chunked(settings.IMAGE_DOWNLOAD_CHUNK_SIZE):
+                if len(header) < IMAGE_HEADER_SIZE:
+                    header += chunk[:IMAGE_HEADER_SIZE - len(header)]
+                    if len(header) == IMAGE_HEADER_SIZE and not sniff_image_format(header):
+                        MODULE_LOGGER.warning(f'Not an image content: {image_uri}')
+                        return None
+                content_hash.update(chunk)
+                await image_file.write(chunk)
+
+        if not sniff_image_format(header):  # an empty or a tiny body
+            MODULE_LOGGER.warning(f'Not an image content: {image_uri}')
+            return None
+        streamed = StreamedImage(temp_file_path, content_hash.hexdigest())
+        return streamed
 
     except PermissionError as e:
         MODULE_LOGGER.exception(f'Failed to save the image due to permissions error: {e}')
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        raise  # let the retry policy decide (a TimeoutError is an OSError as well)
     except OSError as e:
         MODULE_LOGGER.critical(f'Could not save the image (no space on disk? the disk is unavailable?): {e}')
-    except Exception as e:
-        MODULE_LOGGER.exception(f'Other kind of exception: {e}')
+    finally:
+        if streamed is None and temp_file_path.exists():
+            temp_file_path.unlink()
+    return None
 
 
-def validate_image(image_content: bytes) -> bool:
-    """ Validate the image content is a valid image format"""
+@instrumentation.timed('save_image')
+async def store_streamed_image(streamed: StreamedImage, image_uri: str, file_extension: str, response_headers,
+                               store: image_store.ImageStore) -> Union[None, Path]:
+    """
+    Validate the downloaded image and atomically rename it to its content address (<sha256>.<extension>).
+    Runs once the download slot is released: waiting for a CPU worker and the disk isn't request latency
+    """
     try:
-        Image.open(io.BytesIO(image_content))
-        return True
-    except UnidentifiedImageError:
+        if settings.VALIDATE_IMAGES_CONTENT:
+            async with instrumentation.timer('validate_image'):
+                if not await cpu_offload.CPU_OFFLOAD.run(validate_image_file, streamed.temp_file_path):
+                    MODULE_LOGGER.warning(f'Broken image content: {image_uri}')
+                    return None
+        absolute_image_path = store.add_image(image_uri, streamed.content_hash, file_extension,
+                                              image_store.upstream_validators(response_headers))
+        os.replace(streamed.temp_file_path, absolute_image_path)
+        return absolute_image_path
+
+    except PermissionError as e:
+        MODULE_LOGGER.exception(f'Failed to save the image due to permissions error: {e}')
+    except OSError as e:
+        MODULE_LOGGER.critical(f'Could not save the image (no space on disk? the disk is unavailable?): {e}')
+    finally:
+        if streamed.temp_file_path.exists():
+            streamed.temp_file_path.unlink()
+    return None
+
+
+async def probe_image(image_uri: str, validators: dict, session, scheduler=None) -> bool:
+    """HEAD request: whether the upstream image is still the stored one (any failure counts as changed)"""
+    try:
+        response = await utilties.send_request(image_uri, session, utilties.ignore_body, scheduler=scheduler,
+                                               method='HEAD')
+    except Exception as e:
+        MODULE_LOGGER.warning(f'Failed to probe image {image_uri}: {e}')
         return False
+    return response.status == HTTPStatus.OK and image_store.is_unchanged(validators, response.headers)
 
 
-async def download_image(image_uri: str = None, abs_file_path: str = None, session=None) -> bool:
+def keep_unchanged_image(store: image_store.ImageStore, image_path: Path) -> Union[None, Path]:
+    """The stored image is still the upstream one, None when its file is gone (it has to be downloaded again)"""
+    try:
+        size = image_path.stat().st_size
+    except FileNotFoundError:
+        store.revalidations['missing_files'] += 1
+        return None
+    store.revalidations['unchanged'] += 1
+    store.revalidations['bytes_not_downloaded'] += size
+    return image_path
+
+
+async def download_image(image_uri: str = None, file_extension: str = None, session=None, scheduler=None,
+                         store: image_store.ImageStore = None) -> Union[None, Path]:
     """
-    Download an image and verify it is a proper image content,
-    provided by its uri and save under provided file_name
+    Download an image (streamed to disk) and verify it is a proper image content,
+    provided by its uri and save it in the content-addressed store (returns its path)
+    An image already stored is revalidated first (see settings.IMAGE_REVALIDATION), its body is downloaded
+    only when it has changed upstream
     """
-    content = await utilties.retrieve_content(image_uri, session)
-    is_successful: bool = False
-    if not content:
-        MODULE_LOGGER.warning(f'Failed to retrieve image: {image_uri}')
+    async def read_body(response) -> Union[None, StreamedImage]:
+        return await stream_image_to_file(response, image_uri, store)
+
+    request_headers = {}
+    stored = store.lookup_validators(image_uri) if settings.IMAGE_REVALIDATION else None
+    if stored:
+        stored_image_path, validators = stored
+        if settings.IMAGE_REVALIDATION == 'head':
+            if await probe_image(image_uri, validators, session, scheduler):
+                if absolute_image_path := keep_unchanged_image(store, stored_image_path):
+                    return absolute_image_path
+                stored = None  # the file is gone: a full download (not a changed image)
+        else:
+            request_headers = http_cache.ResponseCache.conditional_headers(validators)
+
+    absolute_image_path = None
+    try:
+        response = await utilties.send_request(image_uri, session, read_body, request_headers, scheduler=scheduler)
+        if response.body:
+            absolute_image_path = await store_streamed_image(response.body, image_uri, file_extension,
+                                                             response.headers, store)
+    except Exception as e:
+        MODULE_LOGGER.exception(f'Failed to retrieve image {image_uri}: {e}')
     else:
-        MODULE_LOGGER.debug(f'Successfully retrieved image: {image_uri}, now validating the image {abs_file_path}')
-        if validate_image(content):
-            await save_image_to_file(content, abs_file_path)
-            MODULE_LOGGER.debug(f'Successfully saved image: {image_uri}')
-            is_successful = True
+        if absolute_image_path:
+            MODULE_LOGGER.debug('Successfully saved image: %s', image_uri, sample_every=settings.LOG_SAMPLE_EVERY)
+            if stored:
+                store.revalidations['changed'] += 1
+        elif response.status == HTTPStatus.NOT_MODIFIED and stored:
+            store.refresh_validators(image_uri, response.headers)
+            # The file deleted since the lookup: not in the store anymore, a full download this time
+            absolute_image_path = keep_unchanged_image(store, stored_image_path) \
+                or await download_image(image_uri, file_extension, session, scheduler, store)
+        elif response.status != HTTPStatus.OK:
+            MODULE_LOGGER.warning(f'Failed to retrieve image: {image_uri} Error code:{response.status}')
         else:
             MODULE_LOGGER.warning(f'Failed to validate image: {image_uri}')
-    return is_successful
-
+    return absolute_image_path
 
-# TODO: This can be "Optimized" caching wise
-#       We can first check by the animal name if there's already an image for it
-#       before downloading the page that has the link to the image
-#       (even though we don't know yet the image extension), so it's a little pain in the ass but possible...
-#       Maybe it's also possible to cache the web pages themselves etc.
 
+def parse_image_uri(page_content: bytes) -> Union[None, str]:
+    """Parse the animal page and return its image uri (runs in the CPU offload executor)"""
+    tree = bs4.BeautifulSoup(page_content, settings.BS4_TREE_BUILDER)  # parse the html
 
-async def image_already_exists(image_file_name):
-    image_extensions = ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'svg')
-    # Note: Use os.exists in case we want to save multiple images for each animal (creating folders)
-    for extension in image_extensions:
-        path = Path(settings.SAVED_IMAGES_DIR, f'{image_file_name}.{extension}')
-        if path.is_file():
-            return path
-    return None
-
-
-async def parse_image_uri(tree=None, file_name=None, page_uri=None):
     # get the image uri from the crawler friendly script tag (it is the only one)
     # "application/ld+json" which happens to also contain the highest quality image
     # It won't exist on pages with multiple images (4 animals).
     # The problematic cases: Dog, Squalidae, Goshawk, Black panther.
     # use a different technique to get the image uri for those cases
     # <script type="application/ld+json">{"@context":"https:\/\/schema.org", ...."image":"https:\/\/u...."}</script>
-    script_text = tree.select('script[type="application/ld+json"]')[0]  # Perform a CSS selection
-    json_data = json.loads(script_text.text)  # get the json data string and convert it to dict object
+    script_text = tree.select('script[type="application/ld+json"]')  # Perform a CSS selection
+    if not script_text:
+        return None
+    json_data = json.loads(script_text[0].text)  # get the json data string and convert it to dict object
+    return json_data.get('image')
+
 
-    if 'image' not in json_data:
-        MODULE_LOGGER.warning(f'Failed to parse link to animal image from {page_uri}')
-        return None, None, None
+def get_image_file_extension(image_uri: str) -> str:
+    """The extension of the image file is taken from the image uri"""
+    return utilties.get_proper_file_name_part(image_uri.split('/')[-1].split('.')[-1].lower())
 
-    image_uri = json_data['image']
-    file_extension = image_uri.split('/')[-1].split('.')[-1].lower()
-    absolute_image_path = Path(settings.SAVED_IMAGES_DIR,
-                               f'{file_name}.{utilties.get_proper_file_name_part(file_extension)}')
-    return image_uri, absolute_image_path, file_extension
 
+def make_thumbnail(image_path: Path, thumbnail_path: Path, width: int, image_format: str, quality: int) -> bool:
+    """
+    Save a thumbnail (at most width pixels wide) of the image. CPU-bound: runs in the offload (process) pool.
+    Written to a temporary file first, so a thumbnail is never seen half written
+    """
+    partial_path = thumbnail_path.with_name(thumbnail_path.name + settings.PARTIAL_DOWNLOAD_SUFFIX)
+    try:
+        with Image.open(image_path) as image:
+            # JPEG: decode straight at a reduced scale (much faster than decoding the full image, then resizing)
+            image.draft('RGB', (width, max(1, width * image.height // image.width)))
+            image.thumbnail((width, image.height), Image.LANCZOS)  # keeps the aspect ratio, never upscales
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha and image_format != 'jpeg' else 'RGB')
+            thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+            image.save(partial_path, format=image_format, quality=quality, method=settings.THUMBNAIL_WEBP_METHOD)
+        os.replace(partial_path, thumbnail_path)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        MODULE_LOGGER.warning(f'Failed to make the thumbnail of {image_path}: {e}')
+        partial_path.unlink(missing_ok=True)
+        return False
 
-async def download_animal_image(uri: str, animal_name: str, session) -> Union[None, Path]:
-    """ Retrieve an image from the provided uri and save it under provided animal_name """
-    file_name = utilties.get_proper_file_name_part(animal_name)  # The image file name will be the animal's name
 
-    # Check if the image already exists, if so, return the full path to it
-    absolute_image_path =  await image_already_exists(file_name)
+async def create_thumbnail(image_path: Path) -> Union[None, Path]:
+    """
+    The derivative stage (after each saved image): the thumbnail shown by the HTML page.
+    Skipped when the thumbnail is newer than its source image
+    """
+    thumbnail_path = image_store.thumbnail_path(image_path)
+    try:
+        if thumbnail_path.stat().st_mtime >= image_path.stat().st_mtime:
+            THUMBNAILS_STATS['up_to_date'] += 1
+            THUMBNAILS[image_path] = thumbnail_path
+            return thumbnail_path
+    except FileNotFoundError:
+        pass
+
+    if thumbnail_path not in THUMBNAILS_IN_FLIGHT:
+        future = asyncio.ensure_future(cpu_offload.CPU_OFFLOAD.run(
+            make_thumbnail, image_path, thumbnail_path,
+            settings.THUMBNAIL_WIDTH, settings.THUMBNAIL_FORMAT, settings.THUMBNAIL_QUALITY))
+        future.add_done_callback(lambda _: THUMBNAILS_IN_FLIGHT.pop(thumbnail_path, None))
+        THUMBNAILS_IN_FLIGHT[thumbnail_path] = future
+    try:
+        async with instrumentation.timer('create_thumbnail'):
+            # shielded: the other animals sharing the image keep waiting for it if this one is cancelled
+            made = await asyncio.shield(THUMBNAILS_IN_FLIGHT[thumbnail_path])
+    except Exception as e:
+        MODULE_LOGGER.exception(f'Failed to make the thumbnail of {image_path}: {e}')
+        made = False
+    THUMBNAILS_STATS['made' if made else 'failed'] += 1
+    if made:
+        THUMBNAILS[image_path] = thumbnail_path
+    return thumbnail_path if made else None
+
+
+async def create_thumbnails(image_paths) -> None:
+    """The thumbnails of images saved by a previous run (looked up, or made when missing/outdated)"""
+    await asyncio.gather(*(create_thumbnail(image_path) for image_path in set(image_paths) if image_path))
+
+
+def record_saved_image(journal: checkpoint.CheckpointJournal, animal_name: str, image_uri: str,
+                       absolute_image_path: Path) -> None:
+    if journal and not journal.saved_image(animal_name):
+        journal.record(animal_name, checkpoint.IMAGE_SAVED, image_uri=image_uri,
+                       image_path=str(absolute_image_path), bytes=absolute_image_path.stat().st_size)
+
+
+async def download_animal_image(uri: str, animal_name: str, session, scheduler=None, image_uri: str = None,
+                                store: image_store.ImageStore = None,
+                                journal: checkpoint.CheckpointJournal = None) -> Union[None, Path]:
+    """Retrieve the image of the animal (see fetch_animal_image), then make its thumbnail"""
+    absolute_image_path = await fetch_animal_image(uri, animal_name, session, scheduler, image_uri, store, journal)
+    if absolute_image_path and settings.THUMBNAILS_ENABLED:
+        await create_thumbnail(absolute_image_path)
+    return absolute_image_path
+
+
+async def fetch_animal_image(uri: str, animal_name: str, session, scheduler=None, image_uri: str = None,
+                             store: image_store.ImageStore = None,
+                             journal: checkpoint.CheckpointJournal = None) -> Union[None, Path]:
+    """
+    Retrieve the image of the animal from the provided uri (its page) and save it in the images store
+    All the web requests go through the provided download_scheduler (if any)
+    When the image_uri is already known (e.g. resolved by the MediaWiki API), the animal page isn't fetched at all
+    Every completed step is recorded in the checkpoint journal (if any), and skipped when it was already recorded
+    """
+    store = store or IMAGE_STORE
+    if journal:
+        if absolute_image_path := journal.saved_image(animal_name):
+            return absolute_image_path
+        if image_uri and not journal.resolved_image_uri(animal_name):  # resolved by the caller (MediaWiki API)
+            journal.record(animal_name, checkpoint.IMAGE_URI_RESOLVED, image_uri=image_uri)
+        image_uri = image_uri or journal.resolved_image_uri(animal_name)
+
+    # Check if the animal already has an image, if so, return the full path to it
+    absolute_image_path = store.lookup_animal(animal_name)
     if absolute_image_path != None and settings.REWRITE_EXISTING_IMAGE_FILES == False:
+        record_saved_image(journal, animal_name, image_uri, absolute_image_path)
         return absolute_image_path
-    content = await utilties.retrieve_content(uri, session)
-    if not content:
-        MODULE_LOGGER.warning(f'Failed to retrieve animal page')
-    else:
-        tree = bs4.BeautifulSoup(content, settings.WEBPAGE_PARSER)  # parse the html
 
+    if not image_uri:
+        content = await utilties.retrieve_content(uri, session, scheduler=scheduler)
+        if not content:
+            MODULE_LOGGER.warning(f'Failed to retrieve animal page')
+            return None
+        if journal:
+            journal.record(animal_name, checkpoint.PAGE_FETCHED, page=uri)
         # get the image uri from the crawler friendly script tag (it is the only one)
-        image_uri, absolute_image_path, file_extension = await parse_image_uri(tree, file_name, uri)
-        if not image_uri or not absolute_image_path:
+        # CPU-bound: parsed in the offload executor, the downloads in flight keep progressing meanwhile
+        async with instrumentation.timer('parse_animal_page'):
+            image_uri = await cpu_offload.CPU_OFFLOAD.run(parse_image_uri, content)
+        if not image_uri:
+            MODULE_LOGGER.warning(f'Failed to parse link to animal image from {uri}')
+            IMAGELESS_PAGES.add(uri)
             return None
-        # Edge case: Ant has video instead of image
-        if file_extension != 'webm':
-            if not await download_image(image_uri, absolute_image_path, session):
-                return None
+        if journal:
+            journal.record(animal_name, checkpoint.IMAGE_URI_RESOLVED, image_uri=image_uri)
 
-        return absolute_image_path
+    file_extension = get_image_file_extension(image_uri)
+    # Edge case: Ant has video instead of image
+    if file_extension == 'webm':
+        IMAGELESS_PAGES.add(uri)
+        return None
+
+    # Several animals share the same image, it is downloaded (and stored) once
+    absolute_image_path = await store.fetch(
+        image_uri, lambda: download_image(image_uri, file_extension, session, scheduler, store))
+    if absolute_image_path:
+        store.link_animal(animal_name, image_uri)
+        record_saved_image(journal, animal_name, image_uri, absolute_image_path)
+    return absolute_image_path
@@ -0,0 +1,181 @@
+"""
+Content-addressed images store.
+Every distinct image content is saved once, as <sha256>.<extension> under SAVED_IMAGES_DIR,
+and a single SQLite manifest maps: animal -> source URL -> hash -> extension.
+Existence checks are a single index lookup, and images shared by several animals are downloaded once.
+The upstream validators of every source (ETag / Last-Modified / Content-Length) are kept as well,
+so a refresh run (REWRITE_EXISTING_IMAGE_FILES) downloads only the images that changed.
+"""
+import asyncio
+import sqlite3
+from collections import Counter
+from pathlib import Path
+from typing import Awaitable, Callable, Tuple, Union
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    extension TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL REFERENCES images (sha256),
+    etag TEXT,
+    last_modified TEXT,
+    content_length INTEGER
+);
+CREATE TABLE IF NOT EXISTS animals (
+    animal TEXT PRIMARY KEY,
+    url TEXT NOT NULL REFERENCES sources (url)
+);
+'''
+# Added to the sources table of the manifests created before the validators were kept
+VALIDATOR_COLUMNS = (('etag', 'TEXT'), ('last_modified', 'TEXT'), ('content_length', 'INTEGER'))
+
+
+def upstream_validators(headers) -> dict:
+    """The validators of an image response, the missing ones are None"""
+    content_length = headers.get('Content-Length')
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_length': int(content_length) if content_length and content_length.isdigit() else None,
+    }
+
+
+def is_unchanged(validators: dict, headers) -> bool:
+    """
+    Whether the upstream image (a HEAD response headers) is still the stored one:
+    the same ETag, or (when either side has none) the same Last-Modified and Content-Length
+    """
+    current = upstream_validators(headers)
+    if validators['etag'] and current['etag']:
+        return validators['etag'] == current['etag']
+    return bool(validators['last_modified']) and validators['last_modified'] == current['last_modified'] \
+        and validators['content_length'] == current['content_length']
+
+
+def thumbnail_path(image_path: Path) -> Path:
+    """The thumbnail of a stored image (named after the image content hash as well)"""
+    return Path(settings.THUMBNAILS_DIR, f'{Path(image_path).stem}.{settings.THUMBNAIL_FORMAT}')
+
+
+class ImageStore:
+    def __init__(self, images_dir: Path = settings.SAVED_IMAGES_DIR,
+                 manifest_path: Path = settings.IMAGES_MANIFEST_PATH):
+        self.images_dir = Path(images_dir)
+        self.manifest_path = Path(manifest_path)
+        self._connection = None
+        self._in_flight = dict()  # source url -> the task downloading it
+        self._fetched = dict()  # source url -> path, the urls downloaded during this run
+        self.revalidations = Counter()  # the stored images checked against their upstream versions
+
+    @property
+    def manifest(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.images_dir.mkdir(parents=True, exist_ok=True)
+            # Autocommit mode, every record is persisted immediately
+            self._connection = sqlite3.connect(self.manifest_path, isolation_level=None)
+            self._connection.executescript(MANIFEST_SCHEMA)
+            self._add_missing_columns()
+        return self._connection
+
+    def _add_missing_columns(self) -> None:
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(sources)')}
+        for column, column_type in VALIDATOR_COLUMNS:
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE sources ADD COLUMN {column} {column_type}')
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def image_path(self, sha256: str, extension: str) -> Path:
+        return Path(self.images_dir, f'{sha256}.{extension}')
+
+    def temp_path(self, url_digest: str) -> Path:
+        return Path(self.images_dir, f'.{url_digest}{settings.PARTIAL_DOWNLOAD_SUFFIX}')
+
+    def _existing_path(self, row) -> Union[None, Path]:
+        if row is None:
+            return None
+        path = self.image_path(*row)
+        return path if path.is_file() else None
+
+    def lookup_animal(self, animal: str) -> Union[None, Path]:
+        """The stored image of the animal (if any)"""
+        return self._existing_path(self.manifest.execute(
+            'SELECT images.sha256, images.extension FROM animals '
+            'JOIN sources ON sources.url = animals.url JOIN images ON images.sha256 = sources.sha256 '
+            'WHERE animals.animal = ?', (animal,)).fetchone())
+
+    def lookup_url(self, url: str) -> Union[None, Path]:
+        """The stored image downloaded from the url (if any)"""
+        return self._existing_path(self.manifest.execute(
+            'SELECT images.sha256, images.extension FROM sources JOIN images ON images.sha256 = sources.sha256 '
+            'WHERE sources.url = ?', (url,)).fetchone())
+
+    def lookup_validators(self, url: str) -> Union[None, Tuple[Path, dict]]:
+        """The stored image downloaded from the url and its upstream validators (if any)"""
+        row = self.manifest.execute(
+            'SELECT images.sha256, images.extension, sources.etag, sources.last_modified, sources.content_length '
+            'FROM sources JOIN images ON images.sha256 = sources.sha256 WHERE sources.url = ?', (url,)).fetchone()
+        path = self._existing_path(row[:2] if row else None)
+        if path is None:
+            return None
+        return path, dict(zip(('etag', 'last_modified', 'content_length'), row[2:]))
+
+    def refresh_validators(self, url: str, headers) -> None:
+        """The server approved our copy (304), keep the validators it sent along (if any)"""
+        validators = upstream_validators(headers)
+        self.manifest.execute('UPDATE sources SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) '
+                              'WHERE url = ?', (validators['etag'], validators['last_modified'], url))
+
+    def add_image(self, url: str, sha256: str, extension: str, validators: dict = None) -> Path:
+        """Record the image downloaded from the url, returns the path its content should be stored at"""
+        validators = validators or dict()
+        self.manifest.execute('INSERT OR IGNORE INTO images (sha256, extension) VALUES (?, ?)', (sha256, extension))
+        self.manifest.execute(
+            'INSERT OR REPLACE INTO sources (url, sha256, etag, last_modified, content_length) VALUES (?, ?, ?, ?, ?)',
+            (url, sha256, validators.get('etag'), validators.get('last_modified'), validators.get('content_length')))
+        # The same content may have been stored before under a different extension (e.g. jpeg vs jpg)
+        stored_extension, = self.manifest.execute('SELECT extension FROM images WHERE sha256 = ?',
+                                                  (sha256,)).fetchone()
+        return self.image_path(sha256, stored_extension)
+
+    def link_animal(self, animal: str, url: str) -> None:
+        self.manifest.execute('INSERT OR REPLACE INTO animals (animal, url) VALUES (?, ?)', (animal, url))
+
+    async def fetch(self, url: str, download: Callable[[], Awaitable]) -> Union[None, Path]:
+        """
+        Return the stored image of the url, downloading it (`await download()` -> Path or None) if needed.
+        Concurrent requests of the same url share a single download.
+        """
+        if url in self._fetched:
+            return self._fetched[url]
+        if (path := self.lookup_url(url)) and not settings.REWRITE_EXISTING_IMAGE_FILES:
+            return path
+
+        if url not in self._in_flight:
+            self._in_flight[url] = asyncio.ensure_future(download())
+            self._in_flight[url].add_done_callback(lambda task: self._on_download_done(url, task))
+        else:
+            MODULE_LOGGER.debug('Already downloading %s, waiting for it', url, sample_every=settings.LOG_SAMPLE_EVERY)
+        return await asyncio.shield(self._in_flight[url])
+
+    def _on_download_done(self, url: str, task: asyncio.Future) -> None:
+        self._in_flight.pop(url, None)
+        if not task.cancelled() and not task.exception() and task.result():
+            self._fetched[url] = task.result()
+
+    def stats(self) -> dict:
+        stats = {table: self.manifest.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                 for table in ('animals', 'sources', 'images')}
+        stats.update(self.revalidations)
+        return stats
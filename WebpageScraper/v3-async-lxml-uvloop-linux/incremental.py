@@ -0,0 +1,142 @@
+"""
+Incremental re-scrape support.
+The previous run's parsed rows are persisted with a fingerprint per row (and their results, including their
+grouping keys), so the next run only schedules image work for the rows that were added or changed.
+The grouping is then rebuilt in the table rows order from both, as a full run would group the table.
+"""
+import os
+import json
+import hashlib
+import operator
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Union
+
+import settings
+import logger
+import animal_records
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+
+def row_key(row: dict) -> str:
+    """Identifies a row between runs (an animal name isn't unique by itself after cleaning its text)"""
+    return f'{row.get(settings.ANIMAL_NAME_COL_KEY)}|{row.get(settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX)}'
+
+
+def row_fingerprint(row: dict) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def row_groups(row: dict) -> List[str]:
+    """The grouping keys of the row (as animal_records.group_records groups it), none when it isn't grouped"""
+    groups = row.get(settings.COLATERAL_COLLECTIVES_COL)
+    if row.get(settings.ANIMAL_NAME_COL_KEY) is None or groups is None:
+        return []
+    return [groups] if isinstance(groups, str) else list(groups)
+
+
+def image_page_uri(row: dict) -> str:
+    """The animal page the image is taken from (as image_downloader.fetch_animal_image is given it)"""
+    return f'{settings.BASE_URL}{row.get(settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX)}'
+
+
+def image_path(stored_row: dict) -> Union[None, Path]:
+    return Path(stored_row['image_path']) if stored_row['image_path'] else None
+
+
+class RowsDiff:
+    def __init__(self, changed_rows: List[dict], changed_indexes: List[int], unchanged_keys: Dict[str, int]):
+        self.changed_rows = changed_rows  # added or changed rows, they need (image) work
+        self.changed_indexes = changed_indexes  # their indexes in the table
+        self.unchanged_keys = unchanged_keys  # rows whose stored results can be reused -> their indexes in the table
+
+
+class ScrapeState:
+    """
+    The results of the previous run: row key -> fingerprint/animal/image path (or no image)/grouping keys.
+    The reused rows are regrouped by their row key (animal names aren't unique, e.g. two "deer" rows)
+    """
+
+    def __init__(self, rows: Dict[str, dict] = None):
+        self.rows = rows or dict()
+
+    @classmethod
+    def load(cls, path: Path = settings.INCREMENTAL_STATE_FILE) -> 'ScrapeState':
+        try:
+            with open(path, 'r') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            MODULE_LOGGER.info(f'No previous scrape state ({path}), every row will be processed')
+            return cls()
+        except (OSError, ValueError) as e:
+            MODULE_LOGGER.exception(f'Failed to load the previous scrape state, every row will be processed: {e}')
+            return cls()
+        return cls(state['rows'])
+
+    def is_unchanged(self, row: dict) -> bool:
+        """Whether the stored results of the row can be reused"""
+        previous = self.rows.get(row_key(row))
+        # The rows stored without their grouping keys (by a previous version) are processed again
+        if not (previous and previous['fingerprint'] == row_fingerprint(row) and 'groups' in previous):
+            return False
+        if previous['image_path']:
+            return Path(previous['image_path']).is_file()  # a deleted image is downloaded again
+        # The failed images are retried (they might be available by now), unlike the rows without an image
+        return previous.get('no_image', False)
+
+    def rows_diff(self, changed_rows: List[dict], changed_indexes: List[int], unchanged_keys: Dict[str, int],
+                  current_keys: set) -> RowsDiff:
+        MODULE_LOGGER.info(f'Incremental scrape: {len(changed_rows)} added/changed rows, '
+                           f'{len(unchanged_keys)} unchanged rows, {len(self.rows.keys() - current_keys)} removed rows')
+        return RowsDiff(changed_rows, changed_indexes, unchanged_keys)
+
+    def diff(self, database: List[dict]) -> RowsDiff:
+        changed_rows, changed_indexes, unchanged_keys = [], [], dict()
+        current_keys = set()
+        for index, row in enumerate(database):
+            key = row_key(row)
+            current_keys.add(key)
+            if self.is_unchanged(row):
+                unchanged_keys[key] = index
+            else:
+                changed_rows.append(row)
+                changed_indexes.append(index)
+        return self.rows_diff(changed_rows, changed_indexes, unchanged_keys, current_keys)
+
+    def reused_image_paths(self, rows_diff: RowsDiff) -> Iterator[Path]:
+        return filter(None, (image_path(self.rows[key]) for key in rows_diff.unchanged_keys))
+
+    def merged_grouping(self, rows_diff: RowsDiff, image_paths: Iterable) -> animal_records.AdjectiveIndex:
+        """
+        The grouping of the whole table: the reused rows (their stored grouping keys) and the changed rows
+        (with their image_paths) grouped together in the table rows order, the order of a full run's grouping
+        """
+        rows = [(index, {settings.ANIMAL_NAME_COL_KEY: self.rows[key]['animal'],
+                         settings.COLATERAL_COLLECTIVES_COL: self.rows[key]['groups'] or None},
+                 image_path(self.rows[key]))
+                for key, index in rows_diff.unchanged_keys.items()]
+        rows += zip(rows_diff.changed_indexes, rows_diff.changed_rows, image_paths)
+        rows.sort(key=operator.itemgetter(0))
+        return animal_records.group_records((row for _, row, _ in rows), settings.ANIMAL_NAME_COL_KEY,
+                                            settings.COLATERAL_COLLECTIVES_COL, values=(path for _, _, path in rows))
+
+    def update(self, changed_rows: List[dict], image_paths: list, unchanged_keys: Iterable[str],
+               imageless_pages: set = frozenset()) -> None:
+        """imageless_pages: the animal pages without an image, their rows are stored as done"""
+        rows = {key: self.rows[key] for key in unchanged_keys}
+        for row, image_path in zip(changed_rows, image_paths):
+            rows[row_key(row)] = {'fingerprint': row_fingerprint(row),
+                                  'animal': row.get(settings.ANIMAL_NAME_COL_KEY),
+                                  'image_path': str(image_path) if image_path else None,
+                                  'no_image': not image_path and image_page_uri(row) in imageless_pages,
+                                  'groups': row_groups(row)}
+        self.rows = rows
+
+    def save(self, path: Path = settings.INCREMENTAL_STATE_FILE) -> None:
+        temp_path = Path(f'{path}{settings.PARTIAL_DOWNLOAD_SUFFIX}')
+        try:
+            with open(temp_path, 'w') as state_file:
+                json.dump({'rows': self.rows}, state_file)
+            os.replace(temp_path, path)  # never leave a half written state behind
+        except OSError as e:
+            MODULE_LOGGER.exception(f'Failed to save the scrape state: {e}')
@@ -0,0 +1,210 @@
+"""
+Latency instrumentation of the scraper stages (fetch, parse, validate, save) and of the event loop itself.
+    @timed('stage') / with timer('stage') / async with timer('stage') - record the duration in the stage histogram
+    start_loop_lag_probe() - a background task measuring how late the event loop wakes it up
+The histograms are written at exit as a JSON report and in the Prometheus text format.
+Stages timed with a plain `with` (or a sync function) on the event loop thread block the loop (the same stages
+run by an offload thread don't). Nothing is recorded in the worker processes (their histograms are discarded),
+the parent process times the offloaded calls instead.
+"""
+import json
+import time
+import asyncio
+import functools
+import multiprocessing
+from bisect import bisect_left
+from typing import Callable, Dict
+
+import settings
+import logger
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+LOOP_LAG = 'event_loop_lag'
+
+
+def on_event_loop_thread() -> bool:
+    """Whether the caller runs on the thread of a running event loop (not in an offload thread or process)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class Histogram:
+    def __init__(self, buckets=settings.INSTRUMENTATION_BUCKETS):
+        self.buckets = tuple(buckets)  # upper bounds in seconds, the last bucket is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.blocking = False  # the observed durations blocked the event loop
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction: float) -> float:
+        """The upper bound of the bucket holding the quantile (the max for the +Inf bucket)"""
+        rank, cumulative = fraction * self.count, 0
+        for upper_bound, count in zip(self.buckets + (self.max,), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def report(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': round(self.quantile(0.5), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'max': round(self.max, 6),
+            'blocking': self.blocking,
+            'buckets': dict(zip(map(str, self.buckets + (float('inf'),)), self.counts)),
+        }
+
+
+class Timer:
+    """A sync (with) and async (async with) context manager, records the elapsed time in a histogram"""
+
+    def __init__(self, name: str, histogram: Histogram):
+        self.name = name
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed)
+        if not on_event_loop_thread():
+            return
+        self.histogram.blocking = True
+        if elapsed > settings.INSTRUMENTATION_BLOCKING_THRESHOLD:
+            MODULE_LOGGER.warning(f'{self.name} blocked the event loop thread for {elapsed:.3f}s')
+
+    async def __aenter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer:
+    """Records nothing (contextlib.nullcontext supports async with only since python 3.10)"""
+
+    def __enter__(self) -> 'NullTimer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    async def __aenter__(self) -> 'NullTimer':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Instrumentation:
+    def __init__(self, enabled: bool = settings.INSTRUMENTATION_ENABLED):
+        self.enabled = enabled
+        self.histograms: Dict[str, Histogram] = dict()
+        self._probe = None
+
+    def histogram(self, name: str) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def timer(self, name: str):
+        # A worker process (multiprocessing.parent_process) would record into a discarded copy of the histograms
+        if not self.enabled or multiprocessing.parent_process() is not None:
+            return NULL_TIMER
+        return Timer(name, self.histogram(name))
+
+    def timed(self, name: str = None) -> Callable:
+        """Decorator, times every call of the (sync or async) function"""
+        def decorator(function: Callable) -> Callable:
+            stage = name or function.__name__
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def timed_coroutine(*args, **kwargs):
+                    async with self.timer(stage):
+                        return await function(*args, **kwargs)
+                return timed_coroutine
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorator
+
+    async def _probe_loop_lag(self) -> None:
+        histogram = self.histogram(LOOP_LAG)
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(settings.INSTRUMENTATION_LOOP_LAG_INTERVAL)
+            histogram.observe(max(0.0, time.perf_counter() - start - settings.INSTRUMENTATION_LOOP_LAG_INTERVAL))
+
+    def start_loop_lag_probe(self) -> None:
+        if self.enabled and self._probe is None:
+            self._probe = asyncio.ensure_future(self._probe_loop_lag())
+
+    def stop_loop_lag_probe(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+
+    def report(self) -> dict:
+        return {name: histogram.report() for name, histogram in sorted(self.histograms.items())}
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for metric, names in (('scraper_stage_duration_seconds', [n for n in self.histograms if n != LOOP_LAG]),
+                              ('scraper_event_loop_lag_seconds', [n for n in self.histograms if n == LOOP_LAG])):
+            if not names:
+                continue
+            lines.append(f'# TYPE {metric} histogram')
+            for name in sorted(names):
+                histogram = self.histograms[name]
+                labels = f'stage="{name}",' if name != LOOP_LAG else ''
+                cumulative = 0
+                for upper_bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                    lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{labels.rstrip(",")}}} {histogram.sum}')
+                lines.append(f'{metric}_count{{{labels.rstrip(",")}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def save_report(self, json_path=settings.INSTRUMENTATION_REPORT_PATH,
+                    prometheus_path=settings.INSTRUMENTATION_PROMETHEUS_PATH) -> None:
+        if not self.enabled:
+            return
+        try:
+            with open(json_path, 'w') as report_file:
+                json.dump(self.report(), report_file, indent=2)
+            with open(prometheus_path, 'w') as report_file:
+                report_file.write(self.prometheus_text())
+        except OSError as e:
+            MODULE_LOGGER.exception(f'Failed to save the instrumentation report: {e}')
+            return
+        MODULE_LOGGER.info(f'Instrumentation report saved to {json_path} and {prometheus_path}')
+
+
+INSTRUMENTATION = Instrumentation()
+timed = INSTRUMENTATION.timed
+timer = INSTRUMENTATION.timer
@@ -1,12 +1,86 @@
-"""Logger facility module for the application."""
-import logging
-from logging.handlers import RotatingFileHandler  # TODO: why can't I use logging.handlers.RotatingFileHandler?
+"""
+Logger facility module for the application.
+The records are put on a queue (cheap, non-blocking) and written by a single background listener thread,
+which owns the only file and stderr handlers (shared by all the named loggers).
+"""
+import os
 import sys
+import queue
+import atexit
+import logging
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
 import settings
 
 
+def _create_handlers() -> tuple:
+    rotating_file_handler = RotatingFileHandler(
+        settings.LOG_FILE_PATH,
+        maxBytes=settings.LOG_FILE_MAX_SIZE,
+        backupCount=settings.LOG_BACKUP_COUNT
+    )
+    rotating_file_handler.setFormatter(logging.Formatter(settings.LOGGING_FORMAT_STRING))
+
+    # We will also write the log messages to stderr
+    return rotating_file_handler, logging.StreamHandler(stream=sys.stderr)
+
+
+_LOG_QUEUE = queue.SimpleQueue()
+_QUEUE_HANDLER = QueueHandler(_LOG_QUEUE)
+_listener = None
+
+
+def _start_listener() -> None:
+    global _listener
+    if _listener is None and _QUEUE_HANDLER.queue is _LOG_QUEUE:
+        _listener = QueueListener(_LOG_QUEUE, *_create_handlers(), respect_handler_level=True)
+        _listener.start()
+
+
+class _HandlersQueue:
+    """Hands the records straight to the handlers (a QueueHandler's queue, when there's no listener thread)"""
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    def put_nowait(self, record) -> None:
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def _write_directly_in_child() -> None:
+    """
+    A forked process (e.g. a pool worker) inherits the queue, but not the listener thread.
+    Pool workers exit without running the atexit hooks, so they write their (few) records synchronously instead
+    """
+    global _listener
+    _listener = None
+    _QUEUE_HANDLER.queue = _HandlersQueue(_create_handlers())
+
+
+def stop_listener() -> None:
+    """Flush the queued records (called at exit)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_write_directly_in_child)
+
+
 # TODO: use logging.basicConfig instead?
 class Logger:
+    """
+    Lazy formatting: pass the arguments separately, logger.debug('Saved %s', uri),
+    they are only formatted when the level is enabled.
+    sample_every=N logs only 1 of every N calls with the same message template (for high volume lines).
+    """
+
     def __init__(self, name):
         self.__name = name
 
@@ -14,36 +88,34 @@ class Logger:
         # but always through the module-level function logging.getLogger(name).
         # Multiple calls to getLogger() with the same name will always return a reference to the same Logger object.
         self.__logger = logging.getLogger(name)
-
         self.__logger.setLevel(settings.DEFAULT_LOG_LEVEL)
+        self.__samples = Counter()
 
-        # Note: This variable won't get stored as an attribute (neither class attr nor instance attr)
-        rotating_file_handler = RotatingFileHandler(
-            settings.LOG_FILE_PATH,
-            maxBytes=settings.LOG_FILE_MAX_SIZE,
-            backupCount=settings.LOG_BACKUP_COUNT
-        )
-
-        rotating_file_handler.setFormatter(logging.Formatter(settings.LOGGING_FORMAT_STRING))
-
-        self.__logger.addHandler(rotating_file_handler)
+        # A single handler per logger, however many times it is constructed
+        if _QUEUE_HANDLER not in self.__logger.handlers:
+            self.__logger.addHandler(_QUEUE_HANDLER)
+        _start_listener()
 
-        # We will also write the log messages to stderr
-        self.__logger.addHandler(logging.StreamHandler(stream=sys.stderr))  # TODO: is this the right way to do it?
-        # self.__logger.addHandler(logging.StreamHandler(stream=sys.stdout))
+    def __sampled_out(self, msg, sample_every: int) -> bool:
+        if sample_every <= 1:
+            return False
+        self.__samples[msg] += 1
+        return (self.__samples[msg] - 1) % sample_every != 0
 
-    # TODO: seems like there is a better way (e.g. using decorators) to do this
-    def debug(self, msg):
-        self.__logger.debug(msg)
+    # stacklevel=2: the records hold the caller's line number (not this module's)
+    def debug(self, msg, *args, sample_every: int = 1):
+        if self.__logger.isEnabledFor(logging.DEBUG) and not self.__sampled_out(msg, sample_every):
+            self.__logger.debug(msg, *args, stacklevel=2)
 
-    def info(self, msg):
-        self.__logger.info(msg)
+    def info(self, msg, *args, sample_every: int = 1):
+        if self.__logger.isEnabledFor(logging.INFO) and not self.__sampled_out(msg, sample_every):
+            self.__logger.info(msg, *args, stacklevel=2)
 
-    def critical(self, msg):
-        self.__logger.critical(msg)
+    def critical(self, msg, *args):
+        self.__logger.critical(msg, *args, stacklevel=2)
 
-    def warning(self, msg):
-        self.__logger.warning(msg)
+    def warning(self, msg, *args):
+        self.__logger.warning(msg, *args, stacklevel=2)
 
-    def exception(self, msg):
-        self.__logger.exception(msg)
+    def exception(self, msg, *args):
+        self.__logger.exception(msg, *args, stacklevel=2)
@@ -1,23 +1,34 @@
 """ Animal table (Wikipedia) scrapper."""
-# TODO: Find a way to add a cache for the webpage get requests results
 # TODO: Create a decorator for similar try/except blocks if possible
 
 # Built-in python libraries
 import time
 import asyncio
-
-from collections import defaultdict
-from typing import Tuple, DefaultDict, List
+import argparse
+import functools
 
 # Project packages and modules files
+import animal_records
 import image_downloader
+import incremental
+import checkpoint
+import crawler
+import exporters
+import table_spec
+import cpu_offload
+import instrumentation
+import download_scheduler
+import mediawiki_api
+import pipeline
+import retry_policy
+import session_factory
+import table_parser
 import utilties
 import settings
 import logger
 
 # 3rd party libs
 import bs4
-import aiohttp
 import uvloop
 
 # The logger name hierarchy is analogous to the Python package hierarchy,
@@ -27,65 +38,21 @@ import uvloop
 MAIN_LOGGER = logger.Logger(__name__)
 
 
-# TODO: Make this function more generic so it saves all the interesting data
-#       and not just the collateral adjective (it stiil resembles relational database)
-
-# "SQL like" group_by function
-async def group_by_key(result: DefaultDict[str, List] = None,
-                       keys_to_group_by=None,
-                       animal_name: str = None,
-                       img_file_name: str = None) -> None:
-    # if any of the arguments is None
-    if result is None or keys_to_group_by is None or animal_name is None:
-        MAIN_LOGGER.critical(f'Failed to group by key: {animal_name}')
-        return
-
-    for key in keys_to_group_by:
-        result[key].append(((animal_name, img_file_name)))
-
-
-# TODO: Do we really must declare it as async even tough it is not doing any async stuff?
-# Note: We are using strings as "selectors" (columns names) instead of list of indexing with integers
-#       meaning there's a tradeoff (robustness & readability vs performance)
-async def parse_row(row, table_headers=None, keys_of_interest=None, select_all=False):
-    row_cells = row.find_all('td')  # get the cells of the current row
-    if len(row_cells) == 0:
-        return None     # Skip a capital letter row with no data (it's a special header)
-
-    current_row_columns = dict()  # a dict to store the data of the current row
-    for key, value in zip(table_headers, row_cells):
-        # TODO: This might fail?, Look for better option to filter
-        if key in keys_of_interest or select_all and len(value.text.strip()) > 0:
-            # filter the relevant data
-            cell_data = await utilties.parse_table_cell(value) if value.text.strip() != settings.NO_VALUE else cell_data
-            if cell_data == None:
-                continue
-            current_row_columns[key] = cell_data[0] if key in settings.COLS_WITH_SINGLE_VALUES else cell_data
-
-            if key == settings.COL_WITH_IMAGE_KEY:
-                # Look for a link to the image or page that contains the image (exists for all animals).
-                if image_page := value.find('a', href=True):
-                    image_page = image_page['href']
-                    current_row_columns[key + settings.LINK_SUFFIX] = image_page if image_page else None
-    return current_row_columns
-
-
-async def parse_table(table: bs4.element.Tag, session=None, keys_of_interest: Tuple[str, ...] = None,
-                      select_all=False):
-    """Analyzing tree and extract table with animals' data"""
-    if not table or not session or not keys_of_interest and not select_all:
-        MAIN_LOGGER.critical(f'Incorrect usage of {parse_table.__name__}'
-                             f'Either use select_all=True or provide keys_of_interest')
+async def parse_table(table: bs4.element.Tag, session=None, spec: table_spec.TableSpec = table_spec.MAIN_TABLE):
+    """Analyzing tree and extract table with the spec's columns (the animals' data by default)"""
+    if not table or not session or not spec:
+        MAIN_LOGGER.critical(f'Incorrect usage of {parse_table.__name__}: provide a table, a session and a table spec')
         return
 
     # NOTE: a generator can be exhausted (utilized) only once!
     #       Therefore- we must not define the headers as a generator expression!
     table_headers = tuple(h.text.strip() for h in table.find('tr').find_all('th'))  # coloumns "names"
+    columns = spec.compile(table_headers)
 
-    # TODO: Note: Sequential execution
-    #       This are CPU-BOUND tasks, we should use a multiprocessing pool of workers
-    rows = [await parse_row(row, table_headers, keys_of_interest, select_all)
-            for row in table.find_all('tr')[settings.FIRST_DATA_ROW_INDEX:]]
+    # Note: Sequential execution (blocks the event loop)
+    #       See table_parser.parse_page_in_process_pool for the multiprocessing version
+    with instrumentation.timer('parse_table'):
+        rows = [table_parser.parse_row(row, columns) for row in table.find_all('tr')[spec.first_data_row:]]
 
     return [parsed_row for parsed_row in rows if parsed_row is not None]
 
@@ -97,7 +64,7 @@ async def parse_page(content: bytes) -> bs4.BeautifulSoup:
     MAIN_LOGGER.debug('Scanning the HTML tree')
     parsed_tree = None #TODO: redundant? (will be null anyway in case of exception?)
     try:
-        parsed_tree = bs4.BeautifulSoup(content, settings.WEBPAGE_PARSER)
+        parsed_tree = bs4.BeautifulSoup(content, settings.BS4_TREE_BUILDER)
     # TODO: narrow the exception type to something like HTMLParseError
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to parse the html page: {e}')
@@ -112,57 +79,121 @@ async def get_main_table(main_page_content):
         return
 
     # Only one table is relevant for us (the one with the animals names)
-    table = bs4_tree.find_all(settings.TABLE_XPATH)[settings.RELEVANT_TABLE]
+    tables = bs4_tree.select(settings.MAIN_TABLE_CSS_SELECTOR)
+    table = tables[table_spec.MAIN_TABLE.table_index] if tables else None
     if not table:
-        MAIN_LOGGER.critical(f'Failed to find the table with the animals names (xpath={settings.TABLE_XPATH})')
+        MAIN_LOGGER.critical(f'Failed to find the table with the animals names '
+                             f'(selector={settings.MAIN_TABLE_CSS_SELECTOR})')
 
     return table
 
 
 # TODO: It's a bad practice to send a writeable result object as an argument (it is confusing)
-async def combine_results(database, image_paths, animals_by_collateral_adjectives):
-    tasks = []
+# Note: A single synchronous pass over the rows (see animal_records.group_records), grouping has nothing to await
+def combine_results(database, image_paths, animals_by_collateral_adjectives: animal_records.AdjectiveIndex) -> None:
+    """ "SQL like" group by: collateral adjective -> the animals (and their images), in the rows order """
     try:
-        for animal, image_path in zip(database, image_paths):
-            task = asyncio.create_task(group_by_key(result=animals_by_collateral_adjectives,
-                keys_to_group_by=animal[settings.COLATERAL_COLLECTIVES_COL],
-                animal_name=animal[settings.ANIMAL_NAME_COL_KEY],
-                img_file_name=image_path))
-            tasks.append(task)
-        await asyncio.gather(*tasks)
+        animal_records.group_records(database, settings.ANIMAL_NAME_COL_KEY, settings.COLATERAL_COLLECTIVES_COL,
+                                     values=image_paths, grouping=animals_by_collateral_adjectives)
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to combine results: {e}')
-    return
 
 
-async def download_images_async(database, session=None):
+async def download_images_async(database, session=None, journal: checkpoint.CheckpointJournal = None) -> list:
+    """
+    Download the images of the animals (recording the progress in the checkpoint journal, if any).
+    Returns the images paths in the database order, None for the animals whose image failed
+    """
+    # The tasks are created at once, but the scheduler bounds the number of requests actually in flight
+    # (globally and per host) so we don't open hundreds of sockets to the same server
+    scheduler = download_scheduler.DownloadScheduler()
     tasks = []
     try:
+        image_uris = dict()
+        if settings.IMAGE_URI_RESOLVER == 'mediawiki_api':
+            # The animals resolved by an interrupted run (journal) aren't queried again
+            image_uris = await mediawiki_api.resolve_lead_images(
+                (animal.get(settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX) for animal in database
+                 if not (journal and journal.resolved_image_uri(animal[settings.ANIMAL_NAME_COL_KEY]))),
+                session, scheduler)
+
         for animal in database:
+            image_page = animal[settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX]
             task = asyncio.create_task(
                 image_downloader.download_animal_image(
-                    uri=f'{settings.BASE_URL}{animal[settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX]}',
+                    uri=f'{settings.BASE_URL}{image_page}',
                     animal_name=animal[settings.ANIMAL_NAME_COL_KEY],
-                    session=session
+                    session=session,
+                    scheduler=scheduler,
+                    image_uri=image_uris.get(image_page),  # None -> fallback to parsing the animal page
+                    journal=journal
                 )
             )
             tasks.append(task)
-        return await asyncio.gather(*tasks)
+        # A single failed animal must not discard the images of all the others
+        results = await asyncio.gather(*tasks, return_exceptions=True)
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to download images: {e}')
-        return
+        for task in tasks:
+            task.cancel()
+        return [None] * len(database)
+    finally:
+        MAIN_LOGGER.info(f'Download scheduler stats: {scheduler.stats()}')
+        MAIN_LOGGER.info(f'Images store stats: {image_downloader.IMAGE_STORE.stats()}')
+
+    image_paths = []
+    for animal, result in zip(database, results):
+        if isinstance(result, BaseException):
+            MAIN_LOGGER.critical(
+                f'Failed to download the image of {animal.get(settings.ANIMAL_NAME_COL_KEY)}: {result}')
+            result = None
+        image_paths.append(result)
+    return image_paths
 
 
 async def print_results(animals_by_collateral_adjectives):
     for animal_group,animals in animals_by_collateral_adjectives.items():
         print(f'{animal_group}---->',end='')
-        for animal in animals:
-            print(animal[0], end='  ')
+        for animal_name, _ in animals:
+            print(animal_name, end='  ')
         print()
     return
 
 
-async def do_io_bound_work(session):
+async def parse_main_table(main_page_content: bytes, session, lazy: bool = False):
+    """
+    The parsed rows of the main table, using the configured parser.
+    With lazy=True an iterator may be returned, the rows are then parsed one by one while it is iterated
+    """
+    database = None
+    if settings.WEBPAGE_PARSER == settings.LXML_NATIVE_PARSER:
+        if lazy:
+            database = table_parser.iter_page_rows_lxml(main_page_content, table_spec.MAIN_TABLE)
+        elif settings.TABLE_PARSING_MODE == 'process_pool':
+            # Off the event loop (in the CPU offload pool), as table_spec.scrape_table parses the extra tables
+            async with instrumentation.timer('parse_page_offloaded'):
+                database = await cpu_offload.CPU_OFFLOAD.run(
+                    table_parser.parse_page_with_lxml, main_page_content, table_spec.MAIN_TABLE)
+        else:
+            database = table_parser.parse_page_with_lxml(main_page_content, table_spec.MAIN_TABLE)
+    elif settings.TABLE_PARSING_MODE == 'process_pool':
+        # These are CPU-BOUND tasks, a pool of worker processes keeps the event loop free meanwhile
+        database = await table_parser.parse_page_in_process_pool(main_page_content, table_spec.MAIN_TABLE)
+    if database is None:
+        table = await get_main_table(main_page_content)
+        database = await parse_table(table, session, table_spec.MAIN_TABLE)
+    return database
+
+
+async def do_io_bound_work(session, scrape_state: incremental.ScrapeState = None,
+                           journal: checkpoint.CheckpointJournal = None):
+    """
+    Fetch and parse the main table, then download the animals images.
+    With a previous scrape_state (incremental mode) only the added/changed rows are processed.
+    The progress of every animal is recorded in the checkpoint journal (if any).
+    Returns the processed rows, their image paths, their grouping (None when staged) and the rows diff
+    (None when not incremental)
+    """
     # We must define a User-agent, otherwise we'll get error 403 when trying
     # to download some of the images (we want to impersonate to a normal web browser).
     # TODO: Should we use a list of different user agents (in a loop till success) for robustness?
@@ -172,44 +203,118 @@ async def do_io_bound_work(session):
     if not main_page_content:
         raise Exception(f'Failed to get main HTML page (uri={settings.ANIMALS_PAGE_URL})')
 
-    table = await get_main_table(main_page_content)
+    if settings.SCRAPE_MODE == 'pipeline':
+        # The rows are parsed, resolved, downloaded and grouped concurrently (see pipeline.py)
+        rows = await parse_main_table(main_page_content, session, lazy=True)
+        return await pipeline.ScrapePipeline(session, scrape_state=scrape_state, journal=journal).run(rows)
+
+    database = await parse_main_table(main_page_content, session)
 
-    database = await parse_table(table, session, settings.KEYS_OF_INTEREST, select_all=False)
+    rows_diff = None
+    if scrape_state is not None:
+        rows_diff = scrape_state.diff(database)
+        database = rows_diff.changed_rows
 
     # download images from parsed table
-    image_paths = await download_images_async(database, session=session)
+    image_paths = await download_images_async(database, session=session, journal=journal)
     MAIN_LOGGER.info(
         f'Done downloading images. Check your {settings.SAVED_IMAGES_DIR} directory for the images')
 
-    return database, image_paths
+    return database, image_paths, None, rows_diff
 
 
-async def main() -> None:
+async def main(resume: bool = False, crawl: bool = False) -> None:
     MAIN_LOGGER.info('Starting main() script')
+    instrumentation.INSTRUMENTATION.start_loop_lag_probe()
+    try:
+        await (crawler.crawl(resume) if crawl else scrape(resume))
+    finally:
+        instrumentation.INSTRUMENTATION.stop_loop_lag_probe()
+        cpu_offload.CPU_OFFLOAD.shutdown()
+
+
+async def export_extra_tables(extra_tables: list) -> None:
+    """Export the groupings of the extra tables (see settings.EXTRA_TABLE_SPECS), an export per table"""
+    for spec, rows, grouping in extra_tables:
+        if not spec.group_by:
+            MAIN_LOGGER.warning(f'{spec.name}: no group_by column, nothing to export')
+            continue
+        group_by = (spec.group_by,) if isinstance(spec.group_by, str) else tuple(spec.group_by)
+        fields = tuple(exporters.field_name(column) for column in (*group_by, spec.key_column))
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            exporters.export_results, grouping, exporters.create_exporters(
+                name=spec.name, fields=fields, table=exporters.field_name(spec.name))))
+
+
+async def scrape(resume: bool = False) -> None:
+    """resume: continue an interrupted scrape from the checkpoint journal"""
     # Check if pathlib path exists (folder) and if not, create it
     settings.SAVED_IMAGES_DIR.mkdir(parents=False, exist_ok=True)
 
-    # https://docs.aiohttp.org/en/stable/faq.html#why-is-creating-a-clientsession-outside-of-an-event-loop-dangerous
-    async with aiohttp.ClientSession(loop=asyncio.get_running_loop()) as session:
-        database, image_paths = await do_io_bound_work(session)
-
-    animals_by_collateral_adjectives = defaultdict(list)
+    scrape_state = incremental.ScrapeState.load() if settings.INCREMENTAL_MODE else None
+    journal = checkpoint.CheckpointJournal(resume=resume) if settings.CHECKPOINT_ENABLED or resume else None
+    extra_specs = [table_spec.TableSpec.from_dict(spec) for spec in settings.EXTRA_TABLE_SPECS]
+    extra_specs += table_spec.load_table_specs(settings.EXTRA_TABLE_SPECS_FILE)
 
-    # Group by groups of animals groups
-    await combine_results(database, image_paths, animals_by_collateral_adjectives)
+    # https://docs.aiohttp.org/en/stable/faq.html#why-is-creating-a-clientsession-outside-of-an-event-loop-dangerous
+    connection_stats = session_factory.ConnectionStats()
+    try:
+        async with session_factory.create_session(connection_stats) as session:
+            # The extra tables (other list pages) are scraped concurrently with the animals table
+            (database, image_paths, grouping, rows_diff), extra_tables = await asyncio.gather(
+                do_io_bound_work(session, scrape_state, journal), table_spec.scrape_tables(extra_specs, session))
+    finally:
+        if journal:
+            journal.close()
+            MAIN_LOGGER.info(f'Checkpoint journal stats: {journal.stats()}')
+    MAIN_LOGGER.info(f'Connections stats: {connection_stats.stats()}')
+
+    if utilties.HTTP_CACHE:
+        MAIN_LOGGER.info(f'HTTP cache stats: {utilties.HTTP_CACHE.stats()}')
+    MAIN_LOGGER.info(f'Retry stats: {retry_policy.DEFAULT_RETRY_POLICY.stats()}')
+
+    if rows_diff is not None:
+        # The reused rows (their stored results) and the added/changed rows are grouped together in the rows order
+        animals_by_collateral_adjectives = scrape_state.merged_grouping(rows_diff, image_paths)
+        if settings.THUMBNAILS_ENABLED:
+            # The images of the reused rows weren't downloaded by this run, so neither were their thumbnails made
+            await image_downloader.create_thumbnails(scrape_state.reused_image_paths(rows_diff))
+    elif grouping is None:
+        # Group by groups of animals groups
+        animals_by_collateral_adjectives = animal_records.AdjectiveIndex()
+        combine_results(database, image_paths, animals_by_collateral_adjectives)
+    else:
+        animals_by_collateral_adjectives = grouping  # the pipeline groups them as their images land
+    MAIN_LOGGER.info(f'Thumbnails stats: {dict(image_downloader.THUMBNAILS_STATS)}')
+
+    if scrape_state is not None and image_paths is not None:
+        scrape_state.update(database, image_paths, rows_diff.unchanged_keys, image_downloader.IMAGELESS_PAGES)
+        scrape_state.save()
 
     await print_results(animals_by_collateral_adjectives)
 
-    # Create an html with all the results (collateral adjective -> [animal+image])
-    await utilties.print_results_to_HTML(animals_by_collateral_adjectives)
+    # Create an html with all the results (collateral adjective -> [animal+image]),
+    # and export them (the exporters' blocking file IO runs in a thread meanwhile)
+    await asyncio.gather(
+        asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(exporters.export_results, animals_by_collateral_adjectives)),
+        utilties.print_results_to_HTML(animals_by_collateral_adjectives, thumbnails=image_downloader.THUMBNAILS),
+        export_extra_tables(extra_tables))
     return
 
 if __name__ == '__main__':
+    arguments_parser = argparse.ArgumentParser(description=__doc__)
+    arguments_parser.add_argument('--resume', action='store_true',
+                                  help='Continue an interrupted scrape, skipping the work recorded in the journal')
+    arguments_parser.add_argument('--crawl', action='store_true',
+                                  help='Crawl the pages linked from the animals list instead (see settings.CRAWL_*)')
+    arguments = arguments_parser.parse_args()
     try:
         start = time.time()
 
         # TODO: Without uvloop , I'm getting an error: "RuntimeError: Event loop is closed" repeatedly
         uvloop.install()  # Optizmied asyncio loop
-        asyncio.run((main()), debug=False)
+        asyncio.run((main(arguments.resume, arguments.crawl)), debug=False)
     finally:
         MAIN_LOGGER.info(f"total time: {time.time() - start}")
+        instrumentation.INSTRUMENTATION.save_report()
@@ -0,0 +1,99 @@
+"""
+Batched MediaWiki API client.
+Resolves the lead image of many pages with a single request (up to MEDIAWIKI_API_BATCH_SIZE titles),
+instead of downloading and parsing every page just to read its "application/ld+json" image field.
+"""
+import json
+import asyncio
+from typing import Dict, Iterable, List
+from urllib.parse import unquote, urlencode
+
+import settings
+import logger
+import utilties
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+WIKI_PATH_PREFIX = '/wiki/'
+
+
+def title_from_href(href: str) -> str:
+    """'/wiki/Red_fox#Diet' -> 'Red fox'"""
+    title = href.split('#')[0]
+    if title.startswith(WIKI_PATH_PREFIX):
+        title = title[len(WIKI_PATH_PREFIX):]
+    return unquote(title).replace('_', ' ')
+
+
+def build_query_uri(titles: List[str], continue_params: dict = None) -> str:
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'formatversion': 2,
+        'redirects': 1,
+        'prop': 'pageimages',
+        'piprop': 'original',
+        'pilimit': settings.MEDIAWIKI_API_BATCH_SIZE,
+        'titles': '|'.join(titles),
+    }
+    params.update(continue_params or {})
+    return f'{settings.MEDIAWIKI_API_URL}?{urlencode(params)}'
+
+
+def parse_query_response(query: dict, titles: List[str]) -> Dict[str, str]:
+    """Map each requested title to its page's original image uri (following normalization and redirects)"""
+    renames = {item['from']: item['to'] for item in query.get('normalized', []) + query.get('redirects', [])}
+    images = {page['title']: page['original']['source'] for page in query.get('pages', []) if 'original' in page}
+
+    resolved = dict()
+    for title in titles:
+        final_title = title
+        # A normalized title may be redirected as well (bounded, in case of a redirects loop)
+        for _ in range(len(renames) + 1):
+            if final_title not in renames:
+                break
+            final_title = renames[final_title]
+        if final_title in images:
+            resolved[title] = images[final_title]
+    return resolved
+
+
+async def resolve_batch(titles: List[str], session, scheduler=None) -> Dict[str, str]:
+    resolved = dict()
+    continue_params = None
+    while True:
+        content = await utilties.retrieve_content(build_query_uri(titles, continue_params), session,
+                                                  scheduler=scheduler)
+        if not content:
+            MODULE_LOGGER.warning(f'Failed to query the MediaWiki API for {len(titles)} titles')
+            break
+        try:
+            response = json.loads(content)
+        except ValueError as e:
+            MODULE_LOGGER.exception(f'Failed to parse the MediaWiki API response: {e}')
+            break
+
+        resolved.update(parse_query_response(response.get('query', {}), titles))
+        if 'continue' not in response:
+            break
+        continue_params = response['continue']
+    return resolved
+
+
+async def resolve_lead_images(hrefs: Iterable[str], session, scheduler=None) -> Dict[str, str]:
+    """
+    Resolve the lead image uri of every '/wiki/...' href, batch by batch (concurrently).
+    Returns href -> image uri, the hrefs the API didn't resolve are missing from the result.
+    """
+    titles_by_href = {href: title_from_href(href) for href in hrefs if href}
+    titles = sorted(set(titles_by_href.values()))  # the same batches (and requests) whatever the hrefs order
+    batches = [titles[i:i + settings.MEDIAWIKI_API_BATCH_SIZE]
+               for i in range(0, len(titles), settings.MEDIAWIKI_API_BATCH_SIZE)]
+
+    resolved = dict()
+    for batch_result in await asyncio.gather(*(resolve_batch(batch, session, scheduler) for batch in batches)):
+        resolved.update(batch_result)
+
+    MODULE_LOGGER.info(f'The MediaWiki API resolved {len(resolved)}/{len(titles)} lead images '
+                       f'using {len(batches)} requests')
+    return {href: resolved[title] for href, title in titles_by_href.items() if title in resolved}
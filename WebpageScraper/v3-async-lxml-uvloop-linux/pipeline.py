@@ -0,0 +1,180 @@
+"""
+Streaming (producer/consumer) scrape pipeline:
+    rows parser -> image uri resolver -> image fetcher -> grouper
+Every stage has its own workers and reads from a bounded asyncio.Queue, so the first images are downloaded
+while the table is still being parsed, and the in-flight work is bounded by the queues sizes (not by the rows count).
+"""
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Iterable
+
+import settings
+import logger
+import animal_records
+import image_downloader
+import incremental
+import checkpoint
+import download_scheduler
+import mediawiki_api
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+STOP = object()  # end of the stream marker, every downstream worker gets one
+
+
+def image_page_of(row: dict) -> str:
+    return row.get(settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX)
+
+
+class ScrapePipeline:
+    def __init__(self, session, scheduler: download_scheduler.DownloadScheduler = None,
+                 scrape_state: incremental.ScrapeState = None, journal: checkpoint.CheckpointJournal = None):
+        self.session = session
+        self.journal = journal
+        self.scheduler = scheduler or download_scheduler.DownloadScheduler()
+        self.scrape_state = scrape_state
+        self.rows_queue = asyncio.Queue(settings.PIPELINE_ROWS_QUEUE_SIZE)  # (index, row)
+        self.images_queue = asyncio.Queue(settings.PIPELINE_IMAGES_QUEUE_SIZE)  # (index, row, image uri)
+        self.results_queue = asyncio.Queue(settings.PIPELINE_RESULTS_QUEUE_SIZE)  # (index, row, image path)
+
+        self.processed = dict()  # row index -> (row, image path)
+        self.queued_indexes = deque()  # the indexes of the rows fed to the pipeline and not grouped yet
+        self.landed = dict()  # row index -> (row, image path), landed before a preceding row (waiting to be grouped)
+        self.grouping = animal_records.AdjectiveIndex()
+        self.batching = asyncio.Lock()  # a single resolver worker takes its batch at a time
+        self.unchanged_keys, self.current_keys = dict(), set()  # incremental mode bookkeeping (key -> row index)
+        self._start = self._parsed_at = self._first_result_at = None
+
+    async def parse_rows(self, rows: Iterable[dict]) -> None:
+        """Stage 1: feed the parsed rows (the iterable may parse them lazily, one row per iteration)"""
+        for index, row in enumerate(rows):
+            if self.scrape_state is not None:
+                key = incremental.row_key(row)
+                self.current_keys.add(key)
+                if self.scrape_state.is_unchanged(row):
+                    self.unchanged_keys[key] = index
+                    continue
+            self.queued_indexes.append(index)
+            await self.rows_queue.put((index, row))
+            await asyncio.sleep(0)  # put() doesn't yield unless the queue is full, let the other stages run
+        self._parsed_at = time.perf_counter()
+
+    async def next_batch(self, queue: asyncio.Queue, size: int) -> list:
+        """
+        The next size items (fewer at the end of the stream).
+        The batches are cut at the same rows on every run (not by the items arrival times), so are the API requests
+        (the HTTP cache keys)
+        """
+        async with self.batching:
+            batch = [await queue.get()]
+            while len(batch) < size and batch[-1] is not STOP:
+                batch.append(await queue.get())
+        return batch
+
+    async def resolve_image_uris(self) -> None:
+        """Stage 2: resolve the image uris of the rows, a single MediaWiki API request per batch of rows"""
+        batch_size = settings.MEDIAWIKI_API_BATCH_SIZE if settings.IMAGE_URI_RESOLVER == 'mediawiki_api' else 1
+        while True:
+            batch = await self.next_batch(self.rows_queue, batch_size)
+            stop = batch[-1] is STOP
+            items = batch[:-1] if stop else batch
+
+            # The animals resolved by an interrupted run (journal) aren't queried again
+            unresolved = [row for _, row in items if not (self.journal and self.journal.resolved_image_uri(
+                row.get(settings.ANIMAL_NAME_COL_KEY)))]
+            image_uris = dict()
+            if unresolved and settings.IMAGE_URI_RESOLVER == 'mediawiki_api':
+                try:
+                    image_uris = await mediawiki_api.resolve_lead_images(
+                        (image_page_of(row) for row in unresolved), self.session, self.scheduler)
+                except Exception as e:
+                    MODULE_LOGGER.exception(f'Failed to resolve a batch of image uris: {e}')
+
+            for index, row in items:
+                # None -> fallback to parsing the animal page
+                await self.images_queue.put((index, row, image_uris.get(image_page_of(row))))
+            if stop:
+                return
+
+    async def fetch_images(self) -> None:
+        """Stage 3: download the images (the scheduler bounds the requests actually in flight)"""
+        while (item := await self.images_queue.get()) is not STOP:
+            index, row, image_uri = item
+            image_path = None
+            try:
+                image_path = await image_downloader.download_animal_image(
+                    uri=f'{settings.BASE_URL}{image_page_of(row)}',
+                    animal_name=row[settings.ANIMAL_NAME_COL_KEY],
+                    session=self.session,
+                    scheduler=self.scheduler,
+                    image_uri=image_uri,
+                    journal=self.journal)
+            except Exception as e:
+                MODULE_LOGGER.exception(f'Failed to download the image of {row.get(settings.ANIMAL_NAME_COL_KEY)}: {e}')
+            await self.results_queue.put((index, row, image_path))
+
+    async def group_results(self) -> None:
+        """
+        Stage 4: group the animals as their images land.
+        The images land in any order, so a row waits (in landed) until the rows before it are grouped:
+        the groups and their members are in the rows order, as when the whole table is grouped at once
+        """
+        while (item := await self.results_queue.get()) is not STOP:
+            index, row, image_path = item
+            self._first_result_at = self._first_result_at or time.perf_counter()
+            self.processed[index] = self.landed[index] = (row, image_path)
+            ready = []
+            while self.queued_indexes and self.queued_indexes[0] in self.landed:
+                ready.append(self.landed.pop(self.queued_indexes.popleft()))
+            if ready:
+                animal_records.group_records((row for row, _ in ready), settings.ANIMAL_NAME_COL_KEY,
+                                             settings.COLATERAL_COLLECTIVES_COL,
+                                             values=(image_path for _, image_path in ready), grouping=self.grouping)
+
+    async def run_stage(self, worker: Callable, workers: int, output_queue: asyncio.Queue = None,
+                        downstream_workers: int = 0) -> None:
+        """Run the workers of a stage, then tell the downstream workers the stream has ended"""
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        for _ in range(downstream_workers):
+            await output_queue.put(STOP)
+
+    async def run(self, rows: Iterable[dict]):
+        """
+        Stream the rows through the pipeline.
+        Returns the processed rows, their image paths, their grouping and the rows diff (None when not incremental)
+        """
+        if rows is None:
+            MODULE_LOGGER.critical('No table rows to process')
+            rows = ()
+
+        self._start = time.perf_counter()
+        stages = [asyncio.create_task(stage) for stage in (
+            self.run_stage(lambda: self.parse_rows(rows), 1, self.rows_queue, settings.PIPELINE_RESOLVER_WORKERS),
+            self.run_stage(self.resolve_image_uris, settings.PIPELINE_RESOLVER_WORKERS,
+                           self.images_queue, settings.PIPELINE_FETCHER_WORKERS),
+            self.run_stage(self.fetch_images, settings.PIPELINE_FETCHER_WORKERS, self.results_queue, 1),
+            self.run_stage(self.group_results, 1),
+        )]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            raise
+        finally:
+            MODULE_LOGGER.info(f'Download scheduler stats: {self.scheduler.stats()}')
+            MODULE_LOGGER.info(f'Images store stats: {image_downloader.IMAGE_STORE.stats()}')
+
+        if self._first_result_at and self._parsed_at:
+            MODULE_LOGGER.info(f'Pipeline: table parsed after {self._parsed_at - self._start:.3f}s, '
+                               f'first image after {self._first_result_at - self._start:.3f}s, '
+                               f'done after {time.perf_counter() - self._start:.3f}s')
+
+        indexes = sorted(self.processed)
+        database = [self.processed[index][0] for index in indexes]
+        image_paths = [self.processed[index][1] for index in indexes]
+        rows_diff = None
+        if self.scrape_state is not None:
+            rows_diff = self.scrape_state.rows_diff(database, indexes, self.unchanged_keys, self.current_keys)
+        return database, image_paths, self.grouping, rows_diff
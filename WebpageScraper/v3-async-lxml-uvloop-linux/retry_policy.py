@@ -0,0 +1,145 @@
+"""Retry engine for the web requests (jittered exponential backoff, Retry-After support and a per-request deadline)"""
+import time
+import random
+import asyncio
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Union
+
+import settings
+import logger
+import instrumentation
+
+import aiohttp
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+# Transient network failures, worth another attempt
+RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def parse_retry_after(value: str) -> Union[None, float]:
+    """The Retry-After header is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Deadline:
+    """
+    The time budget of a request (all its attempts and backoff sleeps together).
+    Only the attempts run through run() are charged, so the time spent waiting for a download slot
+    (behind the other downloads) doesn't count against it
+    """
+
+    def __init__(self, seconds: float):
+        self.remaining = seconds
+
+    async def run(self, awaitable: Awaitable):
+        start = time.monotonic()
+        try:
+            return await asyncio.wait_for(awaitable, timeout=max(0.0, self.remaining))
+        finally:
+            self.remaining -= time.monotonic() - start
+
+    async def sleep(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.remaining -= delay
+
+
+class RetryPolicy:
+    """
+    Decides whether (and when) a request is sent again.
+    The number of attempts and the total time spent (including the backoff sleeps) of the requests are aggregated
+    (nothing is kept per URI, a crawl of any size uses the same memory), so their tail latency can be measured.
+    """
+
+    def __init__(self, max_attempts: int = settings.RETRY_MAX_ATTEMPTS,
+                 retry_statuses=settings.RETRY_STATUSES,
+                 retry_exceptions=RETRYABLE_EXCEPTIONS,
+                 backoff_base: float = settings.RETRY_BACKOFF_BASE,
+                 backoff_max: float = settings.RETRY_BACKOFF_MAX,
+                 deadline: float = settings.RETRY_DEADLINE,
+                 respect_retry_after: bool = settings.RETRY_RESPECT_RETRY_AFTER):
+        self.max_attempts = max_attempts
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.respect_retry_after = respect_retry_after
+
+        self.attempts = Counter()  # number of attempts -> number of requests
+        self.elapsed = instrumentation.Histogram(settings.RETRY_ELAPSED_BUCKETS)  # first attempt -> final result
+
+    def backoff(self, attempt: int, retry_after: str = None) -> float:
+        """Full jitter exponential backoff, unless the server told us how long to wait"""
+        if self.respect_retry_after:
+            delay = parse_retry_after(retry_after)
+            if delay is not None:
+                return delay
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    async def call(self, uri: str, attempt: Callable[[Callable[[Awaitable], Awaitable]], Awaitable]):
+        """
+        Await attempt(within_deadline) until it returns a non retryable response (anything with .status and
+        .headers), the attempts are exhausted or the deadline is reached.
+        The attempt runs the request itself through `await within_deadline(request)` (e.g. once it holds its
+        download slot), which times it out when the deadline is reached.
+        The last response is returned, or the last exception is raised.
+        """
+        start = time.monotonic()
+        deadline = Deadline(self.deadline)
+        attempt_number = 0
+        try:
+            for attempt_number in range(1, self.max_attempts + 1):
+                retry_after = None
+                try:
+                    response = await attempt(deadline.run)
+                except self.retry_exceptions as e:
+                    if attempt_number == self.max_attempts:
+                        raise
+                    MODULE_LOGGER.warning(f'Attempt {attempt_number} to retrieve {uri} failed: {e!r}')
+                    response = None
+                else:
+                    if response.status not in self.retry_statuses or attempt_number == self.max_attempts:
+                        return response
+                    MODULE_LOGGER.warning(f'Attempt {attempt_number} to retrieve {uri} failed: '
+                                          f'Error code:{response.status}')
+                    retry_after = response.headers.get('Retry-After')
+
+                delay = self.backoff(attempt_number, retry_after)
+                if delay >= deadline.remaining:
+                    MODULE_LOGGER.warning(f'Giving up on {uri}, the deadline ({self.deadline}s) would be exceeded')
+                    if response is None:
+                        raise asyncio.TimeoutError(f'Deadline exceeded for {uri}')
+                    return response
+                await deadline.sleep(delay)
+        finally:
+            self.attempts[attempt_number] += 1
+            self.elapsed.observe(time.monotonic() - start)
+
+    def stats(self) -> dict:
+        """The percentiles are the upper bounds of the RETRY_ELAPSED_BUCKETS holding them"""
+        if not self.elapsed.count:
+            return {}
+        return {
+            'requests': self.elapsed.count,
+            'retried_requests': sum(requests for attempts, requests in self.attempts.items() if attempts > 1),
+            'total_attempts': sum(attempts * requests for attempts, requests in self.attempts.items()),
+            'max_attempts': max(self.attempts),
+            'elapsed_p50': round(self.elapsed.quantile(0.5), 3),
+            'elapsed_p95': round(self.elapsed.quantile(0.95), 3),
+            'elapsed_p99': round(self.elapsed.quantile(0.99), 3),
+            'elapsed_max': round(self.elapsed.max, 3),
+        }
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
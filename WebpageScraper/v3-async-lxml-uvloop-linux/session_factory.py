@@ -0,0 +1,187 @@
+"""
+Creation of the shared HTTP session (a single one for all the web requests).
+The aiohttp connector is tuned (connections pool limits, DNS cache, keep-alive and timeouts),
+and a TraceConfig counts the new vs reused connections so connection churn can be measured.
+An HTTP/2 client (httpx, optional dependency) can be used instead, behind the same interface.
+"""
+import time
+import socket
+import asyncio
+import contextlib
+from collections import Counter
+from urllib.parse import urlsplit
+
+import settings
+import logger
+
+import aiohttp
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+AIOHTTP_CLIENT = 'aiohttp'
+HTTPX_CLIENT = 'httpx'
+
+
+class ConnectionStats:
+    """New vs reused connections (per host), and the time spent waiting for a free connection in the pool"""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.created = Counter()
+        self.reused = Counter()
+        self.queued = 0
+        self.queued_time = 0.0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+        return trace_config
+
+    def count_request(self, host: str, new_connection: bool) -> None:
+        self.requests[host] += 1
+        (self.created if new_connection else self.reused)[host] += 1
+
+    # The trace context (a SimpleNamespace) is shared by the signals of the same request
+    async def _on_request_start(self, session, context, params) -> None:
+        context.host = params.url.host
+        self.requests[context.host] += 1
+
+    async def _on_connection_create_end(self, session, context, params) -> None:
+        self.created[context.host] += 1
+
+    async def _on_connection_reuseconn(self, session, context, params) -> None:
+        self.reused[context.host] += 1
+
+    async def _on_connection_queued_start(self, session, context, params) -> None:
+        context.queued_at = time.perf_counter()
+
+    async def _on_connection_queued_end(self, session, context, params) -> None:
+        self.queued += 1
+        self.queued_time += time.perf_counter() - context.queued_at
+
+    def stats(self) -> dict:
+        per_host = {host: {'requests': self.requests[host],
+                           'connections_created': self.created[host],
+                           'connections_reused': self.reused[host]}
+                    for host in self.requests}
+        created = sum(self.created.values())
+        return {
+            'requests': sum(self.requests.values()),
+            'connections_created': created,
+            'connections_reused': sum(self.reused.values()),
+            'requests_per_connection': round(sum(self.requests.values()) / created, 2) if created else None,
+            'queued_for_connection': self.queued,
+            'queued_time': round(self.queued_time, 3),
+            'per_host': per_host,
+        }
+
+
+def create_aiohttp_session(connection_stats: ConnectionStats = None) -> aiohttp.ClientSession:
+    # Note: aiohttp always sets TCP_NODELAY on its connections (SESSION_TCP_NODELAY applies to the httpx client)
+    connector = aiohttp.TCPConnector(
+        limit=settings.SESSION_CONNECTIONS_LIMIT,
+        limit_per_host=settings.SESSION_CONNECTIONS_LIMIT_PER_HOST,
+        use_dns_cache=True,
+        ttl_dns_cache=settings.SESSION_DNS_CACHE_TTL,
+        keepalive_timeout=settings.SESSION_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=settings.SESSION_TOTAL_TIMEOUT,
+                                    connect=settings.SESSION_CONNECT_TIMEOUT,
+                                    sock_read=settings.SESSION_READ_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                 trace_configs=[connection_stats.trace_config()] if connection_stats else None)
+
+
+#####################################################
+# HTTP/2 client (settings.SESSION_CLIENT == HTTPX_CLIENT)
+# Only the subset of the aiohttp interface used by the scraper is implemented:
+#   session.headers, `async with session.request(method, uri, headers=...) as response`,
+#   response.status, response.headers, await response.read(), response.content.iter_chunked(size)
+# The httpx errors are raised as their aiohttp counterparts, so the retry policy handles them the same way
+
+@contextlib.contextmanager
+def aiohttp_errors():
+    import httpx
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise asyncio.TimeoutError(str(e)) from e
+    except httpx.TransportError as e:
+        raise aiohttp.ClientConnectionError(str(e)) from e
+
+
+class HttpxResponse:
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        self.content = self  # response.content.iter_chunked(...)
+
+    async def read(self) -> bytes:
+        with aiohttp_errors():
+            return await self._response.aread()
+
+    async def iter_chunked(self, chunk_size: int):
+        with aiohttp_errors():
+            async for chunk in self._response.aiter_bytes(chunk_size):
+                yield chunk
+
+
+class HttpxSession:
+    def __init__(self, connection_stats: ConnectionStats = None):
+        import httpx  # optional dependency (pip install httpx[http2])
+
+        socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(settings.SESSION_TCP_NODELAY))]
+        self._client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=settings.SESSION_CONNECTIONS_LIMIT or None,
+                                max_keepalive_connections=settings.SESSION_CONNECTIONS_LIMIT or None,
+                                keepalive_expiry=settings.SESSION_KEEPALIVE_TIMEOUT),
+            timeout=httpx.Timeout(settings.SESSION_READ_TIMEOUT, connect=settings.SESSION_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(http2=True, socket_options=socket_options),
+        )
+        self.headers = self._client.headers
+        self.connection_stats = connection_stats
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, uri: str, headers: dict = None):
+        host = urlsplit(uri).hostname
+        new_connection = False
+
+        async def trace(event_name: str, info: dict) -> None:
+            # httpcore's trace events, a new connection starts with a TCP connect
+            nonlocal new_connection
+            new_connection = new_connection or event_name == 'connection.connect_tcp.complete'
+
+        with aiohttp_errors():
+            async with self._client.stream(method, uri, headers=headers, extensions={'trace': trace}) as response:
+                if self.connection_stats:
+                    self.connection_stats.count_request(host, new_connection)
+                yield HttpxResponse(response)
+
+    def get(self, uri: str, headers: dict = None):
+        return self.request('GET', uri, headers)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def __aenter__(self) -> 'HttpxSession':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+def create_session(connection_stats: ConnectionStats = None):
+    """The shared HTTP session, according to settings.SESSION_CLIENT (use it as an async context manager)"""
+    if settings.SESSION_CLIENT == HTTPX_CLIENT:
+        try:
+            return HttpxSession(connection_stats)
+        except ImportError:
+            MODULE_LOGGER.warning('httpx (with HTTP/2 support) is not installed, falling back to aiohttp')
+    return create_aiohttp_session(connection_stats)
@@ -1,7 +1,9 @@
 """ App settings/Configuration """
+import os
 import logging
 import tempfile
 from pathlib import Path
+from urllib.parse import urlsplit
 
 # Logger related settings
 CWD = Path.cwd()
@@ -10,16 +12,25 @@ LOG_FILE_PATH = Path(CWD,'log.txt')
 LOG_FILE_MAX_SIZE = 1 * 1024 * 1024  # in bytes , 1MB
 LOG_BACKUP_COUNT = 5  # TODO: is it critical to allow backup files if size limit exceeds?
 LOGGING_FORMAT_STRING = '%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s'
+LOG_SAMPLE_EVERY = 10  # high volume debug lines (e.g. per image) are logged once every N calls
 # LOGGING_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 # HTML, pages, and tables structure settings
 USER_AGENT = 'Mozilla/5.0'
 # USER_AGENTS = ['Mozilla/5.0', '(Macintosh; Intel Mac OS X 10_9_3)', 'AppleWebKit/537.36','Safari/537.36']
-WEBPAGE_PARSER = "lxml" # an optimization for faster parsing ,3rd party library (lxml)
-BASE_URL = 'https://en.wikipedia.org'
+# The main table parser: a bs4 tree builder ("lxml" is an optimization for faster parsing, 3rd party library)
+# or LXML_NATIVE_PARSER - lxml.html + XPath directly, without building a BeautifulSoup tree (several times faster)
+LXML_NATIVE_PARSER = 'lxml-xpath'
+WEBPAGE_PARSER = LXML_NATIVE_PARSER
+BS4_TREE_BUILDER = 'lxml' if WEBPAGE_PARSER == LXML_NATIVE_PARSER else WEBPAGE_PARSER  # the other pages (bs4)
+BASE_URL = os.environ.get('SCRAPER_BASE_URL', 'https://en.wikipedia.org')  # overridden by the benchmarks
 LINK_SUFFIX = '_href'
 ANIMALS_PAGE_URL = f'{BASE_URL}/wiki/List_of_animal_names'
-TABLE_XPATH = 'table', {'class': 'wikitable sortable'}
+# The main table locator: the tables having (at least) these classes, whatever their order and the other classes
+MAIN_TABLE_CLASSES = ('wikitable', 'sortable')
+MAIN_TABLE_CSS_SELECTOR = 'table' + ''.join(f'.{name}' for name in MAIN_TABLE_CLASSES)  # for bs4
+MAIN_TABLE_XPATH = '//table' + ''.join(  # the same locator, for the lxml native parser
+    f'[contains(concat(" ", normalize-space(@class), " "), " {name} ")]' for name in MAIN_TABLE_CLASSES)
 COLATERAL_COLLECTIVES_COL = "Collateral adjective"
 ANIMAL_NAME_COL_KEY = "Animal"
 COL_WITH_IMAGE_KEY = ANIMAL_NAME_COL_KEY
@@ -28,19 +39,170 @@ KEYS_OF_INTEREST = ANIMAL_NAME_COL_KEY, COLATERAL_COLLECTIVES_COL
 RELEVANT_TABLE = -1  # There are two tables on the page; we need the 2nd one
                     #TODO: Identify the relevant table by a unique identifier
 FIRST_DATA_ROW_INDEX = 1
+# The main table, declared as a table spec (see table_spec.py)
+ANIMALS_TABLE_SPEC = {
+    'name': 'animals',
+    'url': ANIMALS_PAGE_URL,
+    'table_xpath': MAIN_TABLE_XPATH,
+    'table_index': RELEVANT_TABLE,
+    'first_data_row': FIRST_DATA_ROW_INDEX,
+    'columns': KEYS_OF_INTEREST,
+    'multi_valued': tuple(key for key in KEYS_OF_INTEREST if key not in COLS_WITH_SINGLE_VALUES),
+    'link_columns': (COL_WITH_IMAGE_KEY,),
+    'key_column': ANIMAL_NAME_COL_KEY,
+    'group_by': COLATERAL_COLLECTIVES_COL,
+}
+# More tables (specs dicts, or a JSON/YAML file of specs) scraped concurrently with the animals table,
+# their rows are grouped by their group_by column (or columns list) and exported (see EXPORT_FORMATS), e.g.
+# {'name': 'dinosaurs', 'url': '/wiki/List_of_dinosaur_genera', 'table_xpath': '//table[contains(@class, "wikitable")]',
+#  'table_index': 0, 'columns': '*', 'multi_valued': ('Period',), 'key_column': 'Genus', 'group_by': 'Period'}
+EXTRA_TABLE_SPECS = ()
+EXTRA_TABLE_SPECS_FILE = None
 NO_VALUE = '?'
 
+# Table rows parsing (the 'staged' SCRAPE_MODE): 'sequential' (on the event loop) or 'process_pool' (off the loop):
+#   the bs4 parsers split the rows among the CPU offload workers (table_parser.parse_page_in_process_pool),
+#   the (several times faster) LXML_NATIVE_PARSER parses the whole page in the CPU offload pool (CPU_OFFLOAD_MODE)
+# The 'pipeline' SCRAPE_MODE parses the lxml rows lazily on the event loop instead, a row at a time between the
+# downloads: each row blocks the loop for tens of microseconds only, and the first images start right away
+TABLE_PARSING_MODE = 'process_pool'
+TABLE_PARSER_CHUNKS_PER_WORKER = 4
+
+# How the rows are processed:
+#   'staged' - parse the whole table, then download all the images, then group the results
+#   'pipeline' - stream the rows through bounded queues (parse -> resolve image uri -> download -> group)
+SCRAPE_MODE = 'pipeline'
+PIPELINE_ROWS_QUEUE_SIZE = 100  # parsed rows waiting for their image uri
+PIPELINE_IMAGES_QUEUE_SIZE = 100  # resolved rows waiting for their image download
+PIPELINE_RESULTS_QUEUE_SIZE = 100  # downloaded images waiting to be grouped
+PIPELINE_RESOLVER_WORKERS = 2
+PIPELINE_FETCHER_WORKERS = 32  # the download scheduler still bounds the requests in flight
+
 # Printing results to HTML format
 OUTPUT_HTML_FILE = Path(CWD,'output.html')
 OUTPUT_HTML_FILE_TEMPLATE = Path(CWD,'output_template.html')
 IMAGE_HTML_WIDTH = 500
+# Exports of the grouped results for the downstream jobs (see exporters.py), 'parquet' requires pyarrow
+EXPORT_FORMATS = ('jsonl', 'csv', 'sqlite')  # any of: 'jsonl', 'csv', 'sqlite', 'parquet'
+EXPORT_DIR = Path(CWD, 'exports')
+EXPORT_FILE_NAME = 'animals_by_collateral_adjective'
+EXPORT_BATCH_SIZE = 1000  # records per write (per SQLite transaction, per Parquet row group)
+HTML_WRITE_BUFFER_SIZE = 64 * 1024  # in characters, the page is streamed to the file in chunks of this size
 
 # Image related settings
 IMAGES_FOLDER_SYMLINK = Path(CWD,'images')
-SAVED_IMAGES_DIR = Path(tempfile.gettempdir()) # For production
+SAVED_IMAGES_DIR = Path(os.environ.get('SCRAPER_IMAGES_DIR', tempfile.gettempdir())) # For production
 # SAVED_IMAGES_DIR = Path(CWD,'tmp') # For development
+# Images are stored by content (<sha256>.<extension>), the manifest maps animal -> source URL -> hash -> extension
+IMAGES_MANIFEST_PATH = Path(SAVED_IMAGES_DIR, 'images_manifest.sqlite3')
+# Thumbnails (derivatives) of the saved images, the HTML page references them instead of the originals
+THUMBNAILS_ENABLED = True
+THUMBNAILS_DIR = Path(SAVED_IMAGES_DIR, 'thumbnails')
+THUMBNAIL_WIDTH = IMAGE_HTML_WIDTH  # in pixels, the smaller images aren't upscaled
+THUMBNAIL_FORMAT = 'webp'  # or 'jpeg' (where PIL is built without WebP support)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WEBP_METHOD = 2  # 0 (fastest) - 6 (smallest), 2 encodes ~2x faster than the default 4, ~10% bigger
 
 
 # Images files, OS restrictions
 PATHNAME_STUB_SYMBOL = '_'
+TEXT_NORMALIZATION_CACHE_SIZE = 8192  # memoized cells texts (the cells values repeat a lot), None for unbounded
 REWRITE_EXISTING_IMAGE_FILES = False
+# How REWRITE_EXISTING_IMAGE_FILES checks the stored images against their upstream versions
+# (the manifest keeps their ETag / Last-Modified / Content-Length), only the changed images are downloaded again:
+#   'conditional_get' - a GET with If-None-Match / If-Modified-Since, an unchanged image is a body-less 304
+#   'head' - a HEAD request compared with the stored validators (for servers ignoring the conditional headers)
+#   None - download every image again
+IMAGE_REVALIDATION = 'conditional_get'
+# How the image uri of every animal is found:
+#   'html' - download each animal page and read its "application/ld+json" image field
+#   'mediawiki_api' - batched MediaWiki API queries (pageimages), falling back to 'html' for the unresolved titles
+IMAGE_URI_RESOLVER = 'mediawiki_api'
+MEDIAWIKI_API_URL = f'{BASE_URL}/w/api.php'
+MEDIAWIKI_API_BATCH_SIZE = 50  # titles per request (the API limit for regular users)
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024  # in bytes, images are streamed to disk chunk by chunk
+PARTIAL_DOWNLOAD_SUFFIX = '.part'  # downloads in progress, renamed to the final name once completed
+
+VALIDATE_IMAGES_CONTENT = True  # decode the downloaded images (PIL verify) besides checking their header
+
+# CPU-bound work (animal pages parsing, images validation) offloading:
+#   'thread' - a ThreadPoolExecutor (bs4 and PIL release the GIL only partially, but the loop stays responsive)
+#   'process' - a ProcessPoolExecutor (true parallelism, pays for pickling the pages to the workers)
+#   'inline' - on the event loop (blocks every in-flight download while running)
+CPU_OFFLOAD_MODE = 'process' if (os.cpu_count() or 1) > 1 else 'thread'  # a single core can't parse in parallel
+CPU_OFFLOAD_WORKERS = os.cpu_count() or 1
+CPU_OFFLOAD_MAX_IN_FLIGHT = 2 * CPU_OFFLOAD_WORKERS  # submitted jobs, the rest wait (without blocking the loop)
+
+# Checkpoints: every animal's progress is appended to a journal, `main.py --resume` continues from it
+CHECKPOINT_ENABLED = True
+CHECKPOINT_JOURNAL_PATH = Path(CWD, 'scrape_journal.jsonl')
+
+# Incremental mode: only the table rows added/changed since the previous run are processed
+INCREMENTAL_MODE = False
+INCREMENTAL_STATE_FILE = Path(CWD, 'scrape_state.json')
+
+# Crawl mode (`main.py --crawl`): follow the links of the animals list page (taxon pages, "see also" lists, ...)
+# and of the pages they link to. The frontier (the URLs to visit and the visited ones) is kept in a SQLite database,
+# so the memory doesn't grow with the crawl, and a paused (interrupted) crawl continues with `main.py --crawl --resume`
+CRAWL_SEEDS = (ANIMALS_PAGE_URL,)
+CRAWL_MAX_DEPTH = 2  # links away from the seeds (the seeds are at depth 0)
+CRAWL_MAX_PAGES = 50000  # visited pages per crawl, the pages visited before a pause count as well
+CRAWL_WORKERS = 16  # pages fetched concurrently
+CRAWL_ALLOWED_HOSTS = (urlsplit(BASE_URL).hostname,)
+CRAWL_URL_PATTERN = r'^/wiki/[^:?#]+$'  # the followed URLs (path and query): articles, no File:/Special:/Talk: pages
+CRAWL_PRIORITY_PATTERN = r'^/wiki/List_of_'  # these pages are visited before the other pages of their depth
+CRAWL_LINKS_XPATH = '//div[@id="mw-content-text"]//a/@href'  # the article body, not the navigation links
+CRAWL_RATE_PER_HOST = 10  # requests per second (politeness, instead of SCHEDULER_RATE_PER_HOST)
+CRAWL_MAX_CONCURRENCY_PER_HOST = 4  # (instead of SCHEDULER_MAX_CONCURRENCY_PER_HOST)
+CRAWL_FRONTIER_PATH = Path(CWD, 'crawl_frontier.sqlite3')
+CRAWL_PAGES_DIR = Path(CWD, 'crawled_pages')  # the visited pages are saved as <sha256 of the url>.html, None to not
+# The seen URLs are deduplicated by a Bloom filter in front of the frontier database (its positives are confirmed
+# by the database): 8M bits (1MB) and 6 hashes have ~2% false positives at 1M URLs
+CRAWL_BLOOM_FILTER_BITS = 8 * 1024 * 1024
+CRAWL_BLOOM_FILTER_HASHES = 6
+
+# The shared HTTP session settings
+SESSION_CLIENT = 'aiohttp'  # or 'httpx' - an HTTP/2 client (optional dependency: pip install httpx[http2])
+SESSION_CONNECTIONS_LIMIT = 100  # open connections, all hosts together (0 means no limit)
+SESSION_CONNECTIONS_LIMIT_PER_HOST = 32  # 0 means no limit (the download scheduler bounds the requests anyway)
+SESSION_DNS_CACHE_TTL = 300  # in seconds, the resolved hosts are cached (few hosts, many requests)
+SESSION_KEEPALIVE_TIMEOUT = 30.0  # in seconds, idle connections are kept open for reuse
+SESSION_TOTAL_TIMEOUT = None  # in seconds, per request (None: bounded by the retry policy deadline instead)
+SESSION_CONNECT_TIMEOUT = 10.0  # in seconds, including the wait for a free connection in the pool
+SESSION_READ_TIMEOUT = 30.0  # in seconds, between two reads of the response
+SESSION_TCP_NODELAY = True  # aiohttp always enables it, configurable for the httpx client only
+
+# Instrumentation: per stage latency histograms and the event loop lag, reported at exit
+INSTRUMENTATION_ENABLED = True
+INSTRUMENTATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # in seconds
+INSTRUMENTATION_BLOCKING_THRESHOLD = 0.1  # in seconds, longer blocking (sync) stages are logged as warnings
+INSTRUMENTATION_LOOP_LAG_INTERVAL = 0.01  # in seconds, how often the event loop lag is sampled
+INSTRUMENTATION_REPORT_PATH = Path(CWD, 'instrumentation.json')
+INSTRUMENTATION_PROMETHEUS_PATH = Path(CWD, 'instrumentation.prom')
+
+# Web pages (GET requests) cache settings
+HTTP_CACHE_ENABLED = True
+HTTP_CACHE_DIR = Path(CWD, '.http_cache')
+HTTP_CACHE_TTL = 24 * 60 * 60  # in seconds, stale entries are revalidated (conditional GET) rather than re-downloaded
+HTTP_CACHE_MAX_SIZE = 200 * 1024 * 1024  # in bytes, 200MB. Least recently used entries are evicted first
+
+# Download scheduler settings (bounded concurrency, per-host rate limiting and AIMD backoff)
+SCHEDULER_MAX_CONCURRENCY = 64  # in-flight requests, all hosts together
+SCHEDULER_INITIAL_CONCURRENCY_PER_HOST = 8
+SCHEDULER_MIN_CONCURRENCY_PER_HOST = 1
+SCHEDULER_MAX_CONCURRENCY_PER_HOST = 32
+SCHEDULER_ADDITIVE_INCREASE = 1.0  # window increment per a full window of successful responses
+SCHEDULER_MULTIPLICATIVE_DECREASE = 0.5  # window factor on congestion
+SCHEDULER_RATE_PER_HOST = 50  # requests per second (token bucket refill rate)
+SCHEDULER_BURST_PER_HOST = 10  # token bucket capacity
+SCHEDULER_LATENCY_THRESHOLD = 10.0  # in seconds, slower responses are treated as a congestion signal
+SCHEDULER_CONGESTION_STATUSES = (429, 403, 503)  # Too Many Requests, Forbidden (throttling), Service Unavailable
+
+# Retry policy of the web requests
+RETRY_MAX_ATTEMPTS = 4
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_BASE = 0.5  # in seconds, the backoff "ceiling" doubles on every attempt (full jitter below it)
+RETRY_BACKOFF_MAX = 30.0  # in seconds
+RETRY_DEADLINE = 120.0  # in seconds, per request (all attempts and backoff sleeps together, not the wait for a slot)
+RETRY_RESPECT_RETRY_AFTER = True
+RETRY_ELAPSED_BUCKETS = INSTRUMENTATION_BUCKETS + (30.0, 60.0, 120.0)  # in seconds, the requests durations histogram
@@ -0,0 +1,227 @@
+"""
+Parsing of the main table rows.
+Rows can be parsed sequentially (on the event loop) or shipped as raw HTML to a pool of worker processes,
+since these are CPU-bound tasks which block every in-flight download while they run.
+The lxml native backend skips BeautifulSoup altogether and produces the same rows with XPath queries.
+What is parsed is declared by a table spec (see table_spec.py), compiled once per table into the columns
+(cell index -> key) the rows parsers visit.
+"""
+import re
+import asyncio
+from typing import Iterator, List, Sequence, Tuple, Union
+
+import settings
+import logger
+import utilties
+import instrumentation
+import cpu_offload
+import text_normalization
+
+import bs4
+import lxml.html
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+
+# Note: The columns are the spec compiled against the table headers (table_spec.TableSpec.compile),
+#       the cells of interest are picked by their index, the other cells aren't even looked at
+#       A row is parsed in microseconds: the whole table parse is timed (parse_table), timing every row would cost more
+def parse_row(row, columns=None):
+    row_cells = row.find_all('td')  # get the cells of the current row
+    if len(row_cells) == 0:
+        return None     # Skip a capital letter row with no data (it's a special header)
+
+    current_row_columns = dict()  # a dict to store the data of the current row
+    for column in columns:
+        if column.index >= len(row_cells):
+            break  # the columns are in the cells order
+        value = row_cells[column.index]
+        value_text = value.text
+        if value_text.strip() == settings.NO_VALUE:
+            continue  # an unknown value
+        cell_data = utilties.parse_table_cell(value, value_text)
+        if cell_data == None:
+            continue
+        current_row_columns[column.key] = cell_data if column.multi_valued else cell_data[0]
+
+        if column.link:
+            # Look for a link to the image or page that contains the image (exists for all animals).
+            if image_page := value.find('a', href=True):
+                image_page = image_page['href']
+                current_row_columns[column.link] = image_page if image_page else None
+    return current_row_columns
+
+
+# Used to cut the raw page text into rows without building a tree of the whole page
+TABLE_START_PATTERN = re.compile(r'<table\b[^>]*>', re.IGNORECASE)
+CLASS_ATTRIBUTE_PATTERN = re.compile(r'''\sclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+TABLE_END_PATTERN = re.compile(r'</table\s*>', re.IGNORECASE)
+NESTED_TABLE_PATTERN = re.compile(r'<table\b', re.IGNORECASE)
+ROW_START_PATTERN = re.compile(r'<tr\b', re.IGNORECASE)
+
+
+def has_classes(start_tag: str, classes: Sequence[str]) -> bool:
+    """Whether the start tag has all the classes (the rule of MAIN_TABLE_XPATH and MAIN_TABLE_CSS_SELECTOR)"""
+    attribute = CLASS_ATTRIBUTE_PATTERN.search(start_tag)
+    return attribute is not None and set(classes) <= set(''.join(attribute.groups('')).split())
+
+
+def split_table_rows(page: str, table_index: int = settings.RELEVANT_TABLE,
+                     classes: Sequence[str] = settings.MAIN_TABLE_CLASSES) -> Union[None, List[str]]:
+    """
+    Cut the raw HTML of the relevant table (the table_index-th table having the classes) into rows,
+    by text search only. None is returned when it can't be done safely (no such table, or nested tables).
+    """
+    tables = [match for match in TABLE_START_PATTERN.finditer(page) if has_classes(match.group(), classes)]
+    if not tables:
+        return None
+    start = tables[table_index].end()
+    end = TABLE_END_PATTERN.search(page, start)
+    if not end or NESTED_TABLE_PATTERN.search(page, start, end.start()):
+        return None
+
+    rows_starts = [match.start() for match in ROW_START_PATTERN.finditer(page, start, end.start())]
+    return [page[row_start:row_end] for row_start, row_end in zip(rows_starts, rows_starts[1:] + [end.start()])]
+
+
+def parse_rows_html(rows_html: List[str], columns: tuple) -> list:
+    """
+    Worker process entry point.
+    Rebuild the rows from their raw HTML (a bs4 Tag can't be sent to another process) and parse them.
+    """
+    table = bs4.BeautifulSoup(f'<table>{"".join(rows_html)}</table>', settings.BS4_TREE_BUILDER)
+    return [parse_row(row, columns) for row in table.find_all('tr')]
+
+
+def parse_table_headers(header_row_html: str) -> Tuple[str, ...]:
+    header_row = bs4.BeautifulSoup(f'<table>{header_row_html}</table>', settings.BS4_TREE_BUILDER).find('tr')
+    return tuple(h.text.strip() for h in header_row.find_all('th'))  # coloumns "names"
+
+
+def split_to_chunks(items: list, chunks_count: int) -> List[list]:
+    chunk_size = max(1, -(-len(items) // chunks_count))  # ceiling division
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+async def parse_page_in_process_pool(page_content: bytes, spec,
+                                     offload: cpu_offload.CpuOffload = None) -> Union[None, list]:
+    """
+    Parse the rows of the main table in the CPU offload pool (the order of the rows is preserved), its worker
+    processes are started once per run (not per page).
+    The event loop only cuts the raw page text into rows, the workers build the (small) trees and parse them.
+    None is returned when the table can't be cut into rows, the caller should fall back to the sequential parsing.
+    """
+    rows_html = split_table_rows(page_content.decode('utf-8', errors='replace'), spec.table_index)
+    if not rows_html:
+        MODULE_LOGGER.warning('Failed to split the main table into rows')
+        return None
+
+    columns = spec.compile(parse_table_headers(rows_html[0]))
+    data_rows_html = rows_html[spec.first_data_row:]
+    offload = offload or cpu_offload.CPU_OFFLOAD
+    # Few chunks per worker (balances the load while keeping the inter-process overhead low)
+    chunks = split_to_chunks(data_rows_html, offload.workers * settings.TABLE_PARSER_CHUNKS_PER_WORKER)
+
+    async with instrumentation.timer('parse_page_offloaded'):  # the workers' timings aren't recorded
+        parsed_chunks = await asyncio.gather(*(offload.run(parse_rows_html, chunk, columns) for chunk in chunks))
+
+    MODULE_LOGGER.debug('Parsed %d rows in %d chunks using %d %s workers',
+                        len(data_rows_html), len(chunks), offload.workers, offload.mode)
+    return [parsed_row for chunk in parsed_chunks for parsed_row in chunk if parsed_row is not None]
+
+
+#####################################################
+# lxml native backend (settings.WEBPAGE_PARSER == settings.LXML_NATIVE_PARSER)
+# Mirrors parse_row / utilties.parse_table_cell, but on lxml elements
+
+def lxml_node_text(node) -> str:
+    """The bs4 .text of a node (text nodes are returned by XPath as plain strings)"""
+    return node if isinstance(node, str) else node.text_content()
+
+
+def parse_table_cell_lxml(cell, cell_text: str = None):
+    """ aggregate multiple values from a table cell (see utilties.parse_table_cell) """
+    line_breaks = cell.xpath('.//br')
+    if len(line_breaks) > 1:
+        # The values are the nodes right after each line break (bs4's br.next)
+        text = []
+        for line_break in line_breaks:
+            next_node = line_break.xpath('following::node()[1]')
+            if not next_node:
+                MODULE_LOGGER.warning(f'Failed to parse cell: {lxml_node_text(cell)}')
+                text = []
+                break
+            text.append(text_normalization.clean_cell_value(lxml_node_text(next_node[0])))
+        ret = [text_normalization.clean_text(y) for y in text] if text != [] else None
+    else:
+        # tuple of a single value
+        ret = text_normalization.clean_text(cell.text_content() if cell_text is None else cell_text),
+
+    return None if ret in (('_',), ('',)) else ret
+
+
+def parse_row_lxml(row, columns=None):
+    row_cells = row.xpath('.//td')  # get the cells of the current row
+    if len(row_cells) == 0:
+        return None     # Skip a capital letter row with no data (it's a special header)
+
+    current_row_columns = dict()  # a dict to store the data of the current row
+    for column in columns:
+        if column.index >= len(row_cells):
+            break  # the columns are in the cells order
+        value = row_cells[column.index]
+        value_text = value.text_content()
+        if value_text.strip() == settings.NO_VALUE:
+            continue  # an unknown value
+        cell_data = parse_table_cell_lxml(value, value_text)
+        if cell_data is None:
+            continue
+        current_row_columns[column.key] = cell_data if column.multi_valued else cell_data[0]
+
+        if column.link:
+            # Look for a link to the image or page that contains the image (exists for all animals).
+            image_page = value.xpath('.//a[@href]/@href')
+            if image_page:
+                current_row_columns[column.link] = image_page[0] if image_page[0] else None
+    return current_row_columns
+
+
+def find_main_table_rows_lxml(page_content: bytes, spec) -> Union[None, Tuple[Tuple[str, ...], list]]:
+    """The headers and the data rows (lxml elements) of the spec's table"""
+    try:
+        with instrumentation.timer('parse_main_page'):
+            tree = lxml.html.fromstring(page_content, parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except (lxml.etree.ParserError, ValueError) as e:
+        MODULE_LOGGER.exception(f'Failed to parse the html page: {e}')
+        return None
+
+    tables = tree.xpath(spec.table_xpath)
+    try:
+        rows = tables[spec.table_index].xpath('.//tr')
+    except IndexError:
+        MODULE_LOGGER.critical(f'Failed to find the table of {spec.name} '
+                               f'(xpath={spec.table_xpath}, index={spec.table_index})')
+        return None
+    table_headers = tuple(header.text_content().strip() for header in rows[0].xpath('.//th'))  # coloumns "names"
+    return table_headers, rows[spec.first_data_row:]
+
+
+def iter_page_rows_lxml(page_content: bytes, spec) -> Union[None, Iterator[dict]]:
+    """
+    Lazily parse the rows of the spec's table, one row per iteration (lets the caller interleave other work).
+    None is returned when the table can't be found.
+    """
+    main_table = find_main_table_rows_lxml(page_content, spec)
+    if main_table is None:
+        return None
+    table_headers, rows = main_table
+    columns = spec.compile(table_headers)
+    parsed_rows = (parse_row_lxml(row, columns) for row in rows)
+    return (parsed_row for parsed_row in parsed_rows if parsed_row is not None)
+
+
+def parse_page_with_lxml(page_content: bytes, spec) -> Union[None, list]:
+    """Extract the rows of the spec's table straight from the page content (lxml.html + XPath, no bs4 tree)"""
+    with instrumentation.timer('parse_table'):
+        rows = iter_page_rows_lxml(page_content, spec)
+        return None if rows is None else list(rows)
@@ -0,0 +1,133 @@
+"""
+Declarative tables specs: which page, which table, which columns (and how to read them) and how to group the rows.
+A spec is compiled once per table (against the table's headers) into a column-index map, so the rows parsers
+only visit the cells of interest, by their index, instead of checking every cell's header name.
+The specs are dicts (see settings.ANIMALS_TABLE_SPEC), or loaded from a JSON/YAML file.
+"""
+import json
+import asyncio
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+import settings
+import logger
+import utilties
+import animal_records
+import table_parser
+import cpu_offload
+import instrumentation
+
+MODULE_LOGGER = logger.Logger(__name__)
+
+# A compiled column: the cell index in the row, the key in the parsed row, and how the cell is read
+# (link: the key of the cell's link in the parsed row, None when the link isn't kept)
+Column = namedtuple('Column', ('index', 'key', 'multi_valued', 'link'))
+ALL_COLUMNS = '*'
+
+
+class TableSpec:
+    def __init__(self, name: str, url: str, columns: Union[str, Sequence[str]] = ALL_COLUMNS,
+                 multi_valued: Union[str, Sequence[str]] = (), link_columns: Sequence[str] = (),
+                 key_column: str = None, group_by: Union[str, Sequence[str]] = None,
+                 table_xpath: str = settings.MAIN_TABLE_XPATH,
+                 table_index: int = -1, first_data_row: int = 1):
+        """
+        columns: the headers of the columns to keep ('*' for all of them)
+        multi_valued: the columns whose cells hold several values (a list), the others hold a single value ('*': all)
+        link_columns: the columns whose first link is kept as well (under '<column><LINK_SUFFIX>')
+        key_column: the column naming a row (e.g. the animal)
+        group_by: the (multi valued) column to group by, or several columns (grouped by the tuples of their values)
+        table_xpath, table_index: the table locator (the table_index-th table matched by table_xpath)
+        """
+        self.name = name
+        self.url = url
+        self.columns = columns
+        self.multi_valued = multi_valued
+        self.link_columns = tuple(link_columns)
+        self.key_column = key_column
+        self.group_by = group_by
+        self.table_xpath = table_xpath
+        self.table_index = table_index
+        self.first_data_row = first_data_row
+
+    @classmethod
+    def from_dict(cls, spec: dict) -> 'TableSpec':
+        spec = dict(spec)
+        if not str(spec.get('url', '')).startswith(('http://', 'https://')):
+            spec['url'] = f'{settings.BASE_URL}{spec.get("url", "")}'  # e.g. /wiki/List_of_...
+        return cls(**spec)
+
+    def __repr__(self):
+        return f'TableSpec({self.name!r}, {self.url!r})'
+
+    def compile(self, table_headers: Sequence[str]) -> Tuple[Column, ...]:
+        """The column-index map of the table (computed once per table, not per row)"""
+        wanted = set(table_headers) if self.columns == ALL_COLUMNS else set(self.columns)
+        missing = wanted.difference(table_headers)
+        if missing:
+            MODULE_LOGGER.warning(f'{self.name}: no such columns {sorted(missing)} (the headers: {table_headers})')
+        columns, seen = [], set()
+        for index, header in enumerate(table_headers):
+            if header in wanted and header not in seen:  # the first of the columns sharing a header
+                seen.add(header)
+                columns.append(Column(index, header,
+                                      self.multi_valued == ALL_COLUMNS or header in self.multi_valued,
+                                      header + settings.LINK_SUFFIX if header in self.link_columns else None))
+        return tuple(columns)
+
+
+def load_table_specs(path: Union[None, Path]) -> List[TableSpec]:
+    """A list of specs (dicts) from a JSON or YAML (requires PyYAML, an optional dependency) file"""
+    if not path:
+        return []
+    path = Path(path)
+    try:
+        with open(path, 'r', encoding='utf-8') as specs_file:
+            if path.suffix in ('.yaml', '.yml'):
+                import yaml
+                specs = yaml.safe_load(specs_file)
+            else:
+                specs = json.load(specs_file)
+        return [TableSpec.from_dict(spec) for spec in specs or ()]
+    except ImportError:
+        MODULE_LOGGER.critical(f'PyYAML is required to load the tables specs from {path} (or use a JSON file)')
+    except Exception as e:
+        MODULE_LOGGER.exception(f'Failed to load the tables specs from {path}: {e}')
+    return []
+
+
+def group_rows(rows: Iterable[dict], spec: TableSpec, values: Iterable = None) -> animal_records.AdjectiveIndex:
+    """The rows grouped by the spec's group_by column(s), named by its key column (see animal_records.group_records)"""
+    return animal_records.group_records(rows, spec.key_column, spec.group_by, values)
+
+
+async def scrape_table(spec: TableSpec, session) -> Tuple[TableSpec, List[dict], Dict[str, list]]:
+    """Fetch the spec's page, parse its table (in the CPU offload pool) and group its rows"""
+    content = await utilties.retrieve_content(spec.url, session)
+    if not content:
+        MODULE_LOGGER.critical(f'{spec.name}: failed to fetch {spec.url}')
+        return spec, [], dict()
+    async with instrumentation.timer('parse_page_offloaded'):
+        rows = await cpu_offload.CPU_OFFLOAD.run(table_parser.parse_page_with_lxml, content, spec)
+    if rows is None:
+        return spec, [], dict()
+    grouping = group_rows(rows, spec) if spec.group_by else dict()
+    MODULE_LOGGER.info(f'{spec.name}: {len(rows)} rows, {len(grouping)} groups')
+    return spec, rows, grouping
+
+
+async def scrape_tables(specs: Iterable[TableSpec], session) -> List[Tuple[TableSpec, List[dict], Dict[str, list]]]:
+    """Scrape several tables (pages) concurrently, a failed table doesn't affect the others"""
+    specs = list(specs)
+    results = await asyncio.gather(*(scrape_table(spec, session) for spec in specs), return_exceptions=True)
+    scraped = list()
+    for spec, result in zip(specs, results):
+        if isinstance(result, BaseException):
+            MODULE_LOGGER.critical(f'Failed to scrape the table {spec.name}: {result}')
+            continue
+        scraped.append(result)
+    return scraped
+
+
+MAIN_TABLE = TableSpec.from_dict(settings.ANIMALS_TABLE_SPEC)
@@ -0,0 +1,10 @@
+"""
+The scraper modules are flat (main.py runs from this folder), and the fixture server lives in the benchmarks folder.
+The tests run offline: the MediaWiki API and the pages are served by benchmarks/fixture_server.py
+"""
+import sys
+from pathlib import Path
+
+V3_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(V3_DIR))
+sys.path.insert(0, str(Path(V3_DIR.parent, 'benchmarks')))
@@ -0,0 +1,130 @@
+"""mediawiki_api.resolve_lead_images against the fixture server's MediaWiki API emulation"""
+import io
+import json
+import asyncio
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+import settings
+import utilties
+import cpu_offload
+import image_store
+import image_downloader
+import mediawiki_api
+
+from fixture_server import SNAPSHOT_BASE_PLACEHOLDER, FixtureServer, snapshot_file_name
+
+import aiohttp
+
+ANIMALS = ('Red fox', 'Dog', 'Cat', 'Horse', 'Goat', 'Sheep', 'Cow')
+
+
+def save_snapshot_file(snapshot_dir: Path, url_path: str, content: bytes) -> None:
+    path = Path(snapshot_dir, snapshot_file_name(url_path))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+def image_uri(title: str) -> str:
+    return f'{SNAPSHOT_BASE_PLACEHOLDER}/upload/{title.replace(" ", "_")}.png'
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path) -> Path:
+    """An animal page (with its lead image) per animal, and a redirect to one of them"""
+    for index, title in enumerate(ANIMALS):
+        ld_json = json.dumps({'@context': 'https://schema.org', 'image': image_uri(title)})
+        page = f'<html><head><script type="application/ld+json">{ld_json}</script></head><body></body></html>'
+        save_snapshot_file(tmp_path, f'/wiki/{title.replace(" ", "_")}', page.encode())
+        image = io.BytesIO()
+        Image.new('RGB', (4, 4), (index * 30, 0, 0)).save(image, format='png')
+        save_snapshot_file(tmp_path, f'/upload/{title.replace(" ", "_")}.png', image.getvalue())
+    save_snapshot_file(tmp_path, '/wiki/Vulpes_vulpes', b'#REDIRECT [[Red fox]]')
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def offline_settings(monkeypatch):
+    monkeypatch.setattr(utilties, 'HTTP_CACHE', None)
+    monkeypatch.setattr(cpu_offload, 'CPU_OFFLOAD', cpu_offload.CpuOffload(mode=cpu_offload.INLINE))
+    monkeypatch.setattr(settings, 'THUMBNAILS_ENABLED', False)
+
+
+def run_against_fixture_server(monkeypatch, snapshot_dir: Path, scenario, **server_options):
+    """asyncio.run(scenario(server, session)) with the MediaWiki API (and the pages) served by a FixtureServer"""
+    async def run():
+        server = FixtureServer(snapshot_dir, **server_options)
+        base_url = await server.start()
+        monkeypatch.setattr(settings, 'BASE_URL', base_url)
+        monkeypatch.setattr(settings, 'MEDIAWIKI_API_URL', f'{base_url}/w/api.php')
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await scenario(server, session)
+        finally:
+            await server.stop()
+
+    return asyncio.run(run())
+
+
+def expected_image_uri(server: FixtureServer, title: str) -> str:
+    return image_uri(title).replace(SNAPSHOT_BASE_PLACEHOLDER, server.base_url)
+
+
+def test_titles_are_queried_in_batches_of_the_batch_size(monkeypatch, snapshot_dir):
+    monkeypatch.setattr(settings, 'MEDIAWIKI_API_BATCH_SIZE', 3)
+    hrefs = [f'/wiki/{title.replace(" ", "_")}' for title in ANIMALS]
+
+    async def scenario(server, session):
+        return server, await mediawiki_api.resolve_lead_images(hrefs, session)
+
+    server, resolved = run_against_fixture_server(monkeypatch, snapshot_dir, scenario)
+    assert server.api_requests == 3  # 7 titles, 3 per request
+    assert resolved == {href: expected_image_uri(server, title) for href, title in zip(hrefs, ANIMALS)}
+
+
+def test_normalized_and_redirected_titles_are_resolved(monkeypatch, snapshot_dir):
+    hrefs = ['/wiki/red_fox', '/wiki/Vulpes_vulpes', '/wiki/vulpes_vulpes', '/wiki/Red_fox#Diet', '/wiki/Cat']
+
+    async def scenario(server, session):
+        return server, await mediawiki_api.resolve_lead_images(hrefs, session)
+
+    server, resolved = run_against_fixture_server(monkeypatch, snapshot_dir, scenario)
+    assert server.api_requests == 1
+    assert resolved == {
+        '/wiki/red_fox': expected_image_uri(server, 'Red fox'),  # normalized
+        '/wiki/Vulpes_vulpes': expected_image_uri(server, 'Red fox'),  # redirected
+        '/wiki/vulpes_vulpes': expected_image_uri(server, 'Red fox'),  # normalized, then redirected
+        '/wiki/Red_fox#Diet': expected_image_uri(server, 'Red fox'),
+        '/wiki/Cat': expected_image_uri(server, 'Cat'),
+    }
+
+
+def test_continued_responses_are_followed(monkeypatch, snapshot_dir):
+    hrefs = [f'/wiki/{title.replace(" ", "_")}' for title in ANIMALS]
+
+    async def scenario(server, session):
+        return server, await mediawiki_api.resolve_lead_images(hrefs, session)
+
+    server, resolved = run_against_fixture_server(monkeypatch, snapshot_dir, scenario, api_page_limit=3)
+    assert server.api_requests == 3  # a single batch, its 7 images are sent 3 per response
+    assert resolved == {href: expected_image_uri(server, title) for href, title in zip(hrefs, ANIMALS)}
+
+
+def test_unresolved_titles_fall_back_to_parsing_the_animal_page(monkeypatch, snapshot_dir, tmp_path):
+    hrefs = ['/wiki/Dog', '/wiki/Cat', '/wiki/Unicorn']
+    store = image_store.ImageStore(Path(tmp_path, 'images'), Path(tmp_path, 'images', 'manifest.sqlite3'))
+
+    async def scenario(server, session):
+        resolved = await mediawiki_api.resolve_lead_images(hrefs, session)
+        # As download_images_async does: the animals the API didn't resolve get their image from their page
+        image_path = await image_downloader.fetch_animal_image(
+            f'{server.base_url}/wiki/Dog', 'dog', session, image_uri=resolved.get('/wiki/Dog'), store=store)
+        return server, resolved, image_path
+
+    server, resolved, image_path = run_against_fixture_server(
+        monkeypatch, snapshot_dir, scenario, api_missing_images={'Dog'})
+    store.close()
+    assert resolved == {'/wiki/Cat': expected_image_uri(server, 'Cat')}  # no lead image for Dog, no Unicorn page
+    assert image_path.read_bytes() == Path(snapshot_dir, 'upload', 'Dog.png').read_bytes()
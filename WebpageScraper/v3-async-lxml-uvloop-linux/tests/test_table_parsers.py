@@ -0,0 +1,72 @@
+"""
+The main table parsers produce the same rows (lxml native, bs4 and the process pool) on a saved page.
+The page has other tables around the main one (a maintenance box, a non sortable wikitable, a navbox with a nested
+table), so the tables locators of the parsers are checked as well
+"""
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import settings
+import main
+import cpu_offload
+import table_parser
+import table_spec
+
+FIXTURE_PAGE = Path(Path(__file__).parent, 'fixtures', 'List_of_animal_names.html')
+
+
+@pytest.fixture(scope='module')
+def page() -> bytes:
+    return FIXTURE_PAGE.read_bytes()
+
+
+@pytest.fixture(scope='module')
+def lxml_rows(page) -> list:
+    return table_parser.parse_page_with_lxml(page, table_spec.MAIN_TABLE)
+
+
+@pytest.fixture
+def process_pool() -> cpu_offload.CpuOffload:
+    offload = cpu_offload.CpuOffload(cpu_offload.PROCESS_POOL, workers=2)
+    yield offload
+    offload.shutdown()
+
+
+async def parse_with_bs4(page: bytes) -> list:
+    table = await main.get_main_table(page)
+    return await main.parse_table(table, session=True, spec=table_spec.MAIN_TABLE)
+
+
+@pytest.mark.parametrize('tree_builder', ['lxml', 'html.parser'])
+def test_lxml_rows_are_the_bs4_rows(monkeypatch, page, lxml_rows, tree_builder):
+    monkeypatch.setattr(settings, 'BS4_TREE_BUILDER', tree_builder)
+    assert asyncio.run(parse_with_bs4(page)) == lxml_rows
+
+
+def test_process_pool_rows_are_the_lxml_rows(page, lxml_rows, process_pool):
+    rows = asyncio.run(table_parser.parse_page_in_process_pool(page, table_spec.MAIN_TABLE, process_pool))
+    assert rows == lxml_rows
+
+
+def test_lxml_rows(lxml_rows):
+    adjectives = settings.COLATERAL_COLLECTIVES_COL
+    link = settings.COL_WITH_IMAGE_KEY + settings.LINK_SUFFIX
+    rows = {row[settings.ANIMAL_NAME_COL_KEY]: row for row in lxml_rows}
+
+    assert len(lxml_rows) == 18  # the letters header rows aren't animals
+    assert lxml_rows[0] == {'Animal': 'aardvark', link: '/wiki/Aardvark', adjectives: ('orycteropodian',)}
+    assert rows['albatross'][adjectives] == ('diomedeine',)  # without its citation
+    assert rows['bear'][link] == '/wiki/Bear'  # the name without its "(list)" link
+    assert rows['cat'][link] == '/wiki/Cat'  # the name without its "Also see" reference
+    assert rows['black_panther'][link] == '/wiki/Black_panther#Leopard'
+    assert adjectives not in rows['zorse']  # "?" - no value
+
+
+def test_the_parsers_locate_the_table_by_its_classes(page, lxml_rows, process_pool):
+    # The classes in another order, and more of them (e.g. added by a page script)
+    page = page.replace(b'<table class="wikitable sortable">', b'<table class="sortable jquery-tablesorter wikitable">')
+    assert table_parser.parse_page_with_lxml(page, table_spec.MAIN_TABLE) == lxml_rows
+    assert asyncio.run(parse_with_bs4(page)) == lxml_rows
+    assert asyncio.run(table_parser.parse_page_in_process_pool(page, table_spec.MAIN_TABLE, process_pool)) == lxml_rows
@@ -0,0 +1,51 @@
+"""
+Text normalization of the table cells and the files names.
+The patterns are compiled once, the text is cut at the first stop word in a single pass (instead of a chain of
+split()s, each allocating a list and a string), and clean_text is memoized: the cells repeat a lot
+(e.g. the same collateral adjectives, the same young/collective nouns).
+"""
+import re
+import functools
+from typing import Union
+
+import settings
+
+NON_ALPHABETIC_PATTERN = re.compile(r'[^a-zA-Z,]+')
+FORBIDDEN_FILE_NAME_CHARS_PATTERN = re.compile(r'[^a-zA-Z0-9_.-]+')
+# The not-so-important information (e.g. 'see Also' or 'list' references), the text is cut at the first of them
+STOP_WORDS_PATTERN = re.compile('|'.join(('list', 'also', 'see', 'citation')))
+CELL_NOISE_PATTERN = re.compile(re.escape(' (list)') + '|Also')
+
+
+def cut_at(pattern: re.Pattern, text: str) -> str:
+    """The text up to the first match of the pattern (all of it when there is none)"""
+    match = pattern.search(text)
+    return text[:match.start()] if match else text
+
+
+@functools.lru_cache(maxsize=settings.TEXT_NORMALIZATION_CACHE_SIZE)
+def clean_text(text: str) -> Union[None, str]:
+    """
+    Replace all non-alphabetic characters from the text so it represents a valid filename
+    It also throws not-so-important information (e.g. 'see Also' or 'list' references) away
+    Match a single character not present in the list below [^a-zA-Z, ]
+    + matches the previous token between one and unlimited times, as many times as possible,
+     giving back as needed (greedy)
+    """
+    ret = cut_at(STOP_WORDS_PATTERN, NON_ALPHABETIC_PATTERN.sub(settings.PATHNAME_STUB_SYMBOL, text).lower())
+    if not ret:
+        return None
+    return ret[:-1] if ret[-1] == settings.PATHNAME_STUB_SYMBOL else ret
+
+
+def clean_cell_value(text: str) -> str:
+    """A value of a multi-valued cell, without its '(list)'/'Also' references"""
+    return cut_at(CELL_NOISE_PATTERN, text.strip())
+
+
+def get_proper_file_name_part(original_filename: str) -> str:
+    """
+    Replace forbidden Windows filenames characters with harmless PATHNAME_STUB_SYMBOL
+    and return resulting string
+    """
+    return FORBIDDEN_FILE_NAME_CHARS_PATTERN.sub(settings.PATHNAME_STUB_SYMBOL, original_filename)
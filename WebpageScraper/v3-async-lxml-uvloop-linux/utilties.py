@@ -1,69 +1,108 @@
 import os
-import re
 import time
+from collections import namedtuple
 from http import HTTPStatus
 from pathlib import Path
+from typing import Iterator, Tuple
 
 import settings
 from logger import Logger
+from http_cache import ResponseCache
+from download_scheduler import UNSCHEDULED
+from retry_policy import DEFAULT_RETRY_POLICY
+from instrumentation import timer
+from text_normalization import clean_text, clean_cell_value, get_proper_file_name_part
 
 import aiofile
 
 # Globals :(
 MAIN_LOGGER = Logger(__name__)
+HTTP_CACHE = ResponseCache() if settings.HTTP_CACHE_ENABLED else None
 
+FetchedResponse = namedtuple('FetchedResponse', ('status', 'headers', 'body'))
 
-# Parsing text utils
-def clean_text(text):
-    """
-    Replace all non-alphabetic characters from the text so it represents a valid filename
-    It also throws not-so-important information (e.g. 'see Also' or 'list' references) away
-    Match a single character not present in the list below [^a-zA-Z, ]
-    + matches the previous token between one and unlimited times, as many times as possible,
-     giving back as needed (greedy)
-    """
-    ret = re.sub('[^a-zA-Z,]+', settings.PATHNAME_STUB_SYMBOL, text).lower()
-    ret = ret.split('list')[0].split('also')[0].split('see')[0].split('citation')[0]
-    try:
-        ret = ret[:-1] if ret[-1] == settings.PATHNAME_STUB_SYMBOL else ret
-    except IndexError:
-        return None
-    return ret
 
-
-async def parse_table_cell(item):
-    ''' aggregate multiple values from a table cell '''
+# Parsing text utils
+def parse_table_cell(item, item_text: str = None):
+    ''' aggregate multiple values from a table cell (item_text: the item's .text, when the caller already has it) '''
     # search for line breaks
     lst = item.find_all('br')
     if len(lst) > 1:
-        text = [x.text for x in lst if x.text != '']
+        text = [x_text for x_text in (x.text for x in lst) if x_text != '']
         if len(text) == 0:
             try:
-                text = [x.next.text.strip().split(' (list)')[0].split('Also')[0] for x in lst]
+                text = [clean_cell_value(x.next.text) for x in lst]
             except:
                 MAIN_LOGGER.exception(f'Failed to parse cell: {lst}')
         ret = [clean_text(y) for y in text] if text != [] else None
     else:
-        ret = clean_text(item.text),  # tuple of a single value
+        ret = clean_text(item.text if item_text is None else item_text),  # tuple of a single value
 
     return None if ret in (('_',), ('',)) else ret
 
 
 #####################################################
 
-async def retrieve_content(uri: str, session) -> bytes:
+async def send_request(uri: str, session, read_body, request_headers: dict = None,
+                       scheduler=None, retry_policy=None, method: str = 'GET') -> FetchedResponse:
+    """
+    Send a GET (or `method`) request through the provided download_scheduler (no limits by default),
+    retrying according to the retry_policy.
+    A successful (200) response is handed to the `read_body(response)` coroutine,
+    whatever it returns becomes the body of the returned FetchedResponse.
+    """
+    scheduler = scheduler or UNSCHEDULED
+    retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+
+    async def request(ticket) -> FetchedResponse:
+        async with timer('fetch'), session.request(method, uri, headers=request_headers or {}) as response:
+            ticket.report(response.status)
+            # TODO: how come the status is retrieved before the response "content" is awaited?
+            body = await read_body(response) if response.status == HTTPStatus.OK else None
+            return FetchedResponse(response.status, response.headers, body)
+
+    async def attempt(within_deadline) -> FetchedResponse:
+        # The deadline only runs once the slot is acquired (not while queued behind the other downloads)
+        async with scheduler.slot(uri) as ticket:
+            return await within_deadline(request(ticket))
+
+    return await retry_policy.call(uri, attempt)
+
+
+async def read_whole_body(response) -> bytes:
+    return await response.read()  # response.content won't work here (aiohttp way)
+
+
+async def ignore_body(response) -> None:
+    return None  # e.g. a HEAD response
+
+
+async def retrieve_content(uri: str, session, use_cache: bool = True, scheduler=None, retry_policy=None) -> bytes:
     """
     General method for retrieving content from a provided URI.
-    Empty bytes list will be returned on any exception
+    Empty bytes list will be returned on any exception (once the retry_policy gave up)
+    Pages are served from (and stored in) the HTTP_CACHE unless use_cache is False (e.g. for big images)
     """
     result = bytes()
+    cache = HTTP_CACHE if use_cache else None
+    request_headers = {}
+
     try:
-        async with session.get(uri) as response:
-            # TODO: how come the status is retrieved before the response "content" is awaited?
-            if response.status == HTTPStatus.OK:
-                result = await response.read()  # response.content won't work here (aiohttp way)
-            else:
-                MAIN_LOGGER.critical(f'Failed to retrieve content from {uri} Error code:{response.status}')
+        cached = cache.lookup(uri) if cache else None
+        if cached:
+            if cache.is_fresh(cached):
+                return await cache.serve_fresh(uri)
+            request_headers = cache.conditional_headers(cached)
+
+        response = await send_request(uri, session, read_whole_body, request_headers, scheduler, retry_policy)
+        if response.status == HTTPStatus.NOT_MODIFIED and cached:
+            result = await cache.serve_revalidated(uri, response.headers)
+        elif response.status == HTTPStatus.OK:
+            result = response.body
+            if cache:
+                await cache.store(uri, result, response.headers)
+        else:
+            MAIN_LOGGER.critical(f'Failed to retrieve content from {uri} Error code:{response.status}')
 
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to retrieve content from {uri}: {e}')
@@ -71,15 +110,7 @@ async def retrieve_content(uri: str, session) -> bytes:
     return result
 
 
-def get_proper_file_name_part(original_filename: str) -> str:
-    """
-    Replace forbidden Windows filenames characters with harmless PATHNAME_STUB_SYMBOL
-    and return resulting string
-    """
-    return re.sub('[^a-zA-Z0-9_.-]+', settings.PATHNAME_STUB_SYMBOL, original_filename)
-
-
-# Note: Doesn't work for async code. why?
+# Note: Doesn't work for async code (see instrumentation.timed, which does)
 def timeit(method, *args, **kwargs):
     """ A decorator that reports the execution time."""
     def timed(*args, **kwargs):
@@ -94,46 +125,93 @@ def timeit(method, *args, **kwargs):
     return timed
 
 
-async def create_html_from_template(html_body=None, template_path=None, output_path=None):
+class BufferedFileWriter:
+    """
+    Accumulates the written strings, and writes them to the (async) file in chunks of at least buffer_size
+    characters, rather than an aio write per string (or a single write of the whole content)
+    """
+
+    def __init__(self, output_file, buffer_size: int = settings.HTML_WRITE_BUFFER_SIZE):
+        self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.buffer, self.buffered = list(), 0
+
+    async def write(self, text: str) -> None:
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.buffer:
+            await self.output_file.write(''.join(self.buffer))
+            self.buffer, self.buffered = list(), 0
+
+
+def split_template(template: str, placeholder: str = '{data}') -> Tuple[str, str]:
+    """The template head and tail (around the data placeholder), with their str.format() escaped braces undone"""
+    head, tail = template.split(placeholder, 1)
+    return tuple(part.replace('{{', '{').replace('}}', '}') for part in (head, tail))
+
+
+def render_html_rows(grouped_by_collateral_adjective: dict, thumbnails: dict = None) -> Iterator[str]:
+    """
+    A table row per collateral adjective (rendered lazily, one at a time).
+    The images paths are the download results (None -> no image), thumbnails maps an image path to its thumbnail
+    """
+    thumbnails = thumbnails or dict()
+    # The images (and thumbnails) folders as seen from the page, joined with the files names (no Path per image)
+    images_folder = f'{settings.IMAGES_FOLDER_SYMLINK}{os.sep}'
+    try:
+        thumbnails_folder = Path(settings.IMAGES_FOLDER_SYMLINK,
+                                 settings.THUMBNAILS_DIR.relative_to(settings.SAVED_IMAGES_DIR))
+    except ValueError:
+        thumbnails_folder = settings.THUMBNAILS_DIR  # not under the images folder, referenced as is
+    thumbnails_folder = f'{thumbnails_folder}{os.sep}'
+    for col_adj, animals in grouped_by_collateral_adjective.items():
+        animals_field = list()
+        for animal_name, image_path in animals:
+            animals_field.append(animal_name)
+            if image_path:
+                original_path = f'{images_folder}{image_path.name}'
+                # The (much lighter) thumbnail links to the original, the browser loads it only when scrolled to
+                thumbnail = thumbnails.get(image_path)
+                image_src = f'{thumbnails_folder}{thumbnail.name}' if thumbnail else original_path
+                animals_field.append(f'<a href="{original_path}"><img src="{image_src}" '
+                                     f'width="{settings.IMAGE_HTML_WIDTH}" loading="lazy" decoding="async"></a>')
+
+        yield '\n'.join((f'<tr><td style="text-align:center">{col_adj}</td><td style="text-align:center">',
+                         '<br />'.join(animals_field),
+                         '</td></tr>'))
+
+
+#TODO: increase font size and adjust images fitting with CSS rules/JS scripts
+async def print_results_to_HTML(grouped_by_collateral_adjective: dict, thumbnails: dict = None) -> None:
+    """
+    Builds an HTML page with all the relevant data (collateral adjectives,animals and their image)
+    Streamed: the template head, then the rows as they are rendered, then the template tail
+    """
+    create_symlink(settings.SAVED_IMAGES_DIR, settings.IMAGES_FOLDER_SYMLINK, target_is_dir=True)
     try:
-        async with aiofile.async_open(template_path, 'r') as template_file:
-            template = await template_file.read()
+        async with aiofile.async_open(settings.OUTPUT_HTML_FILE_TEMPLATE, 'r') as template_file:
+            head, tail = split_template(await template_file.read())
     except FileNotFoundError as e:
         MAIN_LOGGER.exception(f'Failed to open template file: {e}')
         return
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to read template file: {e}')
-    else:
-        try:
-            async with aiofile.async_open(output_path, 'w') as html_output_file:
-                await html_output_file.write(template.format(data='\n'.join(html_body)))
-        except Exception as e:
-            MAIN_LOGGER.exception(f'Failed to write HTML output file: {e}')
-
-
-#TODO: increase font size and adjust images fitting with CSS rules/JS scripts
-async def print_results_to_HTML(grouped_by_collateral_adjective: dict) -> None:
-    """Builds an HTML page with all the relevant data (collateral adjectives,animals and their image)"""
-    create_symlink(settings.SAVED_IMAGES_DIR, settings.IMAGES_FOLDER_SYMLINK, target_is_dir=True)
-    html_body = list()
-    for col_adj in grouped_by_collateral_adjective:
-        row = list()
-        row.append(f'<tr><td style="text-align:center">{col_adj}</td><td style="text-align:center">')
-        animals_field = list()
-
-        for animal_name, image_path in grouped_by_collateral_adjective[col_adj]:
-            animals_field.append(animal_name)
-            if image_path and os.path.isfile(image_path):
-                # concatenate to the image file name another parent folder pathlib
-                image_path = Path(settings.IMAGES_FOLDER_SYMLINK, image_path.name)
-                animals_field.append(f'<img src="{image_path}" width="{settings.IMAGE_HTML_WIDTH}">')
-
-        row.append('<br />'.join(animals_field))
-        row.append('</td></tr>')
-        html_body.append('\n'.join(row))
+        return
 
-    await create_html_from_template(html_body=html_body, template_path=settings.OUTPUT_HTML_FILE_TEMPLATE,
-                              output_path=settings.OUTPUT_HTML_FILE)
+    try:
+        async with aiofile.async_open(settings.OUTPUT_HTML_FILE, 'w') as html_output_file:
+            writer = BufferedFileWriter(html_output_file)
+            await html_output_file.write(head)  # right away, the page starts rendering
+            for index, row in enumerate(render_html_rows(grouped_by_collateral_adjective, thumbnails)):
+                await writer.write(f'\n{row}' if index else row)
+            await writer.write(tail)
+            await writer.flush()
+    except Exception as e:
+        MAIN_LOGGER.exception(f'Failed to write HTML output file: {e}')
 
 
 # TODO: Could have also create a hard-link (just in case someone will move the linked images folder)
@@ -144,6 +222,6 @@ def create_symlink(absolute_path, local_link_name, target_is_dir=False, overwrit
     try:
         os.symlink(absolute_path, local_link_name, target_is_dir)
     except FileExistsError:
-        MAIN_LOGGER.debug(f'Symlink {absolute_path}->{local_link_name} already exists')
+        MAIN_LOGGER.debug('Symlink %s->%s already exists', absolute_path, local_link_name)
     except Exception as e:
         MAIN_LOGGER.exception(f'Failed to create symlink: {e}')